@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк FSM-хранилищ: aiogram RedisStorage против core.fsm_storage.HashStorage.
+
+Сценарий повторяет типичный хендлер загрузки фото: get_state → get_data →
+update_data(photos=...) → set_state. Для каждого хранилища печатает время
+на хендлер, число команд Redis (INFO stats) и память ключей (MEMORY USAGE).
+
+Запуск (нужен отдельный Redis, БД будет очищена):
+    PYTHONPATH=src python bench/fsm_storage.py --db 15 --chats 2000
+"""
+import argparse
+import asyncio
+import time
+
+import redis.asyncio as aioredis
+from aiogram.fsm.storage.base import DefaultKeyBuilder, StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+
+from core.fsm_storage import HashStorage
+
+BOT_ID = 1
+STATE = "GenStates:waiting_photos"
+
+
+def _photo(i: int) -> dict:
+    return {"file_id": f"AgACAgIAAxkBAAI{i:08d}" + "x" * 48, "unique_id": f"AQAD{i:06d}"}
+
+
+def _base_data(chat_id: int) -> dict:
+    return {
+        "mode": "edit",
+        "prompt": "сделай фон закатным, добавь мягкий свет " * 3,
+        "photos": [_photo(i) for i in range(4)],
+        "edits": [{"prompt": f"правка {i}", "task_id": f"task-{chat_id}-{i}"} for i in range(5)],
+        "last_result_urls": [f"https://tempfile.example/{chat_id}/{i}.png" for i in range(4)],
+        "last_task_uuid": f"{chat_id:032x}",
+        "aspect_ratio": "3:4",
+    }
+
+
+async def _commands(r: aioredis.Redis) -> int:
+    return int((await r.info("stats"))["total_commands_processed"])
+
+
+async def _run(name: str, storage, r: aioredis.Redis, chats: int) -> None:
+    await r.flushdb()
+    kb = DefaultKeyBuilder(with_bot_id=True)
+    keys = [StorageKey(bot_id=BOT_ID, chat_id=c, user_id=c) for c in range(1, chats + 1)]
+    for k in keys:
+        await storage.set_data(k, _base_data(k.chat_id))
+        await storage.set_state(k, STATE)
+
+    c0 = await _commands(r)
+    t0 = time.perf_counter()
+    for k in keys:
+        await storage.get_state(k)
+        data = await storage.get_data(k)
+        photos = data["photos"] + [_photo(99)]
+        await storage.update_data(k, {"photos": photos})
+        await storage.set_state(k, STATE)
+    elapsed = time.perf_counter() - t0
+    # INFO сам по себе тоже команда
+    cmds = await _commands(r) - c0 - 1
+
+    mem = 0
+    sample = keys[: min(200, len(keys))]
+    for k in sample:
+        for rk in (kb.build(k), kb.build(k, "state"), kb.build(k, "data")):
+            mem += await r.memory_usage(rk) or 0
+
+    print(
+        f"{name:<13} {elapsed / chats * 1e6:8.1f} мкс/хендлер"
+        f"  {cmds / chats:4.1f} команд/хендлер"
+        f"  {mem / len(sample):7.0f} байт/чат"
+    )
+
+
+async def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="localhost")
+    ap.add_argument("--port", type=int, default=6379)
+    ap.add_argument("--db", type=int, default=15)
+    ap.add_argument("--chats", type=int, default=2000)
+    args = ap.parse_args()
+
+    r = aioredis.Redis(host=args.host, port=args.port, db=args.db)
+    kb = DefaultKeyBuilder(with_bot_id=True)
+    try:
+        await _run("RedisStorage", RedisStorage(r, key_builder=kb, state_ttl=86400, data_ttl=86400), r, args.chats)
+        await _run("HashStorage", HashStorage(r, key_builder=kb, ttl=86400), r, args.chats)
+        await r.flushdb()
+    finally:
+        await r.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Задержка пути «голос → Whisper» до и после отказа от временного файла.
+
+- file:   BytesIO → NamedTemporaryFile → open() → запрос (как было в bot/routers/voice.py);
+- memory: тот же BytesIO сразу в запрос (services.transcribe).
+
+Запрос идёт через настоящий AsyncOpenAI (multipart-кодирование тела), но в
+httpx.MockTransport с задержкой ``--api-delay`` вместо сети, так что разница —
+это именно дисковый круг на event loop. ``--concurrency`` показывает, как
+синхронная запись файла тормозит параллельные апдейты.
+
+    python bench/voice_transcribe.py --size-kb 240 --runs 200 --concurrency 8
+    python bench/voice_transcribe.py --file sample.ogg
+"""
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+from openai import AsyncOpenAI
+
+
+def _client(api_delay: float) -> AsyncOpenAI:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await request.aread()  # тело целиком, как при реальной отправке
+        if api_delay:
+            await asyncio.sleep(api_delay)
+        return httpx.Response(200, text="распознанный текст", headers={"content-type": "text/plain"})
+
+    http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return AsyncOpenAI(api_key="bench", base_url="http://whisper.bench/v1", http_client=http, max_retries=0)
+
+
+async def _via_file(client: AsyncOpenAI, voice: io.BytesIO) -> str:
+    path = None
+    try:
+        with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as f:
+            f.write(voice.getvalue())
+            path = f.name
+        with open(path, "rb") as audio:
+            return await client.audio.transcriptions.create(
+                model="whisper-1", file=("voice.ogg", audio, "audio/ogg"), language="ru", response_format="text"
+            )
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+async def _via_memory(client: AsyncOpenAI, voice: io.BytesIO) -> str:
+    voice.seek(0)
+    return await client.audio.transcriptions.create(
+        model="whisper-1", file=("voice.ogg", voice, "audio/ogg"), language="ru", response_format="text"
+    )
+
+
+async def _run(name: str, fn, client: AsyncOpenAI, payload: bytes, runs: int, concurrency: int) -> None:
+    sem = asyncio.Semaphore(concurrency)
+    lat = []
+
+    async def one():
+        async with sem:
+            voice = io.BytesIO(payload)  # так буфер отдаёт Bot.download_file
+            t0 = time.perf_counter()
+            await fn(client, voice)
+            lat.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(runs)))
+    wall = time.perf_counter() - t0
+    lat.sort()
+    print(
+        f"{name:<7} p50={statistics.median(lat):7.2f} ms  "
+        f"p95={lat[int(len(lat) * 0.95) - 1]:7.2f} ms  "
+        f"max={lat[-1]:7.2f} ms  throughput={runs / wall:7.1f}/s"
+    )
+
+
+async def main(args) -> None:
+    if args.file:
+        with open(args.file, "rb") as f:
+            payload = f.read()
+    else:
+        payload = os.urandom(args.size_kb * 1024)
+    client = _client(args.api_delay)
+    print(f"voice={len(payload) / 1024:.0f} KB runs={args.runs} concurrency={args.concurrency}")
+    await _run("warmup", _via_memory, client, payload, min(10, args.runs), 1)
+    await _run("file", _via_file, client, payload, args.runs, args.concurrency)
+    await _run("memory", _via_memory, client, payload, args.runs, args.concurrency)
+    await client.close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--file", default=None, help="настоящий .ogg вместо случайных байт")
+    ap.add_argument("--size-kb", type=int, default=240, help="~1 минута голоса Opus")
+    ap.add_argument("--runs", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=1)
+    ap.add_argument("--api-delay", type=float, default=0.0, help="имитация ответа Whisper, с")
+    asyncio.run(main(ap.parse_args()))
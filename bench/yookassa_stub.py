@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка API YooKassa v3 для прогонов без реальных платежей.
+
+- POST /v3/payments — идемпотентно по Idempotence-Key (повтор отдаёт тот же платёж);
+- GET  /v3/payments/{id};
+- POST /stub/succeed/{id} — перевести платёж в succeeded и отправить вебхук
+  payment.succeeded на ``--webhook`` (как это делает YooKassa).
+
+Задержка и ошибки настраиваются, чтобы проверять таймауты и повторы клиента:
+    python bench/yookassa_stub.py --port 8099 --delay 0.3 --fail-rate 0.2
+    YOOKASSA_API_BASE=http://localhost:8099/v3
+"""
+import argparse
+import asyncio
+import random
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI()
+ARGS = argparse.Namespace(delay=0.0, fail_rate=0.0, webhook=None)
+
+_payments: Dict[str, dict] = {}
+_by_idem: Dict[str, str] = {}
+
+
+@app.post("/v3/payments")
+async def create_payment(req: Request, idempotence_key: Optional[str] = Header(None)):
+    if not idempotence_key:
+        return JSONResponse(
+            {"type": "error", "code": "invalid_request", "description": "Idempotence-Key is required"}, 400
+        )
+    await asyncio.sleep(ARGS.delay)
+    if random.random() < ARGS.fail_rate:
+        return JSONResponse({"type": "error", "code": "internal_server_error"}, 500)
+
+    if idempotence_key in _by_idem:
+        return _payments[_by_idem[idempotence_key]]
+
+    body = await req.json()
+    pid = str(uuid.uuid4())
+    _payments[pid] = {
+        "id": pid,
+        "status": "pending",
+        "paid": False,
+        "amount": body["amount"],
+        "description": body.get("description"),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "confirmation": {
+            "type": "redirect",
+            "confirmation_url": f"http://localhost/stub/checkout/{pid}",
+        },
+        "test": True,
+    }
+    _by_idem[idempotence_key] = pid
+    return _payments[pid]
+
+
+@app.get("/v3/payments/{pid}")
+async def get_payment(pid: str):
+    await asyncio.sleep(ARGS.delay)
+    if pid not in _payments:
+        return JSONResponse({"type": "error", "code": "not_found"}, 404)
+    return _payments[pid]
+
+
+@app.post("/stub/succeed/{pid}")
+async def succeed(pid: str):
+    p = _payments.get(pid)
+    if not p:
+        raise HTTPException(404)
+    p.update(status="succeeded", paid=True)
+    if ARGS.webhook:
+        async with httpx.AsyncClient() as cli:
+            await cli.post(ARGS.webhook, json={"type": "notification", "event": "payment.succeeded", "object": p})
+    return p
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8099)
+    ap.add_argument("--delay", type=float, default=0.0, help="задержка ответа, с")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="доля ответов 500 на создание")
+    ap.add_argument("--webhook", default=None, help="например http://localhost:8000/webhook/yookassa")
+    ARGS = ap.parse_args()
+    uvicorn.run(app, host="127.0.0.1", port=ARGS.port)
@@ -109,14 +109,39 @@ CREATE TABLE IF NOT EXISTS `broadcast_jobs` (
   `media_type`       VARCHAR(20)     NULL,
   `media_file_id`    TEXT            NULL,
   `media_file_path`  TEXT            NULL,
+  `segment`          VARCHAR(20)     NOT NULL DEFAULT 'all',
+  `parent_id`        VARCHAR(36)     NULL,
   PRIMARY KEY (`id`),
   KEY `idx_broadcast_status` (`status`),
   KEY `idx_broadcast_created` (`created_at`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- ============================================
+-- BROADCAST DELIVERIES TABLE (исход по каждому получателю, append-only)
+-- ============================================
+CREATE TABLE IF NOT EXISTS `broadcast_deliveries` (
+  `id`               BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+  `job_id`           VARCHAR(36)     NOT NULL,
+  `chat_id`          BIGINT          NOT NULL,
+  `status`           VARCHAR(16)     NOT NULL,
+  `error`            VARCHAR(32)     NULL,
+  `latency_ms`       INT UNSIGNED    NOT NULL DEFAULT 0,
+  `created_at`       TIMESTAMP       NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `idx_bd_job_status_chat` (`job_id`,`status`,`chat_id`),
+  KEY `idx_bd_created` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 COMMIT;
 SET FOREIGN_KEY_CHECKS = 1;
 
+-- ============================================
+-- МИГРАЦИИ для уже созданной БД
+-- ============================================
+-- ALTER TABLE `broadcast_jobs` ADD COLUMN `segment` VARCHAR(20) NOT NULL DEFAULT 'all' AFTER `media_file_path`;
+-- ALTER TABLE `broadcast_jobs` ADD COLUMN `parent_id` VARCHAR(36) NULL AFTER `segment`;
+-- + CREATE TABLE `broadcast_deliveries` (см. выше)
+
 -- ============================================
 -- SAMPLE DATA (опционально)
 -- ============================================
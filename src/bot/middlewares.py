@@ -1,16 +1,21 @@
 import time
 import asyncio
 import logging
-from typing import Callable, Dict, Any, Awaitable
+from typing import Callable, Dict, Any, Awaitable, Optional
 
 from aiogram import BaseMiddleware
-from aiogram.types import Message
+from aiogram.types import CallbackQuery, Message
 from aiogram.exceptions import (
     TelegramForbiddenError,
     TelegramRetryAfter,
     TelegramBadRequest,
 )
 
+from bot.states import CreateStates, GenStates, VoiceStates
+from core.config import settings
+from services.metrics import THROTTLED_UPDATES_TOTAL
+from services.ratelimit import RateLimiter
+
 logger = logging.getLogger("app")
 
 
@@ -54,20 +59,78 @@ class ErrorLoggingMiddleware(BaseMiddleware):
         # ❌ УБРАНО: finally блок с logger.info("message_processed") - слишком много логов
 
 
+_GEN_CALLBACKS = {"run_gen", "regenerate"}
+_GEN_STATES = {
+    GenStates.waiting_prompt.state,
+    GenStates.final_menu.state,
+    CreateStates.waiting_prompt.state,
+    VoiceStates.confirming_prompt.state,
+}
+
+
+def update_cost(event, raw_state: Optional[str]) -> int:
+    """Стоимость апдейта для лимита: запуск генерации и голос дороже кнопок меню."""
+    if isinstance(event, CallbackQuery):
+        if event.data in _GEN_CALLBACKS:
+            return settings.RATE_COST_GENERATION
+        return 1
+    if getattr(event, "voice", None) or getattr(event, "audio", None):
+        return settings.RATE_COST_GENERATION
+    text = getattr(event, "text", None)
+    if text and not text.startswith("/") and raw_state in _GEN_STATES:
+        return settings.RATE_COST_GENERATION
+    return 1
+
+
 class RateLimitMiddleware(BaseMiddleware):
-    def __init__(self, redis_client, limit_per_min: int):
-        self.redis = redis_client
-        self.limit = limit_per_min
-
-    async def __call__(self, handler, event: Message, data):
-        key = f"rl:{event.from_user.id}"
-        count = await self.redis.incr(key)
-        if count == 1:
-            await self.redis.expire(key, 60)
-        if count > self.limit:
+    """Один общий RateLimiter (services.ratelimit) на сообщения и колбэки."""
+
+    def __init__(self, limiter: RateLimiter, event_type: str = "message"):
+        self.limiter = limiter
+        self.event_type = event_type
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if user is None:
+            return await handler(event, data)
+
+        cost = update_cost(event, data.get("raw_state"))
+        # уже в лимите для такой стоимости — не ходим в Redis и не пишем в чат
+        # повторно; колбэк всё равно закрываем, иначе кнопка «крутится»
+        if self.limiter.blocked_locally(user.id, cost):
+            THROTTLED_UPDATES_TOTAL.labels(self.event_type, "local").inc()
+            if isinstance(event, CallbackQuery):
+                try:
+                    await event.answer("Слишком много запросов. Попробуйте через минуту.")
+                except (TelegramForbiddenError, TelegramBadRequest):
+                    pass
+            return
+
+        allowed, _ = await self.limiter.hit(user.id, cost)
+        if not allowed:
+            THROTTLED_UPDATES_TOTAL.labels(self.event_type, "redis").inc()
             try:
                 await event.answer("Слишком много запросов. Попробуйте через минуту.")
             except (TelegramForbiddenError, TelegramBadRequest):
                 pass
             return
-        return await handler(event, data)
\ No newline at end of file
+        return await handler(event, data)
+
+
+class FSMBufferMiddleware(BaseMiddleware):
+    """
+    Буфер FSM на апдейт (core.fsm_storage.HashStorage.buffered): данные
+    читаются один раз, все изменения пишутся одним запросом в конце.
+    Вешается на dp.update (outer) перед FSMContextMiddleware, чтобы накрыть
+    и её get_state, и все хендлеры и фильтры.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        buffered = getattr(self.storage, "buffered", None)
+        if buffered is None:
+            return await handler(event, data)
+        async with buffered():
+            return await handler(event, data)
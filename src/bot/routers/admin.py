@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+from aiogram import Router
+from aiogram.filters import Command
+from aiogram.types import Message
+
+from core.config import settings
+from core.redis import get_redis
+from services.tracing import stage_percentiles
+from services.workers import workers_overview
+
+router = Router()
+
+
+def _fmt_ms(ms: float) -> str:
+    return f"{ms / 1000:.1f}s" if ms >= 1000 else f"{ms:.0f}ms"
+
+
+@router.message(Command("trace_stats"))
+async def cmd_trace_stats(msg: Message):
+    """
+    Перцентили этапов генерации:
+    /trace_stats — за последний час
+    /trace_stats 30 — за последние 30 минут
+    """
+    if not settings.is_admin(msg.from_user.id):
+        return
+
+    parts = (msg.text or "").split(maxsplit=1)
+    minutes = 60
+    if len(parts) > 1 and parts[1].strip().isdigit():
+        minutes = max(1, int(parts[1].strip()))
+
+    try:
+        stats = await stage_percentiles(minutes * 60)
+    except Exception as e:
+        await msg.answer(f"❌ Ошибка: {e}")
+        return
+
+    lines = [f"{'этап':<15}{'n':>5}{'p50':>8}{'p90':>8}{'p99':>8}"]
+    for name, st in stats.items():
+        lines.append(
+            f"{name:<15}{st['count']:>5}"
+            f"{_fmt_ms(st['p50']):>8}{_fmt_ms(st['p90']):>8}{_fmt_ms(st['p99']):>8}"
+        )
+
+    await msg.answer(
+        f"⏱ Этапы генерации за <b>{minutes} мин</b>\n\n<pre>" + "\n".join(lines) + "</pre>",
+        parse_mode="HTML",
+    )
+
+
+def _fmt_s(sec: float) -> str:
+    sec = int(sec)
+    if sec >= 3600:
+        return f"{sec // 3600}ч{sec % 3600 // 60:02d}м"
+    if sec >= 60:
+        return f"{sec // 60}м{sec % 60:02d}с"
+    return f"{sec}с"
+
+
+@router.message(Command("workers"))
+async def cmd_workers(msg: Message):
+    """Живые ARQ-воркеры: загрузка слотов max_jobs и задачи в работе"""
+    if not settings.is_admin(msg.from_user.id):
+        return
+
+    try:
+        workers = await workers_overview(get_redis(settings.REDIS_DB_CACHE))
+    except Exception as e:
+        await msg.answer(f"❌ Ошибка: {e}")
+        return
+
+    if not workers:
+        await msg.answer("⚠️ Нет живых воркеров (heartbeat не найден)")
+        return
+
+    blocks = []
+    for w in workers:
+        lines = [
+            f"🛠 <code>{w['worker_id']}</code> ({w['queue']})",
+            f"Слоты: <b>{w['running']}/{w['max_jobs']}</b> · "
+            f"загрузка с запуска {w['utilization'] * 100:.0f}% · uptime {_fmt_s(w['uptime_s'])}",
+            f"Выполнено: {w['done']} · превысили бюджет: {w['flagged']} · отменено: {w['aborted']}",
+        ]
+        for j in w["jobs"][:15]:
+            mark = "⚠️" if j["elapsed_s"] > j["budget"] else "▫️"
+            lines.append(
+                f"{mark} {j['function']} <code>{j['job_id'][:12]}</code> "
+                f"{_fmt_s(j['elapsed_s'])} / {_fmt_s(j['budget'])}"
+            )
+        if len(w["jobs"]) > 15:
+            lines.append(f"… ещё {len(w['jobs']) - 15}")
+        blocks.append("\n".join(lines))
+
+    await msg.answer("\n\n".join(blocks), parse_mode="HTML")
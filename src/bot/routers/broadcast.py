@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+import html
 import os
+import re
+import time
 import uuid
 from pathlib import Path
 
@@ -9,13 +12,15 @@ from aiogram.filters import Command
 from aiogram.types import Message
 from sqlalchemy import select, update
 
-from arq import create_pool
-from arq.connections import RedisSettings
 import tempfile  
 
 from core.config import settings
 from db.engine import SessionLocal
-from db.models import BroadcastJob, User
+from db.models import BroadcastJob
+from services import broadcast_progress, segments
+from services.broadcast_log import count_retryable, summary
+from services.audience import DEFAULT_SEGMENT, SEGMENTS, count_audience
+from services.queue import QUEUE_BROADCAST, QUEUE_MAINTENANCE, get_arq_pool
 
 router = Router()
 
@@ -24,9 +29,41 @@ MEDIA_DIR = Path(tempfile.gettempdir()) / "broadcast_media"
 MEDIA_DIR.mkdir(exist_ok=True)
 
 
-def _is_admin(uid: int) -> bool:
-    """Проверка, является ли пользователь админом"""
-    return settings.ADMIN_ID and int(settings.ADMIN_ID) == int(uid)
+# снимок старше этого — воркер, вероятно, упал; показываем данные из MySQL
+_PROGRESS_STALE_S = 300
+_SEG_RE = re.compile(r"^seg=([\w&]+)\s*")
+_SEG_HELP = f"{', '.join(SEGMENTS)}; из Redis: paid30, gen7, zero и пересечения через &"
+
+
+def _valid_segment(segment: str) -> bool:
+    return segment in SEGMENTS or segments.parse_spec(segment) is not None
+
+
+_NOT_READY = (
+    "❌ Сегменты в Redis не собраны (рестарт/очистка Redis): {missing}.\n"
+    "Пересборка запущена — повторите через несколько минут."
+)
+
+
+async def _rebuild_segments_soon() -> None:
+    pool = await get_arq_pool()
+    # один job_id — повторные команды не ставят вторую пересборку
+    await pool.enqueue_job("rebuild_segments", _job_id="segments:rebuild", _queue_name=QUEUE_MAINTENANCE)
+
+
+async def _audience_size(session, segment: str, dest: str, ttl: int) -> int:
+    """
+    Материализованный сегмент — снимок в dest и ZCARD; иначе SQL COUNT(*).
+    SegmentsNotReady — наборы потеряны, пересборка поставлена в очередь.
+    """
+    try:
+        materialized = await segments.use_materialized(segment)
+    except segments.SegmentsNotReady:
+        await _rebuild_segments_soon()
+        raise
+    if materialized:
+        return await segments.materialize(segment, dest, ttl)
+    return await count_audience(session, segment)
 
 
 @router.message(Command("broadcast"))
@@ -36,8 +73,9 @@ async def cmd_broadcast(msg: Message):
     1. /broadcast Текст — текстовая
     2. Фото + /broadcast Текст — с фото
     3. Видео + /broadcast Текст — с видео
+    4. /broadcast seg=paid Текст — только сегмент (services.audience)
     """
-    if not _is_admin(msg.from_user.id):
+    if not settings.is_admin(msg.from_user.id):
         return
     
     raw_text = (msg.caption or msg.text or "").strip()
@@ -50,12 +88,26 @@ async def cmd_broadcast(msg: Message):
             "📣 <b>Использование:</b>\n\n"
             "1️⃣ Текст: <code>/broadcast Ваш текст</code>\n"
             "2️⃣ Фото: прикрепите фото + <code>/broadcast Текст</code>\n"
-            "3️⃣ Видео: прикрепите видео + <code>/broadcast Текст</code>",
+            "3️⃣ Видео: прикрепите видео + <code>/broadcast Текст</code>\n"
+            f"🎯 Сегмент: <code>/broadcast seg=paid30&amp;zero Текст</code> ({_SEG_HELP})",
             parse_mode="HTML"
         )
         return
     
     payload = parts[1].strip()
+
+    # необязательный сегмент первым словом: /broadcast seg=paid Текст
+    segment = DEFAULT_SEGMENT
+    m_seg = _SEG_RE.match(payload)
+    if m_seg:
+        segment = m_seg.group(1)
+        payload = payload[m_seg.end():].strip()
+        if not _valid_segment(segment):
+            await msg.answer(f"❌ Неизвестный сегмент. Доступны: {_SEG_HELP}")
+            return
+        if not payload:
+            await msg.answer("❌ Пустой текст рассылки")
+            return
     
     media_type = None
     media_file_id = None
@@ -73,7 +125,13 @@ async def cmd_broadcast(msg: Message):
     # Создать Job
     job_id = str(uuid.uuid4())
     async with SessionLocal() as session:
-        total_users = (await session.execute(select(User.chat_id))).scalars().unique().all()
+        try:
+            total = await _audience_size(
+                session, segment, segments.job_key(job_id), settings.BROADCAST_JOB_TIMEOUT_S
+            )
+        except segments.SegmentsNotReady as e:
+            await msg.answer(_NOT_READY.format(missing=", ".join(e.missing)))
+            return
         
         bj = BroadcastJob(
             id=job_id,
@@ -83,20 +141,15 @@ async def cmd_broadcast(msg: Message):
             media_file_id=media_file_id,
             media_file_path=None,  # ✅ Всегда None
             status="queued",
-            total=len(total_users)
+            total=total,
+            segment=segment,
         )
         session.add(bj)
         await session.commit()
 
     # Запустить в ARQ
-    redis_pool = await create_pool(
-        RedisSettings(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            database=settings.REDIS_DB_CACHE,  # ✅ CACHE
-        )
-    )
-    await redis_pool.enqueue_job("broadcast_send", job_id)
+    redis_pool = await get_arq_pool()
+    await redis_pool.enqueue_job("broadcast_send", job_id, _queue_name=QUEUE_BROADCAST)
     
     media_info = ""
     if media_type == "photo":
@@ -106,15 +159,41 @@ async def cmd_broadcast(msg: Message):
     
     await msg.answer(
         f"🚀 Запустил рассылку <code>#{job_id}</code>{media_info}\n"
+        f"Сегмент: <b>{html.escape(segment)}</b>\n"
         f"Всего: <b>{bj.total}</b>\n\n"
         f"Отмена: <code>/broadcast_cancel {job_id}</code>\n"
-        f"Статус: <code>/broadcast_status {job_id}</code>",
+        f"Статус: <code>/broadcast_status {job_id}</code>\n"
+        f"Живой статус: <code>/broadcast_watch {job_id}</code>",
         parse_mode="HTML"
     )
 
+@router.message(Command("broadcast_count"))
+async def cmd_broadcast_count(msg: Message):
+    """Размер аудитории по сегментам (COUNT(*), без выгрузки пользователей)"""
+    if not settings.is_admin(msg.from_user.id):
+        return
+
+    parts = (msg.text or "").split()
+    names = parts[1:] or list(SEGMENTS)
+    if not all(_valid_segment(seg) for seg in names):
+        await msg.answer(f"❌ Неизвестный сегмент. Доступны: {_SEG_HELP}")
+        return
+
+    async with SessionLocal() as session:
+        lines = []
+        for seg in names:
+            try:
+                size = await _audience_size(session, seg, f"seg:count:{uuid.uuid4().hex}", 60)
+            except segments.SegmentsNotReady:
+                lines.append(f"{html.escape(seg)}: ⚠️ сегменты не собраны, пересборка запущена")
+                continue
+            lines.append(f"{html.escape(seg)}: <b>{size}</b>")
+    await msg.answer("👥 Аудитория\n" + "\n".join(lines), parse_mode="HTML")
+
+
 @router.message(Command("broadcast_cancel"))
 async def cmd_broadcast_cancel(msg: Message):
-    if not _is_admin(msg.from_user.id):
+    if not settings.is_admin(msg.from_user.id):
         return
     
     parts = (msg.text or "").split(" ", 1)
@@ -136,7 +215,7 @@ async def cmd_broadcast_cancel(msg: Message):
 
 @router.message(Command("broadcast_status"))
 async def cmd_broadcast_status(msg: Message):
-    if not _is_admin(msg.from_user.id):
+    if not settings.is_admin(msg.from_user.id):
         return
     
     parts = (msg.text or "").split(" ", 1)
@@ -145,9 +224,26 @@ async def cmd_broadcast_status(msg: Message):
         return
     
     job_id = parts[1].strip()
+
+    # идущая рассылка — живой снимок из Redis, без запросов в MySQL
+    try:
+        progress = await broadcast_progress.read(job_id)
+    except Exception:
+        progress = {}
+    fresh = time.time() - int(progress.get("updated_at") or 0) < _PROGRESS_STALE_S
+    if progress.get("status") == "running" and fresh:
+        await msg.answer(
+            broadcast_progress.render(job_id, progress)
+            + f"\n\nЖивой статус: <code>/broadcast_watch {job_id}</code>",
+            parse_mode="HTML",
+        )
+        return
+
     async with SessionLocal() as session:
         row = await session.execute(select(BroadcastJob).where(BroadcastJob.id == job_id))
         bj = row.scalars().first()
+        if bj:
+            outcomes = await summary(session, job_id)
     
     if not bj:
         await msg.answer("❌ Не найдено")
@@ -158,6 +254,18 @@ async def cmd_broadcast_status(msg: Message):
         media_info = "\n📸 Тип: фото"
     elif bj.media_type == "video":
         media_info = "\n🎬 Тип: видео"
+    if bj.parent_id:
+        media_info += f"\n🔁 Повтор <code>#{bj.parent_id}</code>"
+
+    # разбивка по журналу доставки (services.broadcast_log)
+    breakdown = ""
+    if outcomes:
+        breakdown = "\n".join(
+            f"• {st}{('/' + err) if err else ''}: <b>{n}</b>, ~{avg_ms} мс"
+            for st, err, n, avg_ms in outcomes
+        ) + "\n"
+        if any(st == "failed" for st, *_ in outcomes):
+            breakdown += f"Повторить неудачные: <code>/broadcast_retry {bj.id}</code>\n"
     
     await msg.answer(
         f"📊 Рассылка <code>#{bj.id}</code>\n"
@@ -165,7 +273,91 @@ async def cmd_broadcast_status(msg: Message):
         f"Всего: <b>{bj.total}</b>\n"
         f"Отправлено: <b>{bj.sent}</b>\n"
         f"Ошибок: <b>{bj.failed}</b>\n"
-        f"{('💬 ' + bj.note) if bj.note else ''}",
+        f"{breakdown}"
+        f"{('💬 ' + html.escape(bj.note)) if bj.note else ''}",
+        parse_mode="HTML"
+    )
+
+
+@router.message(Command("broadcast_watch"))
+async def cmd_broadcast_watch(msg: Message):
+    """Одно сообщение со статусом, которое воркер рассылки правит по ходу отправки"""
+    if not settings.is_admin(msg.from_user.id):
+        return
+
+    parts = (msg.text or "").split(" ", 1)
+    if len(parts) < 2:
+        await msg.answer("Использование: <code>/broadcast_watch JOB_ID</code>", parse_mode="HTML")
+        return
+
+    job_id = parts[1].strip()
+    try:
+        progress = await broadcast_progress.read(job_id)
+    except Exception:
+        # Redis недоступен — живого статуса не будет, показываем статус из БД
+        await msg.answer("⚠️ Живой статус сейчас недоступен, показываю последний сохранённый.")
+        await cmd_broadcast_status(msg)
+        return
+    if progress and progress.get("status") != "running":
+        await msg.answer(broadcast_progress.render(job_id, progress), parse_mode="HTML")
+        return
+
+    sent = await msg.answer(broadcast_progress.render(job_id, progress), parse_mode="HTML")
+    try:
+        await broadcast_progress.watch(job_id, sent.chat.id, sent.message_id)
+    except Exception:
+        await msg.answer("⚠️ Не удалось подписать сообщение на обновления — смотрите /broadcast_status.")
+
+
+@router.message(Command("broadcast_retry"))
+async def cmd_broadcast_retry(msg: Message):
+    """Повтор рассылки только для неудачных получателей (кроме заблокировавших бота)"""
+    if not settings.is_admin(msg.from_user.id):
+        return
+
+    parts = (msg.text or "").split(" ", 1)
+    if len(parts) < 2:
+        await msg.answer("Использование: <code>/broadcast_retry JOB_ID</code>", parse_mode="HTML")
+        return
+
+    parent_id = parts[1].strip()
+    async with SessionLocal() as session:
+        row = await session.execute(select(BroadcastJob).where(BroadcastJob.id == parent_id))
+        parent = row.scalars().first()
+        if not parent:
+            await msg.answer("❌ Не найдено")
+            return
+        if parent.status in ("queued", "running"):
+            await msg.answer("⏳ Рассылка ещё идёт — повтор после завершения")
+            return
+
+        total = await count_retryable(session, parent_id)
+        if not total:
+            await msg.answer("✅ Неудачных получателей для повтора нет")
+            return
+
+        job_id = str(uuid.uuid4())
+        session.add(BroadcastJob(
+            id=job_id,
+            created_by=msg.from_user.id,
+            text=parent.text,
+            media_type=parent.media_type,
+            media_file_id=parent.media_file_id,
+            media_file_path=None,
+            status="queued",
+            total=total,
+            segment=parent.segment,
+            parent_id=parent_id,
+        ))
+        await session.commit()
+
+    redis_pool = await get_arq_pool()
+    await redis_pool.enqueue_job("broadcast_send", job_id, _queue_name=QUEUE_BROADCAST)
+
+    await msg.answer(
+        f"🔁 Повтор рассылки <code>#{parent_id}</code>: <code>#{job_id}</code>\n"
+        f"Получателей: <b>{total}</b>\n\n"
+        f"Статус: <code>/broadcast_status {job_id}</code>",
         parse_mode="HTML"
     )
 
@@ -173,7 +365,7 @@ async def cmd_broadcast_status(msg: Message):
 @router.message(Command("broadcast_test"))
 async def cmd_broadcast_test(msg: Message):
     """Тестовая рассылка только админу"""
-    if not _is_admin(msg.from_user.id):
+    if not settings.is_admin(msg.from_user.id):
         return
     
     raw_text = (msg.caption or msg.text or "").strip()
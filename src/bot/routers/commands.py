@@ -450,7 +450,7 @@ from services.telegram_safe import safe_answer, safe_send_text, safe_edit_text
 from core.config import settings
 from db.engine import SessionLocal
 from db.models import User
-from services.queue import enqueue_generation
+from services.queue import enqueue_generation, undo_duplicate_start
 
 router = Router()
 
@@ -691,15 +691,18 @@ async def create_got_prompt(m: Message, state: FSMContext) -> None:
     image_resolution = data.get("image_resolution", "4K")
     max_images = data.get("max_images", 1)
 
+    prev_state = await state.get_state()
     await state.set_state(CreateStates.generating)
     wait_msg = await safe_send_text(m.bot, m.chat.id, f"Генерирую...")
-    await state.update_data(
+    wait_msg_id = getattr(wait_msg, "message_id", None)
+    started = dict(
         mode="create", 
         prompt=prompt,
-        wait_msg_id=getattr(wait_msg, "message_id", None),
+        wait_msg_id=wait_msg_id,
     )
+    await state.update_data(**started)
     
-    await enqueue_generation(
+    if not await enqueue_generation(
         m.from_user.id, 
         prompt, 
         [], 
@@ -707,7 +710,11 @@ async def create_got_prompt(m: Message, state: FSMContext) -> None:
         image_resolution=image_resolution,
         max_images=max_images,
         seed=None
-    )
+    ):
+        await undo_duplicate_start(
+            m.bot, m.chat.id, wait_msg_id, state, prev_state, data,
+            started_state=CreateStates.generating.state, started=started,
+        )
 
 # ======================= CREATE FINAL MENU =======================
 
@@ -738,8 +745,8 @@ async def create_regenerate(c: CallbackQuery, state: FSMContext):
         max_images = user.max_images
     
     try:
-        await safe_send_text(c.bot, c.message.chat.id, "Генерирую…")
-        await enqueue_generation(
+        wait_msg = await safe_send_text(c.bot, c.message.chat.id, "Генерирую…")
+        if not await enqueue_generation(
             c.from_user.id, 
             prompt, 
             [],
@@ -747,7 +754,8 @@ async def create_regenerate(c: CallbackQuery, state: FSMContext):
             image_resolution=image_resolution,
             max_images=max_images,
             seed=seed
-        )
+        ):
+            await undo_duplicate_start(c.bot, c.message.chat.id, getattr(wait_msg, "message_id", None))
     except Exception:
         await safe_send_text(c.bot, c.message.chat.id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
 
@@ -786,22 +794,29 @@ async def create_final_menu_new_prompt(m: Message, state: FSMContext):
         image_resolution = user.image_resolution
         max_images = user.max_images
     
+    prev_state = await state.get_state()
     await state.set_state(CreateStates.generating)
     wait_msg = await safe_send_text(m.bot, m.chat.id, "Генерирую…")
-    await state.update_data(
+    wait_msg_id = getattr(wait_msg, "message_id", None)
+    started = dict(
         mode="create",
         prompt=prompt,
-        wait_msg_id=getattr(wait_msg, "message_id", None),
+        wait_msg_id=wait_msg_id,
         image_resolution=image_resolution,
         max_images=max_images,
         aspect_ratio=aspect_ratio,
     )
+    await state.update_data(**started)
     
-    await enqueue_generation(
+    if not await enqueue_generation(
         m.from_user.id, 
         prompt, 
         [],
         aspect_ratio=aspect_ratio,
         image_resolution=image_resolution,
         max_images=max_images
-    )
\ No newline at end of file
+    ):
+        await undo_duplicate_start(
+            m.bot, m.chat.id, wait_msg_id, state, prev_state, data,
+            started_state=CreateStates.generating.state, started=started,
+        )
\ No newline at end of file
@@ -6,7 +6,7 @@ import asyncio
 import logging
 from typing import List, Dict, Optional
 
-from aiogram import Router, F, Bot
+from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import (
     Message, CallbackQuery, FSInputFile,
@@ -20,8 +20,9 @@ from db.engine import SessionLocal
 from db.models import User
 from services.pricing import CREDITS_PER_GENERATION
 from bot.states import GenStates
-from bot.keyboards import kb_gen_step_back, kb_final_result, kb_edit_orientation_selector
-from services.queue import enqueue_generation
+from bot.keyboards import kb_gen_step_back, kb_edit_orientation_selector
+from services.blobstore import task_blobs
+from services.queue import enqueue_generation, undo_duplicate_start
 from services.telegram_safe import (
     safe_answer,
     safe_send_text,
@@ -30,7 +31,6 @@ from services.telegram_safe import (
     safe_edit_text,
     safe_delete_message,
 )
-from core.config import settings
 
 log = logging.getLogger("generation")
 router = Router()
@@ -46,11 +46,6 @@ def resource_path(relative_path: str) -> str:
 
 PLACEHOLDER_PATH = resource_path(os.path.join('..', '..', 'assets', 'placeholder_light_gray_block.png'))
 
-def _j(event: str, **fields) -> str:
-    """JSON логирование"""
-    import json
-    return json.dumps({"event": event, **fields}, ensure_ascii=False)
-
 # 🆕 НОВАЯ ФУНКЦИЯ: Проверка на HEIC
 def _is_heic_format(message: Message) -> bool:
     """Проверка, является ли файл HEIC форматом (iPhone)"""
@@ -101,7 +96,12 @@ async def auto_start_on_photo(m: Message, state: FSMContext):
     """✅ Автоматический старт /edit при получении фото с проверкой HEIC"""
     # 🆕 ЛОГИРОВАНИЕ
     cur = await state.get_state()
-    log.info(_j("auto_start.triggered", chat_id=m.from_user.id, state=cur, has_photo=bool(m.photo), has_doc=bool(m.document)))
+    log.info("auto_start.triggered", extra={
+        "chat_id": m.from_user.id,
+        "state": cur,
+        "has_photo": bool(m.photo),
+        "has_doc": bool(m.document),
+    })
     
     caption = (m.caption or "").strip().lower()
     if caption.startswith("/broadcast"):
@@ -194,27 +194,34 @@ async def _kick_generation_now(m: Message, state: FSMContext, prompt: str) -> No
     aspect_ratio = "9:16"
     
     file_ids = [p["file_id"] for p in photos]
+    prev_state = await state.get_state()
     await state.set_state(GenStates.generating)
     wait_msg = await safe_send_text(m.bot, m.chat.id, f"Генерирую...")
-    await state.update_data(
+    wait_msg_id = getattr(wait_msg, "message_id", None)
+    started = dict(
         prompt=prompt,
         base_prompt=prompt,
         edits=[],
         mode="edit",
-        wait_msg_id=getattr(wait_msg, "message_id", None),
+        wait_msg_id=wait_msg_id,
         image_resolution=image_resolution,
         max_images=max_images,
         aspect_ratio=aspect_ratio,
     )
+    await state.update_data(**started)
 
-    await enqueue_generation(
+    if not await enqueue_generation(
         m.from_user.id, 
         prompt, 
         file_ids,
         aspect_ratio=aspect_ratio,
         image_resolution=image_resolution,
         max_images=max_images
-    )
+    ):
+        await undo_duplicate_start(
+            m.bot, m.chat.id, wait_msg_id, state, prev_state, data,
+            started_state=GenStates.generating.state, started=started,
+        )
 
 @router.message(Command("edit"))
 @router.message(Command("gen"))
@@ -456,7 +463,7 @@ async def handle_text_instead_of_orientation(m: Message, state: FSMContext):
     # 🆕 Устанавливаем дефолтную ориентацию 9:16
     await state.update_data(aspect_ratio="9:16")
     
-    log.info(_j("edit.skip_orientation", chat_id=m.from_user.id, prompt_len=len(prompt)))
+    log.info("edit.skip_orientation", extra={"chat_id": m.from_user.id, "prompt_len": len(prompt)})
     
     # Переходим к состоянию ожидания промта и сразу обрабатываем
     await state.set_state(GenStates.waiting_prompt)
@@ -488,28 +495,35 @@ async def got_user_prompt(m: Message, state: FSMContext) -> None:
         image_resolution = user.image_resolution
         max_images = user.max_images
 
+    prev_state = await state.get_state()
     await state.set_state(GenStates.generating)
     try:
         wait_msg = await safe_send_text(m.bot, m.chat.id, f"Генерирую...")
-        await state.update_data(
+        wait_msg_id = getattr(wait_msg, "message_id", None)
+        started = dict(
             prompt=prompt,
             base_prompt=prompt,
             edits=[],
             mode="edit",
-            wait_msg_id=getattr(wait_msg, "message_id", None),
+            wait_msg_id=wait_msg_id,
             image_resolution=image_resolution,
             max_images=max_images,
             aspect_ratio=aspect_ratio,
         )
+        await state.update_data(**started)
 
-        await enqueue_generation(
+        if not await enqueue_generation(
             m.from_user.id, 
             prompt, 
             file_ids,
             aspect_ratio=aspect_ratio,
             image_resolution=image_resolution,
             max_images=max_images
-        )
+        ):
+            await undo_duplicate_start(
+                m.bot, m.chat.id, wait_msg_id, state, prev_state, data,
+                started_state=GenStates.generating.state, started=started,
+            )
     except Exception:
         await safe_send_text(m.bot, m.chat.id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
 
@@ -548,20 +562,23 @@ async def handle_final_menu_message(m: Message, state: FSMContext) -> None:
     seed = data.get("last_seed")
     aspect_ratio = data.get("aspect_ratio", "9:16")
 
+    prev_state = await state.get_state()
     await state.set_state(GenStates.generating)
     try:
         wait_msg = await safe_send_text(m.bot, m.chat.id, f"Генерирую...")
-        await state.update_data(
+        wait_msg_id = getattr(wait_msg, "message_id", None)
+        started = dict(
             prompt=cumulative_prompt,
             edits=edits,
             mode="edit",
-            wait_msg_id=getattr(wait_msg, "message_id", None),
+            wait_msg_id=wait_msg_id,
             image_resolution=image_resolution,
             max_images=max_images,
         )
+        await state.update_data(**started)
         
         file_ids = [p["file_id"] for p in photos]
-        await enqueue_generation(
+        if not await enqueue_generation(
             m.from_user.id, 
             cumulative_prompt, 
             file_ids,
@@ -569,7 +586,11 @@ async def handle_final_menu_message(m: Message, state: FSMContext) -> None:
             image_resolution=image_resolution,
             max_images=max_images,
             seed=seed
-        )
+        ):
+            await undo_duplicate_start(
+                m.bot, m.chat.id, wait_msg_id, state, prev_state, data,
+                started_state=GenStates.generating.state, started=started,
+            )
     except Exception:
         await safe_send_text(m.bot, m.chat.id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
 
@@ -603,9 +624,9 @@ async def regenerate(c: CallbackQuery, state: FSMContext) -> None:
         max_images = user.max_images
     
     try:
-        await safe_send_text(c.bot, c.message.chat.id, f"Генерирую...")
+        wait_msg = await safe_send_text(c.bot, c.message.chat.id, f"Генерирую...")
         file_ids = [p["file_id"] for p in photos]
-        await enqueue_generation(
+        if not await enqueue_generation(
             c.from_user.id, 
             prompt, 
             file_ids,
@@ -613,7 +634,8 @@ async def regenerate(c: CallbackQuery, state: FSMContext) -> None:
             image_resolution=image_resolution,
             max_images=max_images,
             seed=seed
-        )
+        ):
+            await undo_duplicate_start(c.bot, c.message.chat.id, getattr(wait_msg, "message_id", None))
     except Exception:
         await safe_send_text(c.bot, c.message.chat.id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
 
@@ -622,11 +644,10 @@ async def regenerate(c: CallbackQuery, state: FSMContext) -> None:
 async def send_file_cb(c: CallbackQuery, state: FSMContext) -> None:
     await safe_answer(c)
     data = await state.get_data()
-    file_paths = data.get("file_paths", [])
+    file_paths = await task_blobs(data.get("last_task_uuid"))
     if file_paths:
         for fp in file_paths:
-            if os.path.exists(fp):
-                await safe_send_document(c.bot, c.message.chat.id, fp, caption="Файл в максимальном качестве")
+            await safe_send_document(c.bot, c.message.chat.id, fp, caption="Файл в максимальном качестве")
     else:
         await safe_send_text(c.bot, c.message.chat.id, "Файлы недоступны. Попробуйте сгенерировать снова.")
 
@@ -640,91 +661,3 @@ async def cancel_session(c: CallbackQuery, state: FSMContext) -> None:
         await safe_delete_message(c.bot, c.message.chat.id, c.message.message_id)
     except Exception:
         pass
-
-async def send_generation_result(
-    chat_id: int,
-    task_uuid: str,
-    prompt: str,
-    image_urls: List[str],
-    file_paths: List[str],
-    seed: Optional[int],
-    bot: Bot,
-) -> None:
-    """Отправка результатов генерации + удаление временных файлов"""
-    from aiogram.fsm.context import FSMContext
-    from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
-    from aiogram.fsm.storage.base import StorageKey
-    import redis.asyncio as redis
-
-    redis_cli = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_FSM)
-    storage = RedisStorage(redis=redis_cli, key_builder=DefaultKeyBuilder(with_bot_id=True))
-    bot_info = await bot.get_me()
-    state = FSMContext(storage=storage, key=StorageKey(bot_info.id, chat_id, chat_id))
-
-    data = await state.get_data()
-    wait_msg_id = data.get("wait_msg_id")
-    if wait_msg_id:
-        try:
-            await bot.delete_message(chat_id, wait_msg_id)
-        except Exception:
-            pass
-        await state.update_data(wait_msg_id=None)
-
-    mode = (data.get("mode") or "edit").lower().strip()
-
-    # Отправка изображений
-    for idx, (img_url, fp) in enumerate(zip(image_urls, file_paths)):
-        caption = None
-        reply_markup = None
-        
-        if idx == len(image_urls) - 1:
-            caption = "<b>Если хотите что-то изменить или добавить напишите в чат ⬇️</b>"
-            reply_markup = kb_final_result()
-        
-        await safe_send_photo(bot, chat_id, img_url, caption=caption, reply_markup=reply_markup)
-    
-    # Отправка файлов в максимальном качестве
-    for fp in file_paths:
-        if os.path.exists(fp):
-            await safe_send_document(bot, chat_id, fp, caption="Скачать в максимальном качестве")
-    
-    # 🆕 УДАЛЕНИЕ ВРЕМЕННЫХ ФАЙЛОВ после отправки
-    for fp in file_paths:
-        if os.path.exists(fp):
-            try:
-                os.remove(fp)
-                log.info(_j("temp_file_deleted", path=fp))
-            except Exception as e:
-                log.warning(_j("temp_file_delete_failed", path=fp, error=str(e)))
-    
-    if mode == "create_edit":
-        mode = "create"
-
-    if mode == "create":
-        await state.update_data(
-            mode="create",
-            prompt=prompt,
-            last_result_urls=image_urls,
-            file_paths=[],
-            wait_msg_id=None,
-            last_seed=seed,
-        )
-        await state.set_state(CreateStates.final_menu)
-        return
-
-    photos = data.get("photos", [])
-    base_prompt = data.get("base_prompt") or prompt
-    edits = data.get("edits") or []
-    aspect_ratio = data.get("aspect_ratio", "9:16")
-    
-    await state.update_data(
-        mode="edit",
-        prompt=prompt,
-        base_prompt=base_prompt,
-        edits=edits,
-        photos=photos,
-        file_paths=[],
-        last_seed=seed,
-        aspect_ratio=aspect_ratio,
-    )
-    await state.set_state(GenStates.final_menu)
@@ -8,6 +8,7 @@ from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from services.pricing import credits_for_rub
 from services.payments import create_topup_payment
 from services.users import ensure_user
+from services import segments
 from db.engine import SessionLocal
 from db.models import User
 from bot.states import TopupStates
@@ -278,6 +279,7 @@ async def stars_success(m: Message, state: FSMContext):
                 old_balance = u.balance_credits
                 u.balance_credits += cr
                 await s.commit()
+                await segments.mark_paid(u.chat_id)
                 
                 log.info(f"stars_balance_updated user={m.from_user.id} stars={stars} credits={cr} old={old_balance} new={u.balance_credits}")
                 
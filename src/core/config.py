@@ -28,10 +28,18 @@ class Settings(BaseSettings):
     # ✅ OpenAI Whisper API
     OPENAI_API_KEY: str
     WHISPER_MODEL: str = "whisper-1"  # whisper-1 - единственная доступная модель
+    VOICE_MAX_BYTES: int = 10 * 1024 ** 2  # больше не скачиваем (проверка по voice.file_size)
+    VOICE_JOB_TIMEOUT_S: int = 180  # задача transcribe_voice в очереди generation
     
     # YooKassa configuration
     YOOKASSA_SHOP_ID: str
     YOOKASSA_SECRET_KEY: str
+    YOOKASSA_API_BASE: str = "https://api.yookassa.ru/v3"  # для локальной заглушки: bench/yookassa_stub.py
+    YOOKASSA_TIMEOUT_S: float = 15.0
+    # Сверка pending-платежей с YooKassa (cron очереди maintenance)
+    PAYMENT_RECONCILE_AFTER_MIN: int = 10  # вебхук должен был прийти раньше
+    PAYMENT_RECONCILE_MAX_AGE_H: int = 48  # старше — YooKassa их уже отменила
+    PAYMENT_RECONCILE_BATCH: int = 200
     CURRENCY: str = "RUB"
     TOPUP_RETURN_URL: str
 
@@ -45,18 +53,69 @@ class Settings(BaseSettings):
     BROADCAST_RPS: int = 10
     BROADCAST_CONCURRENCY: int = 5
     BROADCAST_BATCH: int = 100
+    BROADCAST_LOG_FLUSH_EVERY: int = 500  # исходы отправки пишутся в broadcast_deliveries пачками
+    BROADCAST_LOG_RETENTION_DAYS: int = 30
+    BROADCAST_PROGRESS_EVERY_S: float = 2.0  # снимок прогресса в Redis (services.broadcast_progress)
+    BROADCAST_STATUS_EDIT_S: float = 10.0  # правка сообщения /broadcast_watch, за токен лимита рассылки
+    AUDIENCE_ACTIVE_DAYS: int = 7  # сегмент рассылки active: генерации за последние N дней
+    SEGMENT_MAX_WINDOW_DAYS: int = 90  # самое длинное окно paidN/genN (services.segments)
 
     # Redis configuration
     REDIS_HOST: str = "redis"
     REDIS_PORT: int = 6379
     REDIS_DB_FSM: int = 1
     REDIS_DB_CACHE: int = 2
-    RATE_LIMIT_PER_MIN: int = 30
+    RATE_LIMIT_PER_MIN: int = 30  # единиц в минуту на пользователя (GCRA, services.ratelimit)
+    RATE_COST_GENERATION: int = 5  # столько единиц стоит апдейт, запускающий генерацию или голос
     REDIS_PASSWORD: str | None = None
     REDIS_DB_BROADCAST: int = 3 
+    # TTL ключей FSM, ставится при каждой записи (core.fsm)
+    FSM_TTL_S: int = 86400
+    # Переносить старые ключи RedisStorage (…:state / …:data) в hash при первом чтении;
+    # можно выключить, когда прошло FSM_TTL_S после перехода на core.fsm_storage
+    FSM_LEGACY_FALLBACK: bool = True
+    # Инкрементальный обход Redis в cron-очистке (services.maintenance)
+    SWEEP_MAX_KEYS_PER_RUN: int = 20000  # ключей за один запуск, дальше — со следующего курсора
+    SWEEP_SCAN_COUNT: int = 500
+    SWEEP_KEYS_PER_S: int = 5000  # ограничение скорости обхода
     
     # ARQ job timeout (большой для 4K)
     ARQ_JOB_TIMEOUT_S: int = 900  # 15 минут
+    BROADCAST_JOB_TIMEOUT_S: int = 43200  # рассылка по всей базе идёт часами
+
+    # Дедупликация генераций: окно для job_id и TTL in-flight маркера (если доставка не сняла)
+    GEN_DEDUP_WINDOW_S: int = 30
+    GEN_DEDUP_INFLIGHT_TTL_S: int = 600
+
+    # Сколько getFile к Telegram параллельно при подготовке входных фото
+    TG_GETFILE_CONCURRENCY: int = 4
+
+    # Входные фото для KIE: локальный кэш + подписанные ссылки /media/... (services.media)
+    TELEGRAM_FILE_BASE: str = "https://api.telegram.org/file"  # можно указать локальную заглушку
+    MEDIA_DIR: str = "/data/media"
+    MEDIA_URL_TTL_S: int = 3600
+    MEDIA_SIGNING_KEY: str | None = None  # по умолчанию WEBHOOK_SECRET_TOKEN
+    BLOB_STORE_MAX_BYTES: int = 2 * 1024 ** 3  # LRU-вытеснение сверх этого объёма
+    BLOB_TASK_INDEX_TTL_S: int = 7 * 86400  # сколько помним файлы генерации для «Отправить файл»
+
+    # ARQ-воркер: параллельность, heartbeat и watchdog (см. services.workers)
+    WORKER_MAX_JOBS_GENERATION: int = 10
+    WORKER_MAX_JOBS_DELIVERY: int = 10
+    WORKER_MAX_JOBS_BROADCAST: int = 1
+    WORKER_MAX_JOBS_MAINTENANCE: int = 2
+    WORKER_HEARTBEAT_S: int = 10
+    WORKER_WATCHDOG_ABORT: bool = True
+    WORKER_WATCHDOG_GRACE_S: int = 60
+
+    # Логирование: доля INFO-записей для высокочастотных событий (webhook_hit и т.п.)
+    LOG_SAMPLE_RATE: float = 0.05
+
+    # Prometheus-экспортер ARQ-воркера (веб отдаёт метрики на /metrics)
+    WORKER_METRICS_PORT: int = 9100
+
+    def is_admin(self, uid: int) -> bool:
+        """Проверка, является ли пользователь админом (ADMIN_ID)"""
+        return bool(self.ADMIN_ID) and int(self.ADMIN_ID) == int(uid)
 
     @computed_field
     @property
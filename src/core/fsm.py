@@ -0,0 +1,33 @@
+"""FSM-хранилище бота: одно место, где собирается storage (вебхук, воркеры, вебхук KIE)."""
+from __future__ import annotations
+
+from typing import Optional
+
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from core.config import settings
+from core.fsm_storage import HashStorage
+from core.redis import get_redis
+
+_storage: Optional[BaseStorage] = None
+
+
+def create_fsm_storage() -> BaseStorage:
+    """
+    Один hash на чат (core.fsm_storage). TTL ставится при каждой записи,
+    поэтому ключи FSM не висят вечно и периодический обход fsm:* больше не нужен.
+    """
+    return HashStorage(
+        redis=get_redis(settings.REDIS_DB_FSM),
+        key_builder=DefaultKeyBuilder(with_bot_id=True),
+        ttl=settings.FSM_TTL_S,
+        legacy_fallback=settings.FSM_LEGACY_FALLBACK,
+    )
+
+
+def get_fsm_storage() -> BaseStorage:
+    """Общий на процесс экземпляр create_fsm_storage()."""
+    global _storage
+    if _storage is None:
+        _storage = create_fsm_storage()
+    return _storage
@@ -0,0 +1,391 @@
+"""
+FSM-хранилище «один hash на чат».
+
+Стандартный RedisStorage держит state и data в двух строковых ключах, а
+каждый update_data — это GET всего JSON + SET всего JSON (photos, edits,
+last_result_urls...). Здесь:
+
+- ключ ``fsm:{bot_id}:{chat_id}:{user_id}`` — hash, поле ``__state__`` —
+  состояние, остальные поля — ключи data, каждое значение в orjson;
+- update_data — один EVALSHA: HSET только изменённых полей + EXPIRE;
+- TTL обновляется при каждой записи;
+- маленькие hash'и Redis хранит в listpack — заметно компактнее двух JSON-строк.
+
+Старые ключи ``...:state`` / ``...:data`` переносятся при первом чтении
+или первой записи (``legacy_fallback``), лишних запросов это не добавляет:
+скрипты отдают их только когда hash'а ещё нет, а set_data удаляет их сам —
+иначе после clear() перенос вернул бы старые data.
+
+Внутри ``HashStorage.buffered()`` (middleware на апдейт, bot.middlewares)
+hash читается один раз, все get/update/set_state идут в памяти, а изменённые
+поля пишутся одним MULTI в конце апдейта (или раньше — ``flush_buffered()``).
+"""
+from __future__ import annotations
+
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import orjson
+import redis.asyncio as aioredis
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+STATE_FIELD = "__state__"
+
+# KEYS[1] — hash, KEYS[2..3] — старые ключи state/data (если перенос включён)
+# ARGV[1] — поле ('' — весь hash)
+_READ = """
+local v
+if ARGV[1] == '' then
+  v = redis.call('HGETALL', KEYS[1])
+else
+  v = redis.call('HGET', KEYS[1], ARGV[1])
+end
+if #KEYS == 1 or redis.call('EXISTS', KEYS[1]) == 1 then
+  return {v}
+end
+return {v, redis.call('GET', KEYS[2]), redis.call('GET', KEYS[3])}
+"""
+
+# Заменить data целиком, сохранив состояние. ARGV[1] — ttl, ARGV[2] — поле
+# состояния, дальше пары поле/значение. KEYS[2..3] — старые ключи: состояние
+# берётся оттуда, если hash'а ещё нет, и они удаляются, чтобы после clear()
+# перенос при чтении не вернул старые data.
+_SET_DATA = """
+local st = redis.call('HGET', KEYS[1], ARGV[2])
+if #KEYS == 3 then
+  if not st and redis.call('EXISTS', KEYS[1]) == 0 then
+    st = redis.call('GET', KEYS[2])
+  end
+  redis.call('DEL', KEYS[2], KEYS[3])
+end
+redis.call('DEL', KEYS[1])
+if st then
+  redis.call('HSET', KEYS[1], ARGV[2], st)
+end
+if #ARGV > 2 then
+  redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+# Сменить состояние. ARGV[1] — ttl, ARGV[2] — поле, ARGV[3] — значение
+# ('' — сбросить). Как и _UPDATE_DATA: если hash'а нет, а старые data есть —
+# ничего не пишет и отдаёт старые ключи для переноса.
+_SET_STATE = """
+if #KEYS == 3 and redis.call('EXISTS', KEYS[1]) == 0 then
+  local ld = redis.call('GET', KEYS[3])
+  if ld then
+    return {0, redis.call('GET', KEYS[2]), ld}
+  end
+  redis.call('DEL', KEYS[2])
+end
+if ARGV[3] == '' then
+  redis.call('HDEL', KEYS[1], ARGV[2])
+else
+  redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+  redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return {1}
+"""
+
+# Частичное обновление. ARGV[1] — ttl, дальше пары поле/значение.
+# Если hash'а нет, а старые ключи есть — ничего не пишет и отдаёт их
+# (перенос делает Python, чтобы не разбирать JSON в Lua).
+_UPDATE_DATA = """
+if #KEYS == 3 and redis.call('EXISTS', KEYS[1]) == 0 then
+  local ls, ld = redis.call('GET', KEYS[2]), redis.call('GET', KEYS[3])
+  if ls or ld then
+    return {0, ls, ld}
+  end
+end
+if #ARGV > 1 then
+  redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return {1, redis.call('HGETALL', KEYS[1])}
+"""
+
+# Сменить состояние, только если текущее равно ожидаемому. ARGV[1] — ttl,
+# ARGV[2] — поле состояния, ARGV[3] — ожидаемое ('' — нет состояния),
+# ARGV[4] — новое ('' — сбросить). 1 — заменено, 0 — состояние уже другое.
+_CAS_STATE = """
+local cur = redis.call('HGET', KEYS[1], ARGV[2]) or ''
+if cur ~= ARGV[3] then
+  return 0
+end
+if ARGV[4] == '' then
+  redis.call('HDEL', KEYS[1], ARGV[2])
+else
+  redis.call('HSET', KEYS[1], ARGV[2], ARGV[4])
+  redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+
+@dataclass
+class _Snapshot:
+    key: StorageKey
+    state: Optional[str]
+    data: Dict[str, Any]
+    dirty: Set[str] = field(default_factory=set)
+    state_dirty: bool = False
+    replaced: bool = False  # set_data: при записи hash пересобирается целиком
+
+
+@dataclass
+class _Buffer:
+    storage: "HashStorage"
+    entries: Dict[str, _Snapshot] = field(default_factory=dict)
+    closed: bool = False  # задачи, запущенные из хендлера, после flush пишут напрямую
+
+
+_buffer: ContextVar[Optional[_Buffer]] = ContextVar("fsm_buffer", default=None)
+
+
+def _pairs(data: Dict[str, Any]) -> List[Any]:
+    out: List[Any] = []
+    for k, v in data.items():
+        out.append(k)
+        out.append(orjson.dumps(v))
+    return out
+
+
+def _decode_hash(flat: List[bytes]) -> Tuple[Optional[str], Dict[str, Any]]:
+    state, data = None, {}
+    for i in range(0, len(flat), 2):
+        field = flat[i].decode()
+        if field == STATE_FIELD:
+            state = flat[i + 1].decode()
+        else:
+            data[field] = orjson.loads(flat[i + 1])
+    return state, data
+
+
+class HashStorage(BaseStorage):
+    """BaseStorage поверх одного Redis hash на чат (см. модуль)."""
+
+    def __init__(
+        self,
+        redis: aioredis.Redis,
+        key_builder: Optional[KeyBuilder] = None,
+        ttl: Optional[int] = None,
+        legacy_fallback: bool = False,
+    ) -> None:
+        self.redis = redis
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.ttl = ttl
+        self.legacy_fallback = legacy_fallback
+        self._read = redis.register_script(_READ)
+        self._set_data = redis.register_script(_SET_DATA)
+        self._set_state = redis.register_script(_SET_STATE)
+        self._update_data = redis.register_script(_UPDATE_DATA)
+        self._cas_state = redis.register_script(_CAS_STATE)
+
+    def _keys(self, key: StorageKey) -> List[str]:
+        keys = [self.key_builder.build(key)]
+        if self.legacy_fallback:
+            keys += [self.key_builder.build(key, "state"), self.key_builder.build(key, "data")]
+        return keys
+
+    def _ttl(self) -> int:
+        # EXPIRE обязателен в скриптах; без TTL — практически «навсегда»
+        return self.ttl or 10 ** 9
+
+    async def _migrate(self, key: StorageKey, raw_state: Optional[bytes], raw_data: Optional[bytes],
+                       extra: Optional[Dict[str, Any]] = None,
+                       state: Any = ...) -> Tuple[Optional[str], Dict[str, Any]]:
+        """
+        Переносит старые ключи state/data в hash; extra — поверх старых data,
+        state (если передан) — вместо старого состояния.
+        """
+        if state is ...:
+            state = raw_state.decode() if raw_state else None
+        data = orjson.loads(raw_data) if raw_data else {}
+        data.update(extra or {})
+        keys = self._keys(key)
+        fields = _pairs(data)
+        if state is not None:
+            fields += [STATE_FIELD, state]
+        async with self.redis.pipeline(transaction=True) as p:
+            p.delete(keys[0])
+            if fields:
+                p.hset(keys[0], items=fields)
+                p.expire(keys[0], self._ttl())
+            p.delete(*keys[1:])
+            await p.execute()
+        return state, data
+
+    async def _fetch(self, key: StorageKey, field: str) -> Any:
+        res = await self._read(keys=self._keys(key), args=[field])
+        if len(res) > 1 and (res[1] or res[2]):
+            return await self._migrate(key, res[1], res[2])
+        return res[0]
+
+    # --- буфер на апдейт ---
+
+    def _active(self) -> Optional[_Buffer]:
+        buf = _buffer.get()
+        if buf is None or buf.closed or buf.storage is not self:
+            return None
+        return buf
+
+    async def _snapshot(self, buf: _Buffer, key: StorageKey) -> _Snapshot:
+        redis_key = self.key_builder.build(key)
+        snap = buf.entries.get(redis_key)
+        if snap is None:
+            value = await self._fetch(key, "")
+            state, data = value if isinstance(value, tuple) else _decode_hash(value)
+            snap = buf.entries[redis_key] = _Snapshot(key=key, state=state, data=data)
+        return snap
+
+    async def _flush(self, buf: _Buffer) -> None:
+        pending = [(k, s) for k, s in buf.entries.items() if s.dirty or s.state_dirty or s.replaced]
+        if not pending:
+            return
+        async with self.redis.pipeline(transaction=True) as p:
+            for redis_key, snap in pending:
+                if snap.replaced:
+                    p.delete(redis_key)
+                    fields = _pairs(snap.data)
+                    if snap.state is not None:
+                        fields += [STATE_FIELD, snap.state]
+                    if fields:
+                        p.hset(redis_key, items=fields)
+                else:
+                    fields = _pairs({k: snap.data[k] for k in snap.dirty})
+                    if snap.state_dirty and snap.state is not None:
+                        fields += [STATE_FIELD, snap.state]
+                    if fields:
+                        p.hset(redis_key, items=fields)
+                    if snap.state_dirty and snap.state is None:
+                        p.hdel(redis_key, STATE_FIELD)
+                p.expire(redis_key, self._ttl())
+                snap.dirty.clear()
+                snap.state_dirty = snap.replaced = False
+            await p.execute()
+
+    @asynccontextmanager
+    async def buffered(self) -> AsyncIterator[None]:
+        """
+        Один read и один write FSM на апдейт, если буфер открыт снаружи
+        FSMContextMiddleware (см. web/server.py); запись — и при исключении хендлера.
+        """
+        buf = _Buffer(storage=self)
+        token = _buffer.set(buf)
+        try:
+            yield
+        finally:
+            buf.closed = True
+            _buffer.reset(token)
+            await self._flush(buf)
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        buf = self._active()
+        if buf is not None:
+            snap = await self._snapshot(buf, key)
+            snap.state = value
+            snap.state_dirty = True
+            return
+        res = await self._set_state(keys=self._keys(key), args=[self._ttl(), STATE_FIELD, value or ""])
+        if res[0] == 0:
+            await self._migrate(key, res[1], res[2], state=value)
+
+    async def compare_and_set_state(self, key: StorageKey, expected: StateType, state: StateType) -> bool:
+        """
+        set_state, только если текущее состояние — expected (одним EVALSHA).
+        Для задач воркера, которые продолжают сценарий по снимку FSM: если
+        пользователь за это время ушёл дальше, вернёт False и ничего не тронет.
+        """
+        expected = expected.state if isinstance(expected, State) else expected
+        value = state.state if isinstance(state, State) else state
+        buf = self._active()
+        if buf is not None:
+            # сравнивать со снимком нельзя — состояние мог сменить воркер:
+            # сначала пишем накопленное, потом тот же скрипт по Redis
+            await self._flush(buf)
+        res = await self._cas_state(
+            keys=self._keys(key)[:1], args=[self._ttl(), STATE_FIELD, expected or "", value or ""]
+        )
+        if buf is not None:
+            redis_key = self.key_builder.build(key)
+            if res:
+                if redis_key in buf.entries:
+                    buf.entries[redis_key].state = value
+            else:
+                # снимок устарел — следующее чтение возьмёт свежий hash
+                buf.entries.pop(redis_key, None)
+        return bool(res)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        buf = self._active()
+        if buf is not None:
+            return (await self._snapshot(buf, key)).state
+        value = await self._fetch(key, STATE_FIELD)
+        if isinstance(value, tuple):
+            return value[0]
+        return value.decode() if value else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        buf = self._active()
+        if buf is not None:
+            snap = await self._snapshot(buf, key)
+            snap.data = dict(data)
+            snap.dirty.clear()
+            snap.replaced = True
+            return
+        await self._set_data(keys=self._keys(key), args=[self._ttl(), STATE_FIELD, *_pairs(data)])
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        buf = self._active()
+        if buf is not None:
+            return (await self._snapshot(buf, key)).data.copy()
+        value = await self._fetch(key, "")
+        if isinstance(value, tuple):
+            return value[1]
+        return _decode_hash(value)[1]
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Any = None) -> Any:
+        buf = self._active()
+        if buf is not None:
+            return (await self._snapshot(buf, storage_key)).data.get(dict_key, default)
+        value = await self._fetch(storage_key, dict_key)
+        if isinstance(value, tuple):
+            return value[1].get(dict_key, default)
+        return orjson.loads(value) if value is not None else default
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        buf = self._active()
+        if buf is not None:
+            snap = await self._snapshot(buf, key)
+            snap.data.update(data)
+            snap.dirty.update(data)
+            return snap.data.copy()
+        res = await self._update_data(keys=self._keys(key), args=[self._ttl(), *_pairs(data)])
+        if res[0] == 0:
+            _, merged = await self._migrate(key, res[1], res[2], extra=data)
+            return merged.copy()
+        return _decode_hash(res[1])[1]
+
+    async def close(self) -> None:
+        # клиент общий на процесс (core.redis), закрывается вместе с остальными
+        pass
+
+
+async def flush_buffered() -> None:
+    """
+    Досрочно записывает буфер текущего апдейта (буферизация продолжается).
+    Нужен перед постановкой задач, которые читают FSM из воркера.
+    """
+    buf = _buffer.get()
+    if buf is not None and not buf.closed:
+        await buf.storage._flush(buf)
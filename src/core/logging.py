@@ -1,50 +1,135 @@
-# import logging
-# import json
-# import sys
-
-# def configure_json_logging():
-#     class JsonFormatter(logging.Formatter):
-#         def format(self, record):
-#             d = {
-#                 "lvl": record.levelname,
-#                 "msg": record.getMessage(),
-#                 "logger": record.name,
-#                 "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
-#             }
-#             if record.exc_info:
-#                 d["exc"] = self.formatException(record.exc_info)
-#             return json.dumps(d, ensure_ascii=False)
-#     h = logging.StreamHandler(sys.stdout)
-#     h.setFormatter(JsonFormatter())
-#     root = logging.getLogger()
-#     root.handlers = [h]
-#     root.setLevel(logging.INFO)
+"""
+Структурное JSON-логирование.
 
+- поля события передаются через ``extra=`` и попадают в JSON как есть
+  (никаких заранее сериализованных строк внутри "msg");
+- кодирование через orjson;
+- запись в stdout вынесена в отдельный поток (QueueHandler → QueueListener),
+  event loop только кладёт запись в очередь;
+- шумные INFO-события (webhook_hit и т.п.) сэмплируются.
+"""
+from __future__ import annotations
+
+import atexit
+import copy
 import logging
-import json
+import logging.handlers
+import queue
+import random
 import sys
+from typing import Dict, Optional
+
+import orjson
+
+# Атрибуты LogRecord, которые не являются полями события
+_RESERVED = frozenset(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {
+    "message",
+    "asctime",
+    "taskName",
+}
+
+# Высокочастотные события: пишем только долю (WARNING+ пишутся всегда)
+SAMPLED_EVENTS = (
+    "webhook_hit",
+    "webhook_update",
+    "webhook_processed",
+    "webhook.hit",
+)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        d = {
+            "lvl": record.levelname,
+            "msg": record.getMessage(),
+            "logger": record.name,
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+        }
+        for k, v in record.__dict__.items():
+            if k not in _RESERVED and not k.startswith("_"):
+                d[k] = v
+        if record.exc_info:
+            d["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            d["exc"] = record.exc_text
+        return orjson.dumps(d, default=str).decode()
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю ``rate`` INFO/DEBUG записей для указанных событий."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.msg) if isinstance(record.msg, str) else None
+        if rate is None:
+            return True
+        if random.random() < rate:
+            record.sample_rate = rate
+            return True
+        return False
+
+
+class _LoopQueueHandler(logging.handlers.QueueHandler):
+    """
+    Очередь внутри процесса: запись не pickle-ится, поэтому exc_info и extra
+    передаём как есть — форматирование целиком происходит в потоке listener-а.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _stop_listener() -> None:
+    global _listener
+    if _listener is None:
+        return
+    try:
+        _listener.stop()
+    except Exception:
+        pass
+    _listener = None
+
+
+def configure_json_logging(sample_rate: Optional[float] = None) -> None:
+    """Идемпотентна: повторный вызов (post_fork, импорт app) пересоздаёт listener."""
+    global _listener
+
+    if sample_rate is None:
+        from core.config import settings
+        sample_rate = settings.LOG_SAMPLE_RATE
+
+    _stop_listener()
+
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(JsonFormatter())
+
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    h = _LoopQueueHandler(q)
+    h.addFilter(SamplingFilter({ev: sample_rate for ev in SAMPLED_EVENTS}))
+
+    _listener = logging.handlers.QueueListener(q, out, respect_handler_level=True)
+    _listener.start()
 
-def configure_json_logging():
-    class JsonFormatter(logging.Formatter):
-        def format(self, record):
-            d = {
-                "lvl": record.levelname,
-                "msg": record.getMessage(),
-                "logger": record.name,
-                "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
-            }
-            if record.exc_info:
-                d["exc"] = self.formatException(record.exc_info)
-            return json.dumps(d, ensure_ascii=False)
-    h = logging.StreamHandler(sys.stdout)
-    h.setFormatter(JsonFormatter())
     root = logging.getLogger()
     root.handlers = [h]
     root.setLevel(logging.INFO)
-    
-    # 🔇 ДОБАВЛЕНО: Отключаем шумные INFO логи (WARNING и ERROR всё равно пишутся!)
+
+    # 🔇 Отключаем шумные INFO логи (WARNING и ERROR всё равно пишутся!)
     logging.getLogger("aiogram.event").setLevel(logging.WARNING)      # "Update id=X is handled"
     logging.getLogger("httpx").setLevel(logging.WARNING)              # "HTTP Request: GET/POST"
     logging.getLogger("httpcore").setLevel(logging.WARNING)           # HTTP core logs
     logging.getLogger("uvicorn.access").setLevel(logging.WARNING)     # "POST /tg/webhook HTTP/1.1 200"
-    logging.getLogger("hpack").setLevel(logging.WARNING)              # HTTP/2 logs
\ No newline at end of file
+    logging.getLogger("hpack").setLevel(logging.WARNING)              # HTTP/2 logs
+
+
+atexit.register(_stop_listener)
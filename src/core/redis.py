@@ -0,0 +1,33 @@
+"""Общие Redis-клиенты процесса: по одному пулу соединений на каждую БД."""
+from __future__ import annotations
+
+from typing import Dict
+
+import redis.asyncio as aioredis
+
+from core.config import settings
+
+_clients: Dict[int, aioredis.Redis] = {}
+
+
+def get_redis(db: int) -> aioredis.Redis:
+    """Возвращает (и лениво создаёт) клиент для указанной БД Redis."""
+    cli = _clients.get(db)
+    if cli is None:
+        cli = aioredis.Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=db,
+            password=settings.REDIS_PASSWORD,
+        )
+        _clients[db] = cli
+    return cli
+
+
+async def close_redis() -> None:
+    for cli in list(_clients.values()):
+        try:
+            await cli.aclose()
+        except Exception:
+            pass
+    _clients.clear()
@@ -1,12 +1,36 @@
 # db/engine.py
 from __future__ import annotations
 
+import time
+
+from prometheus_client import Histogram
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from core.config import settings
 
+# метрика пула живёт здесь, чтобы db не зависел от services (services.metrics её реэкспортирует)
+DB_ACQUIRE_SECONDS = Histogram(
+    "db_session_acquire_seconds",
+    "Время получения соединения MySQL из пула",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+
+
+class _TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул, который меряет ожидание соединения (включая connect нового)."""
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_ACQUIRE_SECONDS.observe(time.perf_counter() - t0)
+
+
 # 💡 Агрессивные, но безопасные таймауты + маленький пул для шаред-MySQL
 engine = create_async_engine(
     settings.DB_DSN,
+    poolclass=_TimedQueuePool,
     pool_pre_ping=True,
     pool_recycle=180,          
     pool_size=15,
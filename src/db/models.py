@@ -61,4 +61,18 @@ class BroadcastJob(Base):
     note: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     media_type: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
     media_file_id: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
-    media_file_path: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
\ No newline at end of file
+    media_file_path: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    segment: Mapped[str] = mapped_column(String(20), nullable=False, default="all")  # services.audience
+    # повтор рассылки: аудитория — неудачные получатели этой рассылки (services.broadcast_log)
+    parent_id: Mapped[Optional[str]] = mapped_column(String(36), nullable=True)
+
+class BroadcastDelivery(Base):
+    """Исход отправки одному получателю; только INSERT пачками."""
+    __tablename__ = "broadcast_deliveries"
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    job_id: Mapped[str] = mapped_column(String(36), nullable=False)
+    chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    status: Mapped[str] = mapped_column(String(16), nullable=False)  # success / fallback / failed
+    error: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
+    latency_ms: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
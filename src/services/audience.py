@@ -0,0 +1,52 @@
+"""
+Аудитории рассылок: сегмент — это SQL-условие на users.
+
+Одно и то же условие идёт и в ``SELECT COUNT(*)`` для ``total`` (без выгрузки
+chat_id в веб-процесс), и в постраничную выборку broadcast_send.
+Условия опираются на существующие индексы: payments(user_id, status),
+tasks(user_id, created_at).
+"""
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import Callable, Dict
+
+from sqlalchemy import ColumnElement, exists, func, select, true
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from db.models import Payment, Task, User
+
+DEFAULT_SEGMENT = "all"
+
+
+def _paid() -> ColumnElement[bool]:
+    return exists().where(Payment.user_id == User.id, Payment.status == "succeeded")
+
+
+def _active() -> ColumnElement[bool]:
+    since = datetime.utcnow() - timedelta(days=settings.AUDIENCE_ACTIVE_DAYS)
+    return exists().where(Task.user_id == User.id, Task.created_at >= since)
+
+
+SEGMENTS: Dict[str, Callable[[], ColumnElement[bool]]] = {
+    "all": true,
+    "paid": _paid,  # была хотя бы одна успешная оплата
+    "active": _active,  # генерации за AUDIENCE_ACTIVE_DAYS дней
+    "balance": lambda: User.balance_credits > 0,
+    "zero": lambda: User.balance_credits == 0,
+}
+
+
+def segment_predicate(segment: str) -> ColumnElement[bool]:
+    """Условие WHERE для users; ValueError на неизвестный сегмент."""
+    try:
+        return SEGMENTS[segment or DEFAULT_SEGMENT]()
+    except KeyError:
+        raise ValueError(f"unknown segment: {segment}") from None
+
+
+async def count_audience(session: AsyncSession, segment: str = DEFAULT_SEGMENT) -> int:
+    return int(await session.scalar(
+        select(func.count()).select_from(User).where(segment_predicate(segment))
+    ) or 0)
@@ -0,0 +1,223 @@
+"""
+Content-addressed хранилище файлов в ``MEDIA_DIR`` (общий volume app и воркеров).
+
+- ключ — ``{sha256}{ext}``, расширение определяется по сигнатуре содержимого;
+- запись атомарная: временный файл в том же каталоге → ``os.replace``;
+- учёт в Redis (БД кэша): ``blobs:lru`` (zset key → последнее обращение),
+  ``blobs:size`` (hash key → байты), ``blobs:total`` (сумма);
+- ``blobs:task:{task_uuid}`` — какие файлы получились в генерации;
+- вытеснение по LRU до ``BLOB_STORE_MAX_BYTES`` трогает только вытесняемые
+  файлы, без обхода каталога.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import AsyncIterator, BinaryIO, List, Optional, Tuple
+
+import httpx
+
+from core.config import settings
+from core.redis import get_redis
+
+log = logging.getLogger("blobstore")
+
+LRU_KEY = "blobs:lru"
+SIZE_KEY = "blobs:size"
+TOTAL_KEY = "blobs:total"
+
+_KEY_RE = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,5}$")
+_CHUNK = 64 * 1024
+_WRITE_BUF = 1024 * 1024
+
+
+def _task_key(task_uuid: str) -> str:
+    return f"blobs:task:{task_uuid}"
+
+
+def sniff_ext(head: bytes) -> str:
+    """Расширение по магическим байтам (KIE отдаёт и png, и jpeg, и webp)."""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    if head[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return ".heic"
+    return ".bin"
+
+
+def blob_path(key: str) -> Optional[str]:
+    """Путь к файлу по ключу; None для некорректного ключа."""
+    if not _KEY_RE.match(key or ""):
+        return None
+    return os.path.join(settings.MEDIA_DIR, key[:2], key)
+
+
+async def _register(key: str, size: int) -> None:
+    r = get_redis(settings.REDIS_DB_CACHE)
+    try:
+        if await r.hsetnx(SIZE_KEY, key, size):
+            await r.incrby(TOTAL_KEY, size)
+        await r.zadd(LRU_KEY, {key: time.time()})
+    except Exception:
+        log.warning("blobstore.register_failed", extra={"key": key})
+
+
+async def touch(key: str) -> None:
+    try:
+        await get_redis(settings.REDIS_DB_CACHE).zadd(LRU_KEY, {key: time.time()}, xx=True)
+    except Exception:
+        pass
+
+
+def _open_part() -> Tuple[BinaryIO, str]:
+    os.makedirs(settings.MEDIA_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=settings.MEDIA_DIR, prefix=".part-")
+    return os.fdopen(fd, "wb"), tmp
+
+
+def _commit_part(tmp: str, dst: str) -> None:
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.replace(tmp, dst)
+
+
+def _drop_part(tmp: str) -> None:
+    try:
+        os.unlink(tmp)
+    except OSError:
+        pass
+
+
+async def put_stream(chunks: AsyncIterator[bytes], *, max_bytes: int) -> str:
+    """
+    Пишет поток в хранилище; ValueError, если больше max_bytes.
+    Файловые операции — в потоке (asyncio.to_thread), чтобы запись картинок
+    до 20 МБ не останавливала остальные задачи воркера; мелкие чанки
+    склеиваются до _WRITE_BUF, чтобы не прыгать в поток на каждые 64 КБ.
+    """
+    h = hashlib.sha256()
+    size = 0
+    head = b""
+    pending: List[bytes] = []
+    pending_len = 0
+    f, tmp = await asyncio.to_thread(_open_part)
+    try:
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError("file too large")
+                if len(head) < 16:
+                    head += chunk[:16]
+                h.update(chunk)
+                pending.append(chunk)
+                pending_len += len(chunk)
+                if pending_len >= _WRITE_BUF:
+                    await asyncio.to_thread(f.write, b"".join(pending))
+                    pending, pending_len = [], 0
+            if pending:
+                await asyncio.to_thread(f.write, b"".join(pending))
+        finally:
+            # крупные записи идут мимо буфера файла — close почти ничего не пишет
+            f.close()
+        key = f"{h.hexdigest()}{sniff_ext(head)}"
+        await asyncio.to_thread(_commit_part, tmp, blob_path(key))
+    except BaseException:
+        # синхронно: должно отработать и при отмене задачи
+        _drop_part(tmp)
+        raise
+    await _register(key, size)
+    return key
+
+
+async def put_url(url: str, *, max_bytes: int, client: Optional[httpx.AsyncClient] = None) -> str:
+    """Скачивает URL потоком прямо в хранилище."""
+    async def _fetch(cli: httpx.AsyncClient) -> str:
+        async with cli.stream("GET", url) as resp:
+            resp.raise_for_status()
+            return await put_stream(resp.aiter_bytes(_CHUNK), max_bytes=max_bytes)
+
+    if client is not None:
+        return await _fetch(client)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=5.0)) as cli:
+        return await _fetch(cli)
+
+
+async def link_task(task_uuid: str, keys: List[str]) -> None:
+    if not keys:
+        return
+    r = get_redis(settings.REDIS_DB_CACHE)
+    try:
+        async with r.pipeline(transaction=True) as p:
+            p.delete(_task_key(task_uuid))
+            p.rpush(_task_key(task_uuid), *keys)
+            p.expire(_task_key(task_uuid), settings.BLOB_TASK_INDEX_TTL_S)
+            await p.execute()
+    except Exception:
+        log.warning("blobstore.link_task_failed", extra={"task_uuid": task_uuid})
+
+
+async def task_blobs(task_uuid: Optional[str]) -> List[str]:
+    """Пути файлов генерации, которые ещё лежат в хранилище (и освежает их в LRU)."""
+    if not task_uuid:
+        return []
+    try:
+        raw = await get_redis(settings.REDIS_DB_CACHE).lrange(_task_key(task_uuid), 0, -1)
+    except Exception:
+        return []
+    paths = []
+    for k in raw:
+        key = k.decode()
+        path = blob_path(key)
+        if path and os.path.exists(path):
+            paths.append(path)
+            await touch(key)
+    return paths
+
+
+async def evict(max_bytes: Optional[int] = None, batch: int = 50) -> int:
+    """Удаляет самые давно использованные файлы, пока объём больше лимита."""
+    limit = settings.BLOB_STORE_MAX_BYTES if max_bytes is None else max_bytes
+    r = get_redis(settings.REDIS_DB_CACHE)
+    evicted = 0
+    while int(await r.get(TOTAL_KEY) or 0) > limit:
+        keys = [k.decode() for k in await r.zrange(LRU_KEY, 0, batch - 1)]
+        if not keys:
+            # учёт разъехался (например, flush Redis) — начинаем с нуля
+            await r.set(TOTAL_KEY, 0)
+            break
+        sizes = await r.hmget(SIZE_KEY, keys)
+        done, freed = [], 0
+        for key, size in zip(keys, sizes):
+            path = blob_path(key)
+            try:
+                if path:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.warning("blobstore.unlink_failed", extra={"key": key, "error": str(e)})
+                await touch(key)  # в конец очереди, чтобы не застрять на нём
+                continue
+            done.append(key)
+            freed += int(size or 0)
+        if not done:
+            break
+        async with r.pipeline(transaction=True) as p:
+            p.zrem(LRU_KEY, *done)
+            p.hdel(SIZE_KEY, *done)
+            p.decrby(TOTAL_KEY, freed)
+            await p.execute()
+        evicted += len(done)
+    if evicted:
+        log.info("blobstore.evicted", extra={"count": evicted})
+    return evicted
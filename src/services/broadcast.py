@@ -4,11 +4,15 @@ Production-ready broadcast с адаптивным rate limiting
 from __future__ import annotations
 
 import asyncio
+import html
+import re
 import shutil
 import subprocess
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import Any, Dict, List, Optional, Tuple
 import logging
+import time
 
 from sqlalchemy import select, update, delete
 from aiogram import Bot
@@ -18,9 +22,103 @@ from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, Teleg
 from core.config import settings
 from db.engine import SessionLocal
 from db.models import BroadcastJob, User
+from services import broadcast_progress, segments
+from services.broadcast_log import DeliveryLog, failed_page
+from services.audience import segment_predicate
+from services.metrics import BROADCAST_SENDS_TOTAL, RATE_LIMITED_TOTAL, RETRIES_TOTAL
 
 log = logging.getLogger("broadcast")
 
+CAPTION_LIMIT = 1024
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+@dataclass
+class SendPlan:
+    """
+    Как слать всем получателям; решается один раз до рассылки (send_plan + preflight).
+
+    mode: media — медиа с подписью; split — медиа без подписи + текст
+    (подпись длиннее лимита); text — только текст (медиа не прошло проверку).
+    """
+    mode: str
+    media_type: Optional[str]
+    file_id: Optional[str]
+    text: str
+    parse_mode: Optional[str] = "HTML"
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def note(self) -> str:
+        return "; ".join(self.notes)
+
+
+def send_plan(bj: BroadcastJob) -> SendPlan:
+    """
+    План без обращений к Telegram: режим по наличию медиа и длине подписи.
+    Проверки preflight его только уточняют — если они не прошли, длинная
+    подпись всё равно уйдёт отдельным сообщением, а не ошибкой у каждого.
+    """
+    plan = SendPlan(
+        mode="media" if bj.media_type in ("photo", "video") and bj.media_file_id else "text",
+        media_type=bj.media_type,
+        file_id=bj.media_file_id,
+        text=bj.text,
+    )
+    if plan.mode == "media" and _visible_len(plan.text, plan.parse_mode) > CAPTION_LIMIT:
+        plan.mode = "split"
+        plan.notes.append(f"подпись > {CAPTION_LIMIT}: медиа + отдельный текст")
+    return plan
+
+
+def _visible_len(text: str, parse_mode: Optional[str]) -> int:
+    """Длина после разбора HTML в единицах UTF-16 — так лимит считает Telegram."""
+    if parse_mode == "HTML":
+        text = html.unescape(_TAG_RE.sub("", text))
+    return len(text.encode("utf-16-le")) // 2
+
+
+async def _probe_send(bot: Bot, chat_id: int, plan: SendPlan, caption: Optional[str]):
+    if plan.media_type == "photo":
+        return await bot.send_photo(chat_id, photo=plan.file_id, caption=caption, parse_mode=plan.parse_mode)
+    return await bot.send_video(chat_id, video=plan.file_id, caption=caption, parse_mode=plan.parse_mode)
+
+
+async def preflight(bot: Bot, plan: SendPlan, job_id: str) -> None:
+    """
+    Проверка рассылки до первого получателя (пробная отправка админу): HTML
+    разбирается, file_id медиа отправляется, из ответа берётся file_id, которым
+    этот бот точно может слать. План уточняется на месте — что успели
+    проверить до ошибки, то и остаётся.
+    """
+    if not settings.ADMIN_ID:
+        return
+    admin = int(settings.ADMIN_ID)
+
+    # заголовок отдельно: текст у лимита 4096 с префиксом не влез бы
+    await bot.send_message(admin, f"🧪 Проверка рассылки #{job_id}:")
+    # HTML проверяем на тексте как есть: ошибка разметки одна на всех получателей
+    try:
+        await bot.send_message(admin, plan.text, parse_mode=plan.parse_mode)
+    except TelegramBadRequest as e:
+        if "parse entities" not in str(e).lower():
+            raise
+        plan.parse_mode = None
+        plan.notes.append("HTML не разобран: отправка без разметки")
+        await bot.send_message(admin, plan.text)
+
+    if plan.mode != "text":
+        try:
+            msg = await _probe_send(bot, admin, plan, plan.text if plan.mode == "media" else None)
+            if plan.media_type == "photo" and msg.photo:
+                plan.file_id = msg.photo[-1].file_id
+            elif plan.media_type == "video" and msg.video:
+                plan.file_id = msg.video.file_id
+        except TelegramBadRequest as e:
+            log.warning(f"⚠️ Preflight media failed for {job_id}: {e}")
+            plan.mode = "text"
+            plan.notes.append(f"медиа не отправляется ({e.message}): только текст")
+
 
 async def broadcast_send(ctx: dict[str, Any], job_id: str):
     """
@@ -72,81 +170,145 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
         )
         await session.commit()
 
+        # 🧪 Проверка медиа и разметки один раз на всю рассылку
+        plan = send_plan(bj)
+        try:
+            await preflight(bot, plan, job_id)
+        except Exception as e:
+            log.warning(f"⚠️ Preflight for {job_id} failed, sending as planned: {e}")
+        if plan.note:
+            log.info(f"🧪 Broadcast {job_id} plan: {plan.mode}, {plan.note}")
+            await session.execute(
+                update(BroadcastJob).where(BroadcastJob.id == job_id).values(note=f"Preflight: {plan.note}")
+            )
+            await session.commit()
+
         sent = 0
         failed = 0
         fallback = 0
         rate_limited_count = 0
+        dlog = DeliveryLog(job_id)
+        tracker = broadcast_progress.ThroughputTracker()
+        last_publish = 0.0
+        last_edit = 0.0
+        total_processed = 0
+
+        async def _report(status: str, force: bool = False) -> None:
+            """Снимок прогресса в Redis и правка сообщения /broadcast_watch (с троттлингом)."""
+            nonlocal last_publish, last_edit
+            now = time.monotonic()
+            if not force and now - last_publish < settings.BROADCAST_PROGRESS_EVERY_S:
+                return
+            last_publish = now
+            rps = tracker.rps()
+            snap = await broadcast_progress.publish(
+                job_id,
+                status=status,
+                total=bj.total,
+                processed=total_processed,
+                sent=sent,
+                failed=failed,
+                fallback=fallback,
+                rps=round(rps, 2),
+                target_rps=round(current_rps, 2),
+                eta_s=broadcast_progress.eta_seconds(bj.total, total_processed, rps),
+            )
+            if not force and now - last_edit < settings.BROADCAST_STATUS_EDIT_S:
+                return
+            last_edit = now
+            target = await broadcast_progress.watcher(job_id)
+            if not target:
+                return
+            if not force:
+                # правка идёт за токен рассылки — не сверх лимита отправок
+                await tokens.get()
+            try:
+                await bot.edit_message_text(
+                    broadcast_progress.render(job_id, snap),
+                    chat_id=target[0],
+                    message_id=target[1],
+                    parse_mode="HTML",
+                )
+            except TelegramBadRequest:
+                pass  # message is not modified
+            except Exception as e:
+                log.debug(f"Status edit failed for {job_id}: {e}")
         cancelled = False
 
-        async def _send(chat_id: int, text: str, media_type: str | None, 
-                       media_file_id: str | None, media_file_path: str | None) -> str:
+        async def _deliver(chat_id: int, done: Dict[str, bool]) -> None:
+            # file_id уже проверен preflight'ом — Telegram не перекачивает файл,
+            # поэтому длинные таймауты под загрузку видео не нужны
+            if plan.mode == "text":
+                await bot.send_message(chat_id, plan.text, parse_mode=plan.parse_mode, request_timeout=15)
+                return
+            if not done.get("media"):
+                caption = plan.text if plan.mode == "media" else None
+                if plan.media_type == "photo":
+                    await bot.send_photo(
+                        chat_id, photo=plan.file_id, caption=caption, parse_mode=plan.parse_mode, request_timeout=30
+                    )
+                else:
+                    await bot.send_video(
+                        chat_id, video=plan.file_id, caption=caption, parse_mode=plan.parse_mode, request_timeout=30
+                    )
+                # в split повтор после ошибки на тексте не шлёт медиа второй раз
+                done["media"] = True
+            if plan.mode == "split":
+                await bot.send_message(chat_id, plan.text, parse_mode=plan.parse_mode, request_timeout=15)
+
+        async def _send_text_only(chat_id: int, done: Dict[str, bool], error: str) -> Tuple[str, Optional[str]]:
+            try:
+                await bot.send_message(chat_id, plan.text, parse_mode=plan.parse_mode, request_timeout=15)
+            except Exception:
+                return "failed", error
+            # медиа уже дошло (split) — текст был недостающей частью, получатель получил всё
+            if done.get("media"):
+                return "success", None
+            return "fallback", error
+
+        async def _attempt(chat_id: int) -> Tuple[str, Optional[str]]:
             """
             Отправка с retry и адаптивным rate limiting.
-            Возвращает: 'success', 'fallback', 'failed'
+            Возвращает (исход, класс ошибки): исход — 'success', 'fallback', 'failed'
             """
             nonlocal current_rps, rate_limited_count
             
-            await tokens.get()
+            done: Dict[str, bool] = {}
             async with sem:
                 for attempt in range(3):
                     try:
-                        if media_type == "photo" and media_file_id:
-                            await bot.send_photo(
-                                chat_id, 
-                                photo=media_file_id, 
-                                caption=text, 
-                                parse_mode="HTML",
-                                request_timeout=45
-                            )
-                        elif media_type == "video" and media_file_id:
-                            await bot.send_video(
-                                chat_id, 
-                                video=media_file_id,
-                                caption=text, 
-                                parse_mode="HTML",
-                                request_timeout=180
-                            )
-                        else:
-                            await bot.send_message(chat_id, text,parse_mode="HTML", request_timeout=15)
+                        await _deliver(chat_id, done)
                         
                         if rate_limited_count > 0:
                             rate_limited_count = max(0, rate_limited_count - 1)
                         
-                        return "success"
+                        return "success", None
                     
                     except TelegramBadRequest as e:
                         error_msg = str(e).lower()
                         
                         if "too many requests" in error_msg or "retry after" in error_msg:
-                            import re
                             match = re.search(r'retry after (\d+)', error_msg)
                             wait_time = int(match.group(1)) if match else 10
                             
                             rate_limited_count += 1
+                            RATE_LIMITED_TOTAL.labels("telegram").inc()
                             if rate_limited_count > 3:
                                 current_rps = max(5, current_rps * 0.7)
                                 log.warning(f"🐌 Slowing down: RPS={current_rps:.1f}")
                             
                             if attempt < 2:
                                 log.debug(f"⏳ Rate limit for {chat_id}, waiting {wait_time}s (attempt {attempt+1}/3)")
+                                RETRIES_TOTAL.labels("broadcast").inc()
                                 await asyncio.sleep(wait_time)
                                 continue
                             else:
-                                try:
-                                    await bot.send_message(chat_id, text,parse_mode="HTML", request_timeout=15)
-                                    return "fallback"
-                                except Exception:
-                                    return "failed"
+                                return await _send_text_only(chat_id, done, "rate_limit")
                         
                         # ✅ FIX: НЕ УДАЛЯЕМ при BadRequest - это не блокировка!
                         if attempt == 2:
                             log.warning(f"⚠️ BadRequest for {chat_id}: {e}")
-                            try:
-                                await bot.send_message(chat_id, text,parse_mode="HTML", request_timeout=15)
-                                return "fallback"
-                            except Exception:
-                                pass
-                            return "failed"
+                            return await _send_text_only(chat_id, done, "bad_request")
                     
                     except TelegramForbiddenError:
                         # ✅ ТОЛЬКО здесь удаляем - пользователь заблокировал бота
@@ -155,29 +317,76 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
                             async with SessionLocal() as s2:
                                 await s2.execute(delete(User).where(User.chat_id == chat_id))
                                 await s2.commit()
+                            await segments.forget_user(chat_id)
                         except Exception:
                             pass
-                        return "failed"
+                        return "failed", "forbidden"
                     
                     except TelegramRetryAfter as e:
                         if attempt < 2:
+                            RETRIES_TOTAL.labels("broadcast").inc()
                             await asyncio.sleep(e.retry_after)
                             continue
-                        return "failed"
+                        return "failed", "retry_after"
                     
                     except Exception as e:
                         if "timeout" in str(e).lower() and attempt < 2:
                             log.warning(f"⏳ Timeout for {chat_id}, retry {attempt + 1}/3")
+                            RETRIES_TOTAL.labels("broadcast").inc()
                             await asyncio.sleep(5)
                             continue
                         
                         log.error(f"❌ Unexpected error for {chat_id}: {e}")
-                        return "failed"
+                        return "failed", "timeout" if "timeout" in str(e).lower() else type(e).__name__[:32]
                 
-                return "failed"
+                return "failed", "error"
+
+        async def _send(chat_id: int) -> str:
+            await tokens.get()
+            t0 = time.perf_counter()
+            result, error = await _attempt(chat_id)
+            # задержка — от выданного токена до исхода, вместе с повторами
+            dlog.add(chat_id, result, error, int((time.perf_counter() - t0) * 1000))
+            return result
 
         last_chat_id = 0
-        total_processed = 0
+        await _report("running", force=True)
+        # аудитория: неудачные получатели родительской рассылки (повтор),
+        # снимок материализованного сегмента в Redis или SQL-условие
+        snapshot = None
+        audience = None
+        try:
+            if bj.parent_id:
+                log.info(f"🔁 Broadcast {job_id}: retrying failed recipients of {bj.parent_id}")
+            elif segments.parse_spec(bj.segment) and await segments.page(segments.job_key(job_id), 0, 1):
+                # снимок собран при постановке, когда наборы были целы
+                snapshot = segments.job_key(job_id)
+            elif await segments.use_materialized(bj.segment, rebuild=True):
+                snapshot = segments.job_key(job_id)
+                await segments.materialize(bj.segment, snapshot, ttl=settings.BROADCAST_JOB_TIMEOUT_S)
+            else:
+                audience = segment_predicate(bj.segment)
+        except segments.SegmentsNotReady as e:
+            # без наборов аудитория была бы пустой или неполной — не делаем вид, что разослали
+            pump_task.cancel()
+            log.error(f"❌ Broadcast {job_id}: segments not ready ({e})")
+            await session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id)
+                .values(status="error", note=f"Segments not ready: {', '.join(e.missing)}")
+            )
+            await session.commit()
+            await _report("error", force=True)
+            if settings.ADMIN_ID:
+                try:
+                    await bot.send_message(
+                        settings.ADMIN_ID,
+                        f"❌ Рассылка #{job_id} не запущена: сегменты в Redis не собраны "
+                        f"({', '.join(e.missing)}), пересборка не помогла."
+                    )
+                except Exception:
+                    pass
+            return
         
         while not cancelled:
             st_row = await session.execute(
@@ -191,13 +400,18 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
                 break
 
             try:
-                res = await session.execute(
-                    select(User.chat_id)
-                    .where(User.chat_id > last_chat_id)
-                    .order_by(User.chat_id)
-                    .limit(batch_size)
-                )
-                chat_ids = res.scalars().all()
+                if bj.parent_id:
+                    chat_ids = await failed_page(session, bj.parent_id, last_chat_id, batch_size)
+                elif snapshot:
+                    chat_ids = await segments.page(snapshot, last_chat_id, batch_size)
+                else:
+                    res = await session.execute(
+                        select(User.chat_id)
+                        .where(User.chat_id > last_chat_id, audience)
+                        .order_by(User.chat_id)
+                        .limit(batch_size)
+                    )
+                    chat_ids = res.scalars().all()
             except Exception as e:
                 log.error(f"❌ Failed to fetch users: {e}")
                 await session.execute(
@@ -233,16 +447,21 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
                 
                 chunk = chat_ids[i:i + check_cancel_every]
                 tasks = [
-                    asyncio.create_task(_send(cid, bj.text, bj.media_type, bj.media_file_id, bj.media_file_path))
+                    asyncio.create_task(_send(cid))
                     for cid in chunk
                 ]
                 results = await asyncio.gather(*tasks)
+                for r in results:
+                    BROADCAST_SENDS_TOTAL.labels(r).inc()
                 
                 sent += sum(1 for r in results if r == "success")
                 failed += sum(1 for r in results if r == "failed")
                 fallback += sum(1 for r in results if r == "fallback")
                 total_processed += len(results)
+                tracker.add(len(results))
+                await _report("running")
             
+            await dlog.maybe_flush()
             await session.execute(
                 update(BroadcastJob)
                 .where(BroadcastJob.id == job_id)
@@ -258,9 +477,13 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
             last_chat_id = chat_ids[-1]
 
         pump_task.cancel()
+        await dlog.flush()
+        await _report("cancelled" if cancelled else "done", force=True)
         
         final_status = "cancelled" if cancelled else "done"
         final_note = f"{'Cancelled' if cancelled else 'Completed'}. Fallback: {fallback}"
+        if plan.note:
+            final_note += f". Preflight: {plan.note}"
         
         await session.execute(
             update(BroadcastJob)
@@ -283,10 +506,10 @@ async def broadcast_send(ctx: dict[str, Any], job_id: str):
                 failed_rate = (failed / total * 100) if total > 0 else 0
                 
                 media_info = ""
-                if bj.media_type == "photo":
-                    media_info = " (📸 фото)"
-                elif bj.media_type == "video":
-                    media_info = " (🎬 видео)"
+                if plan.mode != "text":
+                    media_info = " (📸 фото)" if plan.media_type == "photo" else " (🎬 видео)"
+                elif bj.media_type:
+                    media_info = " (медиа отключено проверкой)"
                 
                 await bot.send_message(
                     settings.ADMIN_ID,
@@ -0,0 +1,132 @@
+"""
+Журнал доставки рассылок: исход по каждому получателю в ``broadcast_deliveries``.
+
+Строки копятся в памяти воркера и пишутся одним многострочным INSERT каждые
+``BROADCAST_LOG_FLUSH_EVERY`` отправок (и в конце рассылки). Таблица только
+дописывается; по ней работают ``/broadcast_retry`` (повтор только неудачных
+получателей, без повторной отправки успешным), разбивка ошибок в
+``/broadcast_status`` и анализ задержек отправки.
+"""
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from db.engine import SessionLocal
+from db.models import BroadcastDelivery
+
+log = logging.getLogger("broadcast_log")
+
+# бот заблокирован — пользователь уже удалён, повторять бессмысленно
+NOT_RETRYABLE = ("forbidden",)
+_PRUNE_CHUNK = 10000
+
+
+class DeliveryLog:
+    """Буфер исходов одной рассылки."""
+
+    def __init__(self, job_id: str, flush_every: int = 0):
+        self.job_id = job_id
+        self.flush_every = max(1, flush_every or settings.BROADCAST_LOG_FLUSH_EVERY)
+        self._rows: List[Dict[str, Any]] = []
+
+    def add(self, chat_id: int, status: str, error: Optional[str], latency_ms: int) -> None:
+        self._rows.append({
+            "job_id": self.job_id,
+            "chat_id": chat_id,
+            "status": status,
+            "error": error,
+            "latency_ms": max(0, latency_ms),
+            "created_at": datetime.utcnow(),
+        })
+
+    async def maybe_flush(self) -> None:
+        if len(self._rows) >= self.flush_every:
+            await self.flush()
+
+    async def flush(self) -> None:
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        try:
+            async with SessionLocal() as s:
+                await s.execute(insert(BroadcastDelivery), rows)
+                await s.commit()
+        except Exception as e:
+            # журнал не должен останавливать рассылку: вернём строки и попробуем
+            # со следующей пачкой, но не копим бесконечно
+            if len(rows) < self.flush_every * 10:
+                self._rows = rows + self._rows
+            else:
+                log.error("broadcast_log.rows_dropped", extra={"job_id": self.job_id, "rows": len(rows)})
+            log.warning("broadcast_log.flush_failed", extra={"job_id": self.job_id, "error": str(e)})
+
+
+def _retryable(job_id: str):
+    return (
+        BroadcastDelivery.job_id == job_id,
+        BroadcastDelivery.status == "failed",
+        func.coalesce(BroadcastDelivery.error, "").notin_(NOT_RETRYABLE),
+    )
+
+
+async def failed_page(session: AsyncSession, job_id: str, after_chat_id: int, limit: int) -> List[int]:
+    """Неудачные получатели рассылки job_id постранично (keyset по chat_id)."""
+    res = await session.execute(
+        select(BroadcastDelivery.chat_id)
+        .where(*_retryable(job_id), BroadcastDelivery.chat_id > after_chat_id)
+        .order_by(BroadcastDelivery.chat_id)
+        .limit(limit)
+    )
+    return list(res.scalars().all())
+
+
+async def count_retryable(session: AsyncSession, job_id: str) -> int:
+    return int(await session.scalar(
+        select(func.count()).select_from(BroadcastDelivery).where(*_retryable(job_id))
+    ) or 0)
+
+
+async def summary(session: AsyncSession, job_id: str) -> List[Tuple[str, Optional[str], int, int]]:
+    """(status, error, сколько, средняя задержка мс) по рассылке."""
+    res = await session.execute(
+        select(
+            BroadcastDelivery.status,
+            BroadcastDelivery.error,
+            func.count(),
+            func.avg(BroadcastDelivery.latency_ms),
+        )
+        .where(BroadcastDelivery.job_id == job_id)
+        .group_by(BroadcastDelivery.status, BroadcastDelivery.error)
+        .order_by(func.count().desc())
+    )
+    return [(st, err, int(n), int(avg or 0)) for st, err, n, avg in res.all()]
+
+
+async def prune_deliveries(ctx: Optional[dict[str, Any]] = None) -> None:
+    """Cron очереди maintenance: удаляет журнал старше BROADCAST_LOG_RETENTION_DAYS."""
+    horizon = datetime.utcnow() - timedelta(days=settings.BROADCAST_LOG_RETENTION_DAYS)
+    stmt = (
+        delete(BroadcastDelivery)
+        .where(BroadcastDelivery.created_at < horizon)
+        .with_dialect_options(mysql_limit=_PRUNE_CHUNK)
+    )
+    total = 0
+    try:
+        async with SessionLocal() as s:
+            # кусками, чтобы не держать долгую блокировку на вставках идущей рассылки
+            while True:
+                res = await s.execute(stmt)
+                await s.commit()
+                total += res.rowcount
+                if res.rowcount < _PRUNE_CHUNK:
+                    break
+        if total:
+            log.info("broadcast_log.pruned", extra={"rows": total})
+    except Exception:
+        log.exception("broadcast_log.prune_failed")
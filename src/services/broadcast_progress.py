@@ -0,0 +1,130 @@
+"""
+Живой прогресс рассылки: скорость в скользящем окне, текущий RPS и ETA.
+
+Воркер рассылки раз в ``BROADCAST_PROGRESS_EVERY_S`` пишет снимок в hash
+``bc:progress:{job_id}`` (БД REDIS_DB_BROADCAST), и ``/broadcast_status`` читает
+идущую рассылку оттуда, не трогая MySQL. ``/broadcast_watch`` регистрирует
+сообщение в ``bc:watch:{job_id}``; его правит сам воркер не чаще
+``BROADCAST_STATUS_EDIT_S`` и только за токен общего лимита рассылки, так что
+обновления статуса не превышают бюджет отправок.
+"""
+from __future__ import annotations
+
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from core.config import settings
+from core.redis import get_redis
+
+log = logging.getLogger("broadcast_progress")
+
+PROGRESS_TTL_S = 86400
+
+
+def progress_key(job_id: str) -> str:
+    return f"bc:progress:{job_id}"
+
+
+def watch_key(job_id: str) -> str:
+    return f"bc:watch:{job_id}"
+
+
+def _r():
+    return get_redis(settings.REDIS_DB_BROADCAST)
+
+
+class ThroughputTracker:
+    """Отправки в секунду за последние window_s секунд."""
+
+    def __init__(self, window_s: float = 60.0):
+        self.window_s = window_s
+        self.started = time.monotonic()
+        self._events: Deque[Tuple[float, int]] = deque()
+        self._in_window = 0
+
+    def add(self, n: int) -> None:
+        now = time.monotonic()
+        self._events.append((now, n))
+        self._in_window += n
+        self._trim(now)
+
+    def _trim(self, now: float) -> None:
+        while self._events and self._events[0][0] < now - self.window_s:
+            self._in_window -= self._events.popleft()[1]
+
+    def rps(self) -> float:
+        now = time.monotonic()
+        self._trim(now)
+        # в начале рассылки окно ещё не набралось — делим на прошедшее время
+        span = min(self.window_s, now - self.started)
+        return self._in_window / span if span > 0 else 0.0
+
+
+def eta_seconds(total: int, processed: int, rps: float) -> Optional[int]:
+    remaining = max(0, total - processed)
+    if not remaining:
+        return 0
+    return int(remaining / rps) if rps > 0 else None
+
+
+async def publish(job_id: str, **fields) -> Dict[str, str]:
+    """Снимок прогресса (его же и возвращает); ошибка Redis рассылку не останавливает."""
+    fields["updated_at"] = int(time.time())
+    mapping = {k: "" if v is None else str(v) for k, v in fields.items()}
+    try:
+        async with _r().pipeline(transaction=False) as p:
+            p.hset(progress_key(job_id), mapping=mapping)
+            p.expire(progress_key(job_id), PROGRESS_TTL_S)
+            await p.execute()
+    except Exception as e:
+        log.warning("broadcast_progress.publish_failed", extra={"job_id": job_id, "error": str(e)})
+    return mapping
+
+
+async def read(job_id: str) -> Dict[str, str]:
+    raw = await _r().hgetall(progress_key(job_id))
+    return {k.decode(): v.decode() for k, v in raw.items()}
+
+
+async def watch(job_id: str, chat_id: int, message_id: int) -> None:
+    await _r().set(watch_key(job_id), f"{chat_id}:{message_id}", ex=PROGRESS_TTL_S)
+
+
+async def watcher(job_id: str) -> Optional[Tuple[int, int]]:
+    try:
+        raw = await _r().get(watch_key(job_id))
+    except Exception:
+        return None
+    if not raw:
+        return None
+    chat_id, message_id = raw.decode().split(":")
+    return int(chat_id), int(message_id)
+
+
+def _fmt_eta(value: str) -> str:
+    if value == "":
+        return "—"
+    s = int(value)
+    h, rem = divmod(s, 3600)
+    return f"{h}ч {rem // 60}м" if h else f"{rem // 60}м {rem % 60}с"
+
+
+def render(job_id: str, p: Dict[str, str]) -> str:
+    """HTML-текст статуса по снимку прогресса."""
+    if not p:
+        return f"📊 Рассылка <code>#{job_id}</code>\n⏳ Ещё не началась"
+    total = int(p.get("total") or 0)
+    processed = int(p.get("processed") or 0)
+    pct = processed / total * 100 if total else 0.0
+    age = int(time.time()) - int(p.get("updated_at") or 0)
+    return (
+        f"📊 Рассылка <code>#{job_id}</code>\n"
+        f"Статус: <b>{p.get('status', '?')}</b>\n"
+        f"Прогресс: <b>{processed}</b>/{total} ({pct:.1f}%)\n"
+        f"├ ✅ {p.get('sent', 0)} ⚠️ {p.get('fallback', 0)} ❌ {p.get('failed', 0)}\n"
+        f"├ Скорость: <b>{float(p.get('rps') or 0):.1f}</b>/с (лимит {float(p.get('target_rps') or 0):.1f}/с)\n"
+        f"└ Осталось: <b>{_fmt_eta(p.get('eta_s', ''))}</b>\n"
+        f"🕒 обновлено {age} с назад"
+    )
@@ -0,0 +1,75 @@
+"""
+Защита от дублей генерации (двойной тап «перегенерировать», повторная отправка промта).
+
+Два слоя, оба до какой-либо работы с БД и KIE:
+
+1. in-flight маркер ``gen:inflight:{chat_id}:{fp}`` (SET NX) — живёт, пока
+   генерация с тем же отпечатком не доставлена (или до TTL);
+2. детерминированный ``_job_id`` ARQ из отпечатка и короткого окна времени —
+   ARQ не поставит задачу, если такая уже в очереди или выполняется.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import time
+from typing import List, Optional
+
+import orjson
+
+from core.config import settings
+from core.redis import get_redis
+from services.metrics import DEDUP_SUPPRESSED_TOTAL
+
+log = logging.getLogger("dedup")
+
+
+def generation_fingerprint(
+    chat_id: int,
+    prompt: str,
+    photos: List[str],
+    aspect_ratio: Optional[str],
+    image_resolution: str,
+    max_images: int,
+    seed: Optional[int],
+) -> str:
+    raw = orjson.dumps([chat_id, prompt.strip(), photos, aspect_ratio, image_resolution, max_images, seed])
+    return hashlib.sha256(raw).hexdigest()[:20]
+
+
+def generation_job_id(chat_id: int, fp: str) -> str:
+    bucket = int(time.time()) // settings.GEN_DEDUP_WINDOW_S
+    return f"gen:{chat_id}:{fp}:{bucket}"
+
+
+def _inflight_key(chat_id: int, fp: str) -> str:
+    return f"gen:inflight:{chat_id}:{fp}"
+
+
+async def claim_generation(chat_id: int, fp: str, cid: str) -> bool:
+    """False — такая же генерация уже в работе. При недоступном Redis пропускаем."""
+    try:
+        ok = await get_redis(settings.REDIS_DB_CACHE).set(
+            _inflight_key(chat_id, fp), cid, nx=True, ex=settings.GEN_DEDUP_INFLIGHT_TTL_S
+        )
+    except Exception:
+        log.warning("dedup.claim_failed", extra={"cid": cid, "chat_id": chat_id})
+        return True
+    if not ok:
+        suppressed("inflight", chat_id=chat_id, cid=cid)
+    return bool(ok)
+
+
+async def release_generation(chat_id: int, fp: Optional[str]) -> None:
+    """Снимает маркер: после доставки или ошибки можно запускать то же самое снова."""
+    if not fp:
+        return
+    try:
+        await get_redis(settings.REDIS_DB_CACHE).delete(_inflight_key(chat_id, fp))
+    except Exception:
+        pass
+
+
+def suppressed(layer: str, **fields) -> None:
+    DEDUP_SUPPRESSED_TOTAL.labels(layer).inc()
+    log.info("dedup.suppressed", extra={"layer": layer, **fields})
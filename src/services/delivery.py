@@ -0,0 +1,355 @@
+"""
+Доставка результата генерации (очередь delivery).
+
+Вебхук KIE только разбирает payload и ставит ``deliver_generation``;
+списание, скачивание и отправка в Telegram идут здесь, в отдельном
+пуле воркеров, и не держат HTTP-запрос.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import redis.asyncio as aioredis
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from sqlalchemy import select, update
+
+from bot.keyboards import kb_final_result
+from bot.states import CreateStates, GenStates
+from core.config import settings
+from core.fsm import get_fsm_storage
+from db.engine import SessionLocal
+from db.models import Task, User
+from services import segments
+from services.blobstore import blob_path, link_task, put_url
+from services.dedup import release_generation
+from services.metrics import DELIVERY_STAGE_SECONDS
+from services.telegram_safe import safe_send_document, safe_send_photo, safe_send_text
+from services.tracing import GenerationTrace
+
+log = logging.getLogger("delivery")
+
+MAX_RESULT_BYTES = 20 * 1024 * 1024
+
+
+async def _acquire_webhook_lock(task_id: str, ttl: int = 180) -> Optional[Tuple[aioredis.Redis, str]]:
+    r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
+    key = f"wb:lock:{task_id}"
+    try:
+        ok = await r.set(key, "1", nx=True, ex=ttl)
+        if ok:
+            return r, key
+        return None
+    except Exception:
+        try:
+            await r.aclose()
+        except Exception:
+            pass
+        return None
+
+async def _release_webhook_lock(lock: Optional[Tuple[aioredis.Redis, str]]) -> None:
+    if not lock:
+        return
+    r, key = lock
+    try:
+        await r.delete(key)
+    except Exception:
+        pass
+    finally:
+        try:
+            await r.aclose()
+        except Exception:
+            pass
+
+async def _clear_wait_and_reset(bot, chat_id: int, *, back_to: str = "auto") -> None:
+    """Снимает 'Генерирую…' и возвращает пользователя"""
+    me = await bot.get_me()
+    fsm = FSMContext(storage=get_fsm_storage(), key=StorageKey(me.id, chat_id, chat_id))
+
+    data = await fsm.get_data()
+    wait_id = data.get("wait_msg_id")
+    if wait_id:
+        try:
+            await bot.delete_message(chat_id, wait_id)
+        except Exception:
+            pass
+        await fsm.update_data(wait_msg_id=None)
+
+    mode = (data.get("mode") or "").lower()
+    target = back_to
+    if target == "auto":
+        target = "create" if mode == "create" else "edit"
+
+    if target == "create":
+        await fsm.update_data(mode="create", edits=[], photos=[])
+        await fsm.set_state(CreateStates.waiting_prompt)
+    else:
+        await fsm.set_state(GenStates.waiting_prompt)
+
+async def deliver_generation(
+    ctx: dict[str, Any],
+    task_id: str,
+    state: str,
+    result_urls: List[str],
+    seed: Optional[int] = None,
+    raw_state: Optional[str] = None,
+    fail_code: Optional[str] = None,
+    fail_msg: Optional[str] = None,
+    callback_at: Optional[float] = None,
+) -> Dict[str, Any]:
+    """✅ Доставка с защитой от двойного списания"""
+    bot: Bot = ctx["bot"]
+
+    trace = await GenerationTrace.load(task_id)
+    trace.mark("callback", at=callback_at)
+
+    lock = await _acquire_webhook_lock(task_id, ttl=180)
+    if lock is None:
+        log.info("delivery.skip_locked", extra={"cid": trace.cid, "task_id": task_id})
+        return {"ok": True, "skipped": "locked"}
+
+    try:
+        async with SessionLocal() as s:
+            task = (await s.execute(select(Task).where(Task.task_uuid == task_id))).scalar_one_or_none()
+            if not task:
+                log.info("delivery.no_task", extra={"task_id": task_id})
+                return {"ok": True, "skipped": "no_task"}
+
+            if getattr(task, "delivered", False):
+                log.info("delivery.already_delivered", extra={"task_id": task_id})
+                return {"ok": True, "skipped": "delivered"}
+
+            await s.execute(
+                update(Task)
+                .where(Task.id == task.id)
+                .values(status=state, credits_used=len(result_urls) if result_urls else 1, seed=str(seed) if seed else None)
+            )
+            await s.commit()
+
+            user = await s.get(User, task.user_id)
+
+            # ---- SUCCESS ----
+            if state == "completed":
+                if not result_urls:
+                    await _clear_wait_and_reset(bot, user.chat_id, back_to="auto")
+                    await safe_send_text(bot, user.chat_id, "⚠️ Произошла ошибка.\nНапишите в поддержку: @guard_gpt")
+                    await s.execute(update(Task).where(Task.id == task.id).values(delivered=True))
+                    await s.commit()
+                    log.info("delivery.completed.no_urls", extra={"task_id": task_id})
+                    return {"ok": True}
+
+                # 🆕 ИДЕМПОТЕНТНОСТЬ - проверка ПЕРЕД списанием
+                t_stage = time.perf_counter()
+                idempotency_key = f"credits:debited:{task_id}"
+                r_cache = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_CACHE)
+
+                try:
+                    already_debited = await r_cache.exists(idempotency_key)
+                    if already_debited:
+                        log.warning("delivery.already_debited", extra={"task_id": task_id})
+                    else:
+                        # СПИСЫВАЕМ только если ещё НЕ списано
+                        num_images = len(result_urls)
+                        before = int(user.balance_credits or 0)
+                        new_balance = max(0, before - num_images)
+                        await s.execute(
+                            update(User).where(User.id == user.id).values(balance_credits=new_balance)
+                        )
+                        await s.commit()
+                        await segments.set_balance(user.chat_id, new_balance)
+
+                        log.info("credits_deducted", extra={
+                            "task_id": task_id,
+                            "user_id": user.id,
+                            "images": num_images,
+                            "before": before,
+                            "after": new_balance,
+                        })
+
+                        # Ставим маркер "списано"
+                        await r_cache.setex(idempotency_key, 86400, "1")
+                finally:
+                    await r_cache.aclose()
+                DELIVERY_STAGE_SECONDS.labels("debit").observe(time.perf_counter() - t_stage)
+
+                # Скачивание файлов — сразу в хранилище (services.blobstore)
+                t_stage = time.perf_counter()
+                local_paths: List[str] = []
+                blob_keys: List[str] = []
+                download_errors = 0
+
+                async with httpx.AsyncClient(timeout=120) as client:
+                    for idx, image_url in enumerate(result_urls):
+                        last_exc = None
+                        for attempt in range(3):
+                            try:
+                                key = await put_url(image_url, max_bytes=MAX_RESULT_BYTES, client=client)
+                                blob_keys.append(key)
+                                local_paths.append(blob_path(key))
+                                last_exc = None
+                                break
+                            except ValueError:
+                                log.warning("delivery.image_too_large", extra={
+                                    "task_id": task_id,
+                                    "image_idx": idx,
+                                })
+                                download_errors += 1
+                                break
+                            except Exception as e:
+                                last_exc = e
+                                await asyncio.sleep(2)
+
+                        if last_exc:
+                            download_errors += 1
+                            log.warning("delivery.download_failed", extra={
+                                "task_id": task_id,
+                                "image_idx": idx,
+                                "error": str(last_exc),
+                            })
+
+                await link_task(task_id, blob_keys)
+                DELIVERY_STAGE_SECONDS.labels("download").observe(time.perf_counter() - t_stage)
+                trace.mark("download")
+
+                if download_errors == len(result_urls):
+                    await _clear_wait_and_reset(bot, user.chat_id, back_to="auto")
+                    await safe_send_text(bot, user.chat_id, "⚠️ Ошибка загрузки результатов.\nНапишите в поддержку: @guard_gpt")
+                    await s.execute(update(Task).where(Task.id == task.id).values(delivered=True))
+                    await s.commit()
+                    return {"ok": False, "error": "download_failed"}
+
+                t_stage = time.perf_counter()
+                await send_generation_result(
+                    user.chat_id,
+                    task_id,
+                    task.prompt,
+                    result_urls,
+                    local_paths,
+                    seed,
+                    bot,
+                    trace=trace,
+                )
+                DELIVERY_STAGE_SECONDS.labels("send").observe(time.perf_counter() - t_stage)
+                await trace.finish()
+
+                await s.execute(update(Task).where(Task.id == task.id).values(delivered=True))
+                await s.commit()
+
+                log.info("delivery.completed.sent", extra={
+                    "cid": trace.cid,
+                    "task_id": task_id,
+                    "images": len(result_urls),
+                    "seed": seed,
+                })
+
+                return {"ok": True}
+
+            # ---- FAILED ----
+            await _clear_wait_and_reset(bot, user.chat_id, back_to="auto")
+            error_msg = "⚠️ Не удалось сгенерировать изображение."
+            if fail_msg:
+                error_msg += f"\n\nПричина: {fail_msg[:200]}"
+            error_msg += "\n\nИзмените промт и попробуйте снова."
+
+            await safe_send_text(bot, user.chat_id, error_msg)
+            await s.execute(update(Task).where(Task.id == task.id).values(delivered=True))
+            await s.commit()
+
+            log.info("delivery.failed", extra={
+                "cid": trace.cid,
+                "task_id": task_id,
+                "raw_state": raw_state,
+                "fail_code": fail_code,
+                "fail_msg": fail_msg,
+            })
+
+            return {"ok": True}
+
+    finally:
+        await _release_webhook_lock(lock)
+        if trace.chat_id:
+            await release_generation(trace.chat_id, trace.fp)
+
+async def send_generation_result(
+    chat_id: int,
+    task_uuid: str,
+    prompt: str,
+    image_urls: List[str],
+    file_paths: List[str],
+    seed: Optional[int],
+    bot: Bot,
+    *,
+    trace: Optional[GenerationTrace] = None,
+) -> None:
+    """Отправка результатов генерации (файлы остаются в хранилище для «Отправить файл»)"""
+    bot_info = await bot.get_me()
+    state = FSMContext(storage=get_fsm_storage(), key=StorageKey(bot_info.id, chat_id, chat_id))
+
+    data = await state.get_data()
+    wait_msg_id = data.get("wait_msg_id")
+    if wait_msg_id:
+        try:
+            await bot.delete_message(chat_id, wait_msg_id)
+        except Exception:
+            pass
+        await state.update_data(wait_msg_id=None)
+
+    mode = (data.get("mode") or "edit").lower().strip()
+
+    # Отправка изображений
+    for idx, (img_url, fp) in enumerate(zip(image_urls, file_paths)):
+        caption = None
+        reply_markup = None
+        
+        if idx == len(image_urls) - 1:
+            caption = "<b>Если хотите что-то изменить или добавить напишите в чат ⬇️</b>"
+            reply_markup = kb_final_result()
+        
+        await safe_send_photo(bot, chat_id, img_url, caption=caption, reply_markup=reply_markup)
+        if trace and idx == 0:
+            trace.mark("first_photo")
+    
+    # Отправка файлов в максимальном качестве
+    for fp in file_paths:
+        if os.path.exists(fp):
+            await safe_send_document(bot, chat_id, fp, caption="Скачать в максимальном качестве")
+    if trace:
+        trace.mark("last_document")
+    
+    if mode == "create_edit":
+        mode = "create"
+
+    if mode == "create":
+        await state.update_data(
+            mode="create",
+            prompt=prompt,
+            last_result_urls=image_urls,
+            last_task_uuid=task_uuid,
+            wait_msg_id=None,
+            last_seed=seed,
+        )
+        await state.set_state(CreateStates.final_menu)
+        return
+
+    photos = data.get("photos", [])
+    base_prompt = data.get("base_prompt") or prompt
+    edits = data.get("edits") or []
+    aspect_ratio = data.get("aspect_ratio", "9:16")
+    
+    await state.update_data(
+        mode="edit",
+        prompt=prompt,
+        base_prompt=base_prompt,
+        edits=edits,
+        photos=photos,
+        last_task_uuid=task_uuid,
+        last_seed=seed,
+        aspect_ratio=aspect_ratio,
+    )
+    await state.set_state(GenStates.final_menu)
@@ -0,0 +1,131 @@
+"""
+Периодическая очистка Redis и хранилища файлов (очередь maintenance).
+
+Раньше жила только в cleanup_redis.py (отдельный контейнер с sleep-циклом);
+теперь это cron-задача MaintenanceWorker, скрипт остался для ручного запуска.
+
+Обход ключей инкрементальный: за запуск — не больше SWEEP_MAX_KEYS_PER_RUN
+ключей, курсор SCAN сохраняется в Redis, TTL проверяются и ставятся пачками
+через pipeline, между пачками пауза под SWEEP_KEYS_PER_S.
+
+Новые FSM ключи получают TTL при записи (core.fsm), так что для fsm:*
+обход лишь добирает старые ключи без TTL.
+
+⚠️ ВАЖНО: НЕ УДАЛЯЕТ FSM состояния!
+Только ставит TTL (FSM_TTL_S) для ключей БЕЗ TTL.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, Tuple
+
+from core.config import settings
+from core.redis import get_redis
+from services.blobstore import evict
+
+log = logging.getLogger("cleanup")
+
+
+def _cursor_key(db: int, pattern: str) -> str:
+    return f"maint:cursor:{db}:{pattern}"
+
+
+async def _sweep(db: int, pattern: str, *, ttl: int = 0) -> Tuple[int, int]:
+    """
+    Срез обхода ключей pattern без TTL (TTL == -1): при ttl > 0 ставит TTL,
+    иначе удаляет ключ. Возвращает (проверено, исправлено).
+    """
+    r = get_redis(db)
+    meta = get_redis(settings.REDIS_DB_CACHE)
+    cursor_key = _cursor_key(db, pattern)
+    cursor = int(await meta.get(cursor_key) or 0)
+
+    checked = fixed = 0
+    while True:
+        cursor, keys = await r.scan(cursor, match=pattern, count=settings.SWEEP_SCAN_COUNT)
+        if keys:
+            async with r.pipeline(transaction=False) as p:
+                for key in keys:
+                    p.ttl(key)
+                ttls = await p.execute()
+
+            # -1 = нет TTL (ключ висит вечно), -2 = ключ уже исчез
+            stale = [k for k, t in zip(keys, ttls) if t == -1]
+            if stale:
+                async with r.pipeline(transaction=False) as p:
+                    for key in stale:
+                        if ttl > 0:
+                            p.expire(key, ttl, nx=True)  # TTL появился между проверкой и записью — не трогаем
+                        else:
+                            p.delete(key)
+                    await p.execute()
+
+            checked += len(keys)
+            fixed += len(stale)
+            await asyncio.sleep(len(keys) / max(1, settings.SWEEP_KEYS_PER_S))
+        if cursor == 0 or checked >= settings.SWEEP_MAX_KEYS_PER_RUN:
+            break
+
+    await meta.set(cursor_key, cursor)
+    return checked, fixed
+
+
+async def cleanup_fsm_old_states():
+    """
+    TTL для старых FSM ключей, записанных до state_ttl/data_ttl.
+
+    ⚠️ НЕ УДАЛЯЕТ FSM! Только ставит TTL для ключей без TTL.
+
+    FSM ключи имеют формат: fsm:{bot_id}:{chat_id}:{chat_id}:state
+    """
+    try:
+        checked, fixed = await _sweep(settings.REDIS_DB_FSM, "fsm:*", ttl=settings.FSM_TTL_S)
+        log.info("maintenance.fsm_sweep_done", extra={"checked": checked, "ttl_set": fixed})
+    except Exception as e:
+        log.error("maintenance.fsm_sweep_failed", extra={"error": str(e)})
+
+
+async def cleanup_blob_store():
+    """LRU-вытеснение файлов хранилища сверх BLOB_STORE_MAX_BYTES (без обхода каталога)"""
+    try:
+        evicted = await evict()
+        log.info("maintenance.blob_evicted", extra={"evicted": evicted})
+    except Exception as e:
+        log.error("maintenance.blob_evict_failed", extra={"error": str(e)})
+
+
+async def cleanup_old_redis_markers():
+    """
+    Очистка зависших маркеров в REDIS_DB_CACHE (они всегда ставятся с TTL,
+    ключ без TTL — мусор):
+    - wb:lock:* (блокировки доставки)
+    - task:pending:*
+    """
+    deleted = 0
+    for pattern in ("wb:lock:*", "task:pending:*"):
+        try:
+            _, fixed = await _sweep(settings.REDIS_DB_CACHE, pattern)
+            deleted += fixed
+        except Exception as e:
+            log.error("maintenance.markers_sweep_failed", extra={"pattern": pattern, "error": str(e)})
+    log.info("maintenance.markers_sweep_done", extra={"deleted": deleted})
+
+
+async def run_cleanup() -> None:
+    t0 = time.perf_counter()
+    log.info("maintenance.cleanup_started")
+
+    await cleanup_fsm_old_states()
+    await cleanup_blob_store()
+    await cleanup_old_redis_markers()
+
+    log.info("maintenance.cleanup_done", extra={"duration_ms": int((time.perf_counter() - t0) * 1000)})
+
+
+async def cleanup_redis(ctx: dict[str, Any]) -> None:
+    """Cron-задача очереди maintenance (каждые 5 минут, по срезу ключей)"""
+    await cleanup_fsm_old_states()
+    await cleanup_old_redis_markers()
+    await cleanup_blob_store()
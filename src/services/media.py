@@ -0,0 +1,87 @@
+"""
+Раздача входных фото для KIE без токена бота в ссылке.
+
+Воркер один раз скачивает файл Telegram (по file_id) в хранилище
+services.blobstore и отдаёт KIE подписанную истекающую ссылку
+``{PUBLIC_BASE_URL}/media/{sha}{ext}?e=..&s=..``. Саму ссылку обслуживает
+web/routes/media.py (Range, ETag).
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from core.config import settings
+from core.redis import get_redis
+from services.blobstore import blob_path, put_url
+
+log = logging.getLogger("media")
+
+_TG_INDEX_TTL_S = 86400
+
+_download_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _signing_key() -> bytes:
+    return (settings.MEDIA_SIGNING_KEY or settings.WEBHOOK_SECRET_TOKEN).encode()
+
+
+def _signature(key: str, expires: int) -> str:
+    return hmac.new(_signing_key(), f"{key}:{expires}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def signed_url(key: str, ttl: Optional[int] = None) -> str:
+    expires = int(time.time()) + (ttl or settings.MEDIA_URL_TTL_S)
+    base = settings.PUBLIC_BASE_URL.rstrip("/")
+    return f"{base}/media/{key}?e={expires}&s={_signature(key, expires)}"
+
+
+def verify_signature(key: str, expires: str, sig: str) -> bool:
+    try:
+        exp = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if exp < time.time():
+        return False
+    return hmac.compare_digest(_signature(key, exp), sig or "")
+
+
+async def ingest_tg_file(file_id: str, file_path: str, *, max_bytes: int) -> str:
+    """
+    Ключ блоба для файла Telegram; скачивает не больше одного раза на file_id
+    (индекс ``media:tg:{file_id}`` в Redis + lock внутри процесса).
+    """
+    r = get_redis(settings.REDIS_DB_CACHE)
+    index_key = f"media:tg:{file_id}"
+
+    lock = _download_locks.setdefault(file_id, asyncio.Lock())
+    async with lock:
+        try:
+            cached = await r.get(index_key)
+        except Exception:
+            cached = None
+        if cached:
+            key = cached.decode()
+            path = blob_path(key)
+            if path and os.path.exists(path):
+                return key
+
+        url = f"{settings.TELEGRAM_FILE_BASE.rstrip('/')}/bot{settings.TELEGRAM_BOT_TOKEN}/{file_path}"
+        t0 = time.perf_counter()
+        key = await put_url(url, max_bytes=max_bytes)
+        log.info("media.ingested", extra={
+            "file_id": file_id,
+            "key": key,
+            "ms": round((time.perf_counter() - t0) * 1000),
+        })
+        try:
+            await r.set(index_key, key, ex=_TG_INDEX_TTL_S)
+        except Exception:
+            pass
+    _download_locks.pop(file_id, None)
+    return key
@@ -0,0 +1,136 @@
+"""
+Prometheus-метрики веб-приложения и ARQ-воркера.
+
+Веб отдаёт их на ``GET /metrics``, воркер — через собственный HTTP-экспортер
+(``WORKER_METRICS_PORT``). У каждого процесса свой registry.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from prometheus_client import Counter, Gauge, Histogram
+
+from db.engine import DB_ACQUIRE_SECONDS  # noqa: F401 — объявлена в db-слое
+
+# Бакеты под наши задержки: от быстрых Redis/MySQL до многосекундных скачиваний 4K
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_JOB_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600, 14400)
+
+SEEDREAM_CALLBACK_SECONDS = Histogram(
+    "seedream_callback_seconds",
+    "Длительность обработки вебхука /webhook/seedream",
+    ["status"],
+    buckets=_LATENCY_BUCKETS,
+)
+DELIVERY_STAGE_SECONDS = Histogram(
+    "delivery_stage_seconds",
+    "Длительность этапов доставки результата (debit/download/send)",
+    ["stage"],
+    buckets=_LATENCY_BUCKETS,
+)
+VOICE_STAGE_SECONDS = Histogram(
+    "voice_stage_seconds",
+    "Длительность этапов распознавания голоса (download/transcribe)",
+    ["stage"],
+    buckets=_LATENCY_BUCKETS,
+)
+YOOKASSA_REQUEST_SECONDS = Histogram(
+    "yookassa_request_seconds",
+    "Задержка запросов к API YooKassa",
+    ["op", "status"],
+    buckets=_LATENCY_BUCKETS,
+)
+SEEDREAM_REQUEST_SECONDS = Histogram(
+    "seedream_request_seconds",
+    "Задержка запросов SeedreamClient к KIE.ai",
+    ["op", "status"],
+    buckets=_LATENCY_BUCKETS,
+)
+TELEGRAM_REQUEST_SECONDS = Histogram(
+    "telegram_request_seconds",
+    "Задержка запросов к Telegram Bot API",
+    ["method"],
+    buckets=_LATENCY_BUCKETS,
+)
+
+ARQ_QUEUE_DEPTH = Gauge("arq_queue_depth", "Число задач в очереди ARQ", ["queue"])
+ARQ_QUEUE_WAIT_SECONDS = Histogram(
+    "arq_queue_wait_seconds",
+    "Ожидание задачи в очереди ARQ до старта",
+    ["queue"],
+    buckets=_LATENCY_BUCKETS,
+)
+ARQ_JOBS_IN_FLIGHT = Gauge("arq_jobs_in_flight", "Задачи ARQ в работе в этом воркере")
+WATCHDOG_ACTIONS_TOTAL = Counter(
+    "arq_watchdog_actions_total",
+    "Задачи ARQ дольше бюджета: flagged — помечена, aborted — отменена",
+    ["function", "action"],
+)
+ARQ_JOB_SECONDS = Histogram(
+    "arq_job_seconds",
+    "Длительность задач ARQ",
+    ["function", "outcome"],
+    buckets=_JOB_BUCKETS,
+)
+
+BROADCAST_SENDS_TOTAL = Counter("broadcast_sends_total", "Отправки рассылки", ["result"])
+RATE_LIMITED_TOTAL = Counter("rate_limited_total", "Ответы 429 от внешних API", ["source"])
+THROTTLED_UPDATES_TOTAL = Counter(
+    "throttled_updates_total",
+    "Апдейты, отсечённые лимитом частоты (redis — отказ GCRA, local — повтор до retry_after)",
+    ["event", "source"],
+)
+RETRIES_TOTAL = Counter("retries_total", "Повторные попытки запросов", ["component"])
+DEDUP_SUPPRESSED_TOTAL = Counter(
+    "dedup_suppressed_total",
+    "Подавленные дубли генерации (inflight — маркер чата, job_id — ARQ)",
+    ["layer"],
+)
+REFUNDS_TOTAL = Counter("refunds_total", "Возвраты кредитов", ["reason"])
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии aiogram: задержка по методу Bot API + учёт 429."""
+
+    async def __call__(
+        self,
+        make_request: Callable[[Bot, TelegramMethod], Awaitable[Any]],
+        bot: Bot,
+        method: TelegramMethod,
+    ):
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            RATE_LIMITED_TOTAL.labels("telegram").inc()
+            raise
+        finally:
+            TELEGRAM_REQUEST_SECONDS.labels(type(method).__name__).observe(time.perf_counter() - t0)
+
+
+def track_job(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Оборачивает функцию ARQ-задачи: длительность + исход. Имя задачи сохраняется."""
+
+    @functools.wraps(func)
+    async def wrapper(ctx: dict, *args, **kwargs):
+        t0 = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await func(ctx, *args, **kwargs)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            ARQ_JOB_SECONDS.labels(func.__name__, outcome).observe(time.perf_counter() - t0)
+
+    return wrapper
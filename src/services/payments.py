@@ -1,25 +1,23 @@
 # services/payments.py (фрагмент)
 from __future__ import annotations
-from uuid import uuid4
 import logging
+from datetime import datetime, timedelta
 from decimal import Decimal
-from typing import Optional
-from requests.exceptions import HTTPError
-from aiogram import Bot
-from yookassa import Configuration, Payment
-from yookassa.domain.exceptions.api_error import ApiError
-from sqlalchemy import select
+from typing import Any, Optional
+from uuid import uuid4
+import httpx
+from sqlalchemy import select, update
 
 from core.config import settings
 from db.engine import SessionLocal
 from db.models import Payment as PayModel, User
+from services import segments
 from services.pricing import credits_for_rub
+from services.telegram_safe import safe_send_text
+from vendors.yookassa import YooKassaError, get_yookassa
 
 log = logging.getLogger("payments")
 
-Configuration.account_id = settings.YOOKASSA_SHOP_ID
-Configuration.secret_key = settings.YOOKASSA_SECRET_KEY
-
 TECH_EMAIL = "no-reply@nanobanana.app"
 YOOKASSA_TAX_SYSTEM_CODE = getattr(settings, "YOOKASSA_TAX_SYSTEM_CODE", 2) 
 YOOKASSA_VAT_CODE = getattr(settings, "YOOKASSA_VAT_CODE", 1)               
@@ -61,96 +59,204 @@ async def create_topup_payment(chat_id: int, rub_amount: int) -> str:
         user: User = (await s.execute(select(User).where(User.chat_id == chat_id))).scalar_one()
         pay = PayModel(user_id=user.id, rub_amount=rub_amount, amount=credits, status="pending")
         s.add(pay)
+        # резервируем строку (id нужен для description); соединение уходит в пул до ответа YooKassa
         await s.commit()
-        await s.refresh(pay)
-
-    description = f"Topup chat:{chat_id} payment:{pay.id}"
-    if len(description) > 128:
-        description = description[:128]
-
-    email_used = user.email if (user.email and not user.receipt_opt_out) else TECH_EMAIL
-    plan = f"{rub_amount} ₽ → {credits} генераций"
-    receipt = _build_receipt(email=email_used, plan=plan, amount_rub=rub_amount)
-
-    body = {
-        "amount": {"value": f"{rub_amount:.2f}", "currency": "RUB"},
-        "confirmation": {"type": "redirect", "return_url": settings.TOPUP_RETURN_URL},
-        "capture": True,
-        "description": description,
-        "receipt": receipt, 
-        # "payment_method_data": {"type": "bank_card"},  # при желании зафиксировать метод
-    }
 
-    # 3) создаём платёж
-    idem_key = str(uuid4())
-    try:
-        p = Payment.create(body, idem_key)
-    except ApiError as e:
-        log.error(
-            "YooKassa ApiError: type=%s code=%s param=%s desc=%s details=%s body=%s",
-            getattr(e, "type", None),
-            getattr(e, "code", None),
-            getattr(e, "parameter", None),
-            getattr(e, "description", str(e)),
-            getattr(e, "details", None),
-            body,
-        )
-        raise
-    except HTTPError as e:
-        resp = getattr(e, "response", None)
-        log.error(
-            "YooKassa HTTPError: status=%s reason=%s body=%s request_body=%s",
-            getattr(resp, "status_code", None),
-            getattr(resp, "reason", None),
-            getattr(resp, "text", None),
-            body,
-        )
-        raise
-    except Exception:
-        log.exception("YooKassa create() failed (unknown)")
-        raise
+        description = f"Topup chat:{chat_id} payment:{pay.id}"
+        if len(description) > 128:
+            description = description[:128]
 
-    async with SessionLocal() as s:
-        dbp = await s.get(PayModel, pay.id)
-        dbp.ext_payment_id = p.id
-        dbp.confirmation_url = p.confirmation.confirmation_url
+        email_used = user.email if (user.email and not user.receipt_opt_out) else TECH_EMAIL
+        plan = f"{rub_amount} ₽ → {credits} генераций"
+        receipt = _build_receipt(email=email_used, plan=plan, amount_rub=rub_amount)
+
+        body = {
+            "amount": {"value": f"{rub_amount:.2f}", "currency": "RUB"},
+            "confirmation": {"type": "redirect", "return_url": settings.TOPUP_RETURN_URL},
+            "capture": True,
+            "description": description,
+            "receipt": receipt, 
+            # "payment_method_data": {"type": "bank_card"},  # при желании зафиксировать метод
+        }
+
+        # создаём платёж (повторы внутри клиента — с тем же idem_key)
+        idem_key = str(uuid4())
+        try:
+            p = await get_yookassa().create_payment(body, idem_key)
+        except YooKassaError as e:
+            log.error(
+                "YooKassa ApiError: status=%s type=%s code=%s param=%s desc=%s body=%s",
+                e.status,
+                e.type,
+                e.code,
+                e.parameter,
+                e.description,
+                body,
+            )
+            await _mark_failed(s, pay.id)
+            raise
+        except httpx.HTTPError as e:
+            log.error("YooKassa HTTPError: %r request_body=%s", e, body)
+            raise
+        except Exception:
+            log.exception("YooKassa create() failed (unknown)")
+            raise
+
+        # один UPDATE по первичному ключу, без повторного SELECT
+        confirmation_url = p["confirmation"]["confirmation_url"]
+        await s.execute(
+            update(PayModel)
+            .where(PayModel.id == pay.id)
+            .values(ext_payment_id=p["id"], confirmation_url=confirmation_url)
+        )
         await s.commit()
 
-    return p.confirmation.confirmation_url
+    return confirmation_url
 
 
+async def _mark_failed(s, pay_id: int) -> None:
+    try:
+        await s.execute(
+            update(PayModel).where(PayModel.id == pay_id, PayModel.status == "pending").values(status="failed")
+        )
+        await s.commit()
+    except Exception:
+        log.warning("payments.mark_failed_error", extra={"payment_id": pay_id})
+
 
 async def handle_yookassa_webhook(payload: dict):
     if payload.get("event") != "payment.succeeded":
         return
+    await apply_payment_succeeded(payload["object"]["id"])
+
 
-    ext_id = payload["object"]["id"]
+async def apply_payment_succeeded(ext_id: str) -> bool:
+    """
+    Зачисляет оплаченный платёж (вебхук или сверка). False — не найден или уже зачислен.
 
+    Дубли вебхука разводит БД: условный UPDATE статуса берёт блокировку строки,
+    второй такой же запрос ждёт commit и уже ничего не меняет; баланс
+    увеличивается атомарно в той же транзакции.
+    """
     async with SessionLocal() as s:
         pay = (await s.execute(
-            select(PayModel).where(PayModel.ext_payment_id == ext_id)
-        )).scalar_one_or_none()
+            select(PayModel.id, PayModel.user_id, PayModel.amount, PayModel.rub_amount, PayModel.status)
+            .where(PayModel.ext_payment_id == ext_id)
+        )).one_or_none()
 
         if not pay or pay.status == "succeeded":
-            return
+            return False
 
-        pay.status = "succeeded"
-        user = await s.get(User, pay.user_id)
-        user.balance_credits += int(pay.amount)
+        res = await s.execute(
+            update(PayModel)
+            .where(PayModel.id == pay.id, PayModel.status != "succeeded")
+            .values(status="succeeded")
+        )
+        if res.rowcount != 1:
+            await s.rollback()
+            return False
+
+        await s.execute(
+            update(User)
+            .where(User.id == pay.user_id)
+            .values(balance_credits=User.balance_credits + int(pay.amount))
+        )
+        chat_id = await s.scalar(select(User.chat_id).where(User.id == pay.user_id))
         await s.commit()
 
+    log.info("payments.credited", extra={"payment_id": pay.id, "chat_id": chat_id, "credits": int(pay.amount)})
+    await segments.mark_paid(chat_id)
+    await _enqueue_payment_notice(chat_id, float(pay.rub_amount), int(pay.amount), pay.id)
+    return True
+
+
+async def _enqueue_payment_notice(chat_id: int, rub_amount: float, credits: int, payment_id: int) -> None:
+    # services.queue импортирует этот модуль (reconcile_payments), поэтому импорт здесь
+    from services.queue import QUEUE_DELIVERY, get_arq_pool
+
+    try:
+        pool = await get_arq_pool()
+        await pool.enqueue_job(
+            "notify_payment", chat_id, rub_amount, credits,
+            _job_id=f"paynotify:{payment_id}",
+            _queue_name=QUEUE_DELIVERY,
+        )
+    except Exception:
+        log.exception("payments.notify_enqueue_failed", extra={"payment_id": payment_id, "chat_id": chat_id})
+
+
+async def notify_payment(ctx: dict[str, Any], chat_id: int, rub_amount: float, credits: int) -> None:
+    """Сообщение об оплате (очередь delivery, общий Bot воркера)"""
     text = (
-        f"Платёж на {pay.rub_amount:.2f}₽ прошёл успешно!✅ \n"
-        f"Баланс пополнен на {pay.amount} генераций.\n\n"
+        f"Платёж на {rub_amount:.2f}₽ прошёл успешно!✅ \n"
+        f"Баланс пополнен на {credits} генераций.\n\n"
         "Теперь попробуйте:\n"
         "1️⃣ /edit или /create — начать генерацию\n"
         "3️⃣ Опишите желаемый результат\n\n"
         "✅ Бот пришлёт готовое фото!"
     )
+    await safe_send_text(ctx["bot"], chat_id, text)
 
-    bot = Bot(token=settings.TELEGRAM_BOT_TOKEN)
-    try:
-        await bot.send_message(user.chat_id, text)
-    finally:
-        await bot.session.close()
 
+# статусы YooKassa → статусы в таблице payments
+_YK_STATUS = {"canceled": "canceled", "waiting_for_capture": "awaiting_capture"}
+
+
+async def reconcile_payments(ctx: dict[str, Any]) -> None:
+    """
+    Сверка зависших pending-платежей с YooKassa (очередь maintenance): если
+    вебхук потерялся, деньги пользователя всё равно зачисляются.
+    """
+    now = datetime.utcnow()
+    older = now - timedelta(minutes=settings.PAYMENT_RECONCILE_AFTER_MIN)
+    newer = now - timedelta(hours=settings.PAYMENT_RECONCILE_MAX_AGE_H)
+
+    async with SessionLocal() as s:
+        rows = (await s.execute(
+            select(PayModel.id, PayModel.ext_payment_id)
+            .where(PayModel.status == "pending", PayModel.created_at < older, PayModel.created_at > newer)
+            .order_by(PayModel.id)
+            .limit(settings.PAYMENT_RECONCILE_BATCH)
+        )).all()
+
+        # ссылку пользователь так и не получил — оплатить такой платёж нельзя
+        orphans = [r.id for r in rows if not r.ext_payment_id]
+        if orphans:
+            await s.execute(
+                update(PayModel).where(PayModel.id.in_(orphans), PayModel.status == "pending").values(status="failed")
+            )
+            await s.commit()
+
+    credited = closed = 0
+    for row in rows:
+        if not row.ext_payment_id:
+            continue
+        try:
+            p = await get_yookassa().get_payment(row.ext_payment_id)
+        except Exception as e:
+            log.warning("payments.reconcile_fetch_failed", extra={"payment_id": row.id, "error": str(e)})
+            continue
+
+        status = p.get("status")
+        if status == "succeeded":
+            try:
+                if await apply_payment_succeeded(row.ext_payment_id):
+                    credited += 1
+            except Exception:
+                log.exception("payments.reconcile_apply_failed", extra={"payment_id": row.id})
+        elif status in _YK_STATUS:
+            async with SessionLocal() as s:
+                await s.execute(
+                    update(PayModel)
+                    .where(PayModel.id == row.id, PayModel.status == "pending")
+                    .values(status=_YK_STATUS[status])
+                )
+                await s.commit()
+            closed += 1
+
+    log.info("payments.reconciled", extra={
+        "checked": len(rows),
+        "credited": credited,
+        "closed": closed,
+        "orphans": len(orphans),
+    })
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import functools
 import logging
-from typing import Any, Dict, List, Optional
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 import httpx
 import redis.asyncio as aioredis
@@ -10,41 +12,143 @@ from aiogram import Bot
 from aiogram.exceptions import TelegramForbiddenError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.base import StorageKey
-from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
-from arq import create_pool
+from arq import ArqRedis, create_pool
 from arq.connections import RedisSettings
+from arq.cron import cron
+from prometheus_client import start_http_server
 from sqlalchemy import select, update
 from sqlalchemy.exc import OperationalError
 from uuid import uuid4
 
 from core.config import settings
+from core.fsm import get_fsm_storage
+from core.fsm_storage import flush_buffered
+from core.logging import configure_json_logging
 from db.engine import SessionLocal
 from db.models import Task, User
 from services.pricing import CREDITS_PER_GENERATION
 from vendors.seedream import SeedreamClient, SeedreamError
+from vendors.yookassa import close_yookassa
 from services.broadcast import broadcast_send
+from services.broadcast_log import prune_deliveries
+from services import segments
+from services.segments import rebuild_segments
+from services.dedup import claim_generation, generation_fingerprint, generation_job_id, release_generation, suppressed
+from services.delivery import deliver_generation
+from services.maintenance import cleanup_redis
+from services.payments import notify_payment, reconcile_payments
+from services.voice import transcribe_voice
+from services.metrics import ARQ_QUEUE_WAIT_SECONDS, REFUNDS_TOTAL, TelegramMetricsMiddleware
+from services.media import ingest_tg_file, signed_url
+from services.tg_files import resolve_tg_files
+from services.tracing import trace_start
+from services.workers import heartbeat_loop, heartbeat_stop, job_function, tracked
 
 log = logging.getLogger("worker")
 
-def _j(event: str, **fields) -> str:
-    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+# Именованные очереди ARQ: у каждой свой пул воркеров и свой max_jobs,
+# чтобы многочасовая рассылка не занимала слоты интерактивных генераций
+QUEUE_GENERATION = "arq:generation"
+QUEUE_DELIVERY = "arq:delivery"
+QUEUE_BROADCAST = "arq:broadcast"
+QUEUE_MAINTENANCE = "arq:maintenance"
+QUEUES = (QUEUE_GENERATION, QUEUE_DELIVERY, QUEUE_BROADCAST, QUEUE_MAINTENANCE)
 
-async def _tg_file_to_url(bot: Bot, file_id: str, *, cid: str) -> str:
-    """Возвращает публичный URL файла Telegram"""
-    f = await bot.get_file(file_id)
-    file_path = f.file_path
-    file_size = getattr(f, "file_size", None) or 0
+QUEUE_MAX_JOBS = {
+    QUEUE_GENERATION: settings.WORKER_MAX_JOBS_GENERATION,
+    QUEUE_DELIVERY: settings.WORKER_MAX_JOBS_DELIVERY,
+    QUEUE_BROADCAST: settings.WORKER_MAX_JOBS_BROADCAST,
+    QUEUE_MAINTENANCE: settings.WORKER_MAX_JOBS_MAINTENANCE,
+}
 
-    if file_size > 10 * 1024 * 1024:
-        log.error(_j("queue.image_too_large", cid=cid, size=file_size))
-        raise ValueError("image too large")
+_REDIS_SETTINGS = RedisSettings(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    database=settings.REDIS_DB_CACHE,
+    password=settings.REDIS_PASSWORD,
+)
 
-    lower = (file_path or "").lower()
-    if not any(lower.endswith(ext) for ext in [".png", ".jpg", ".jpeg", ".webp"]):
-        log.error(_j("queue.image_unsupported_ext", cid=cid, file_path=file_path))
-        raise ValueError("unsupported image ext")
+_arq_pool: Optional[ArqRedis] = None
 
-    return f"https://api.telegram.org/file/bot{settings.TELEGRAM_BOT_TOKEN}/{file_path}"
+
+async def get_arq_pool() -> ArqRedis:
+    """Общий на процесс пул ARQ для постановки задач"""
+    global _arq_pool
+    if _arq_pool is None:
+        _arq_pool = await create_pool(_REDIS_SETTINGS)
+    return _arq_pool
+
+
+async def close_arq_pool() -> None:
+    global _arq_pool
+    if _arq_pool is not None:
+        try:
+            await _arq_pool.aclose()
+        except Exception:
+            pass
+        _arq_pool = None
+
+MAX_INPUT_IMAGES = 10
+MAX_INPUT_IMAGE_BYTES = 10 * 1024 * 1024
+_INPUT_IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+async def _prepare_image_urls(
+    bot: Bot, photos: List[str], *, cid: str
+) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """
+    Готовит входные фото для KIE: все file_id резолвятся разом (кэш + getFile
+    параллельно с ограничением), затем размер и расширение проверяются пачкой,
+    файлы скачиваются в локальный кэш и отдаются KIE подписанными ссылками
+    /media/... — токен бота наружу не уходит.
+    Возвращает URL-ы в исходном порядке и ошибки по элементам
+    ``{"idx", "file_id", "error"}`` — частичный результат тоже годится.
+    """
+    items = photos[:MAX_INPUT_IMAGES]
+    is_url = [isinstance(i, str) and i.startswith("http") for i in items]
+    tg_files = await resolve_tg_files(
+        bot,
+        [i for i, u in zip(items, is_url) if not u],
+        concurrency=settings.TG_GETFILE_CONCURRENCY,
+    )
+
+    slots: List[Optional[str]] = [None] * len(items)
+    errors: List[Dict[str, Any]] = []
+    to_ingest: List[Tuple[int, str, str]] = []
+    for idx, (item, url) in enumerate(zip(items, is_url)):
+        if url:
+            slots[idx] = item
+            continue
+        info = tg_files.get(item)
+        if info is None or isinstance(info, Exception):
+            errors.append({"idx": idx, "file_id": item, "error": f"get_file: {info}"})
+            continue
+        file_path, file_size = info
+        if file_size > MAX_INPUT_IMAGE_BYTES:
+            errors.append({"idx": idx, "file_id": item, "error": "too_large", "size": file_size})
+        elif not (file_path or "").lower().endswith(_INPUT_IMAGE_EXTS):
+            errors.append({"idx": idx, "file_id": item, "error": "unsupported_ext", "file_path": file_path})
+        else:
+            to_ingest.append((idx, item, file_path))
+
+    sem = asyncio.Semaphore(max(1, settings.TG_GETFILE_CONCURRENCY))
+
+    async def _ingest(file_id: str, file_path: str) -> str:
+        async with sem:
+            return await ingest_tg_file(file_id, file_path, max_bytes=MAX_INPUT_IMAGE_BYTES)
+
+    keys = await asyncio.gather(*(_ingest(fid, fp) for _, fid, fp in to_ingest), return_exceptions=True)
+    for (idx, file_id, _), key in zip(to_ingest, keys):
+        if isinstance(key, BaseException):
+            errors.append({"idx": idx, "file_id": file_id, "error": f"download: {key}"})
+        else:
+            slots[idx] = signed_url(key)
+
+    urls = [u for u in slots if u]
+    errors.sort(key=lambda e: e["idx"])
+    if errors:
+        log.warning("queue.images.prepare_errors", extra={"cid": cid, "errors": errors})
+    return urls, errors
 
 async def enqueue_generation(
     chat_id: int, 
@@ -54,50 +158,142 @@ async def enqueue_generation(
     image_resolution: str = "1K",
     max_images: int = 1,
     seed: Optional[int] = None
-) -> None:
-    """Ставит в очередь генерацию изображения"""
-    log.info(_j("enqueue_generation", chat_id=chat_id, prompt_len=len(prompt), 
-               photos_count=len(photos), resolution=image_resolution, max_images=max_images))
-    
-    redis_pool = await create_pool(
-        RedisSettings(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            database=settings.REDIS_DB_CACHE,
+) -> bool:
+    """Ставит в очередь генерацию изображения. False — это дубль, подавлен."""
+    # cid живёт от постановки в очередь до доставки (см. services.tracing)
+    cid = uuid4().hex[:12]
+    fp = generation_fingerprint(chat_id, prompt, photos, aspect_ratio, image_resolution, max_images, seed)
+    if not await claim_generation(chat_id, fp, cid):
+        return False
+    log.info("enqueue_generation", extra={
+        "cid": cid,
+        "chat_id": chat_id,
+        "prompt_len": len(prompt),
+        "photos_count": len(photos),
+        "resolution": image_resolution,
+        "max_images": max_images,
+    })
+
+    try:
+        # wait_msg_id и прочее из хендлера должны быть в Redis до старта воркера
+        await flush_buffered()
+
+        redis_pool = await get_arq_pool()
+        job = await redis_pool.enqueue_job(
+            "process_generation", 
+            chat_id, 
+            prompt, 
+            photos, 
+            aspect_ratio,
+            image_resolution,
+            max_images,
+            seed,
+            cid=cid,
+            enqueued_at=time.time(),
+            fp=fp,
+            _job_id=generation_job_id(chat_id, fp),
+            _queue_name=QUEUE_GENERATION,
         )
-    )
-    
-    job = await redis_pool.enqueue_job(
-        "process_generation", 
-        chat_id, 
-        prompt, 
-        photos, 
-        aspect_ratio,
-        image_resolution,
-        max_images,
-        seed
-    )
-    
-    log.info(_j("enqueue_generation.success", chat_id=chat_id, job_id=str(job.job_id) if job else None))
+    except Exception:
+        # задача не поставлена — маркер не должен держать повтор весь TTL
+        await release_generation(chat_id, fp)
+        raise
+    if job is None:
+        # маркер мог истечь, а задача ещё в очереди — её и ждём
+        suppressed("job_id", chat_id=chat_id, cid=cid)
+        return False
+
+    log.info("enqueue_generation.success", extra={
+        "cid": cid,
+        "chat_id": chat_id,
+        "job_id": job.job_id,
+    })
+    return True
+
+GENERATION_DUPLICATE_TEXT = "⏳ Эта генерация уже запущена — результат придёт в этот чат."
+
+
+async def undo_duplicate_start(
+    bot: Bot,
+    chat_id: int,
+    wait_msg_id: Optional[int],
+    state: Optional[FSMContext] = None,
+    prev_state: Optional[str] = None,
+    prev_data: Optional[Dict[str, Any]] = None,
+    started_state: Optional[str] = None,
+    started: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    enqueue_generation вернул False (дубль подавлен): убирает новое «Генерирую…»,
+    откатывает то, что записал этот запуск, и говорит пользователю, что
+    генерация уже идёт.
 
-async def startup(ctx: dict[str, Bot]):
-    log.info("worker_startup_begin")
-    ctx["bot"] = Bot(token=settings.TELEGRAM_BOT_TOKEN)
+    Идущая генерация в это время может сама писать в FSM (wait_msg_id,
+    last_task_uuid, final_menu), поэтому data целиком не перезаписываем:
+    состояние возвращается только если оно всё ещё started_state (атомарно),
+    а из полей started — только те, что ещё держат записанное запуском значение.
+    """
+    if wait_msg_id:
+        try:
+            await bot.delete_message(chat_id, wait_msg_id)
+        except Exception:
+            pass
+    if state is not None:
+        if started_state is not None and not await state.storage.compare_and_set_state(
+            state.key, started_state, prev_state
+        ):
+            # идущая генерация уже сменила состояние — её записи не трогаем
+            started = None
+        if started:
+            prev_data = prev_data or {}
+            current = await state.get_data()
+            restore = {k: prev_data.get(k) for k, v in started.items() if current.get(k) == v}
+            if restore:
+                await state.update_data(**restore)
+    try:
+        await bot.send_message(chat_id, GENERATION_DUPLICATE_TEXT)
+    except Exception:
+        pass
+
+async def startup(ctx: dict[str, Bot], *, queue_name: str):
+    configure_json_logging()
+    ctx["queue_name"] = queue_name
+    ctx["max_jobs"] = QUEUE_MAX_JOBS[queue_name]
+    log.info("worker_startup_begin", extra={"queue": queue_name})
+    try:
+        start_http_server(settings.WORKER_METRICS_PORT)
+    except OSError:
+        log.warning("worker_metrics_port_busy", extra={"port": settings.WORKER_METRICS_PORT})
+    bot = Bot(token=settings.TELEGRAM_BOT_TOKEN)
+    bot.session.middleware(TelegramMetricsMiddleware())
+    ctx["bot"] = bot
+    ctx["heartbeat"] = asyncio.create_task(heartbeat_loop(ctx))
     log.info("worker_startup_complete")
 
 async def shutdown(ctx: dict[str, Bot]):
     log.info("worker_shutdown_begin")
+    hb = ctx.get("heartbeat")
+    if hb:
+        hb.cancel()
+    await heartbeat_stop(ctx)
     bot: Bot = ctx.get("bot")
     if bot:
         await bot.session.close()
+    await close_yookassa()
     log.info("worker_shutdown_complete")
 
+async def on_job_start(ctx: dict) -> None:
+    queue_name = ctx["queue_name"]
+    # score — время (мс), с которого задача могла стартовать
+    if ctx.get("score"):
+        ARQ_QUEUE_WAIT_SECONDS.labels(queue_name).observe(max(0.0, time.time() - ctx["score"] / 1000))
+    # глубину очереди считает только /metrics веба в момент scrape: у воркера
+    # значение замирало бы на последней задаче и спорило со свежим
+
 async def _clear_waiting_message(bot: Bot, chat_id: int) -> None:
     try:
-        r = aioredis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB_FSM)
-        storage = RedisStorage(redis=r, key_builder=DefaultKeyBuilder(with_bot_id=True))
         me = await bot.get_me()
-        fsm = FSMContext(storage=storage, key=StorageKey(me.id, chat_id, chat_id))
+        fsm = FSMContext(storage=get_fsm_storage(), key=StorageKey(me.id, chat_id, chat_id))
         data = await fsm.get_data()
         msg_id = data.get("wait_msg_id")
         if msg_id:
@@ -118,7 +314,7 @@ async def _maybe_refund_if_deducted(chat_id: int, task_uuid: str, amount: int, c
     except Exception:
         debited = None
     if not debited:
-        log.info(_j("refund.skipped_not_debited", cid=cid, chat_id=chat_id, task_uuid=task_uuid))
+        log.info("refund.skipped_not_debited", extra={"cid": cid, "chat_id": chat_id, "task_uuid": task_uuid})
         return
 
     try:
@@ -131,14 +327,25 @@ async def _maybe_refund_if_deducted(chat_id: int, task_uuid: str, amount: int, c
                     .where(User.id == u.id)
                     .values(balance_credits=User.balance_credits + amount)
                 )
+                # баланс после UPDATE (строка под блокировкой до commit) — с учётом
+                # параллельных списаний и пополнений, а не прочитанный до возврата
+                new_balance = await s.scalar(select(User.balance_credits).where(User.id == u.id))
                 await s.commit()
-                log.info(_j("refund.ok", cid=cid, chat_id=chat_id, task_uuid=task_uuid, amount=amount, reason=reason))
+                await segments.set_balance(chat_id, int(new_balance or 0))
+                REFUNDS_TOTAL.labels(reason).inc()
+                log.info("refund.ok", extra={
+                    "cid": cid,
+                    "chat_id": chat_id,
+                    "task_uuid": task_uuid,
+                    "amount": amount,
+                    "reason": reason,
+                })
                 try:
                     await rcache.delete(deb_key)
                 except Exception:
                     pass
     except Exception:
-        log.exception(_j("refund.db_error", cid=cid, task_uuid=task_uuid))
+        log.exception("refund.db_error", extra={"cid": cid, "task_uuid": task_uuid})
 
 async def process_generation(
     ctx: dict[str, Bot], 
@@ -148,14 +355,26 @@ async def process_generation(
     aspect_ratio: Optional[str] = None,
     image_resolution: str = "1K",
     max_images: int = 1,
-    seed: Optional[int] = None
+    seed: Optional[int] = None,
+    cid: Optional[str] = None,
+    enqueued_at: Optional[float] = None,
+    fp: Optional[str] = None,
 ) -> Dict[str, Any] | None:
     bot: Bot = ctx["bot"]
     api = SeedreamClient()  # 🆕 Будем закрывать в finally
-    cid = uuid4().hex[:12]
+    cid = cid or uuid4().hex[:12]
+    job_started = time.time()
+    task_created = False
 
-    log.info(_j("queue.process.start", cid=cid, chat_id=chat_id, photos_in=len(photos or []),
-               prompt_len=len(prompt or ""), resolution=image_resolution, max_images=max_images, seed=seed))
+    log.info("queue.process.start", extra={
+        "cid": cid,
+        "chat_id": chat_id,
+        "photos_in": len(photos or []),
+        "prompt_len": len(prompt or ""),
+        "resolution": image_resolution,
+        "max_images": max_images,
+        "seed": seed,
+    })
 
     try:
         async with SessionLocal() as s:
@@ -163,7 +382,7 @@ async def process_generation(
                 q = await s.execute(select(User).where(User.chat_id == chat_id))
                 user = q.scalar_one_or_none()
                 if user is None:
-                    log.warning(_j("queue.user_not_found", cid=cid, chat_id=chat_id))
+                    log.warning("queue.user_not_found", extra={"cid": cid, "chat_id": chat_id})
                     await _clear_waiting_message(bot, chat_id)
                     try:
                         await bot.send_message(chat_id, "Нажмите /start для инициализации")
@@ -171,7 +390,7 @@ async def process_generation(
                         pass
                     return {"ok": False, "error": "user_not_found"}
             except OperationalError:
-                log.error(_j("queue.db_unavailable", cid=cid))
+                log.error("queue.db_unavailable", extra={"cid": cid})
                 await _clear_waiting_message(bot, chat_id)
                 try:
                     await bot.send_message(chat_id, "⚠️ Ошибка БД. Напишите @guard_gpt")
@@ -181,7 +400,11 @@ async def process_generation(
 
             required_credits = max_images * CREDITS_PER_GENERATION
             if user.balance_credits < required_credits:
-                log.info(_j("queue.balance.insufficient", cid=cid, required=required_credits, balance=user.balance_credits))
+                log.info("queue.balance.insufficient", extra={
+                    "cid": cid,
+                    "required": required_credits,
+                    "balance": user.balance_credits,
+                })
                 await bot.send_message(
                     chat_id, 
                     f"Недостаточно генераций.\nТребуется: {required_credits}\nВаш баланс: {user.balance_credits}\n\nПополните: /buy"
@@ -191,21 +414,17 @@ async def process_generation(
             callback = f"{settings.PUBLIC_BASE_URL.rstrip('/')}/webhook/seedream?t={settings.WEBHOOK_SECRET_TOKEN}"
             
             if photos:
-                image_urls: List[str] = []
-                for item in photos[:10]:
-                    try:
-                        if isinstance(item, str) and item.startswith("http"):
-                            image_urls.append(item)
-                        else:
-                            image_urls.append(await _tg_file_to_url(bot, item, cid=cid))
-                    except Exception:
-                        log.exception(_j("queue.fetch_image_url.failed", cid=cid, file_id=item))
-                
+                image_urls, prep_errors = await _prepare_image_urls(bot, photos, cid=cid)
+
                 if not image_urls:
                     await bot.send_message(chat_id, "Ошибка обработки изображений. Попробуйте снова")
                     return {"ok": False, "error": "images_prepare_failed"}
-                
-                log.info(_j("queue.images.prepared", cid=cid, count=len(image_urls)))
+
+                log.info("queue.images.prepared", extra={
+                    "cid": cid,
+                    "count": len(image_urls),
+                    "failed": len(prep_errors),
+                })
                 
                 try:
                     task_id = await api.create_task_edit(
@@ -218,9 +437,9 @@ async def process_generation(
                         seed=seed,
                         cid=cid,
                     )
-                    log.info(_j("queue.create_task_edit.ok", cid=cid, task_id=task_id))
+                    log.info("queue.create_task_edit.ok", extra={"cid": cid, "task_id": task_id})
                 except Exception as e:
-                    log.error(_j("queue.seedream_error", cid=cid, error=str(e)))
+                    log.error("queue.seedream_error", extra={"cid": cid, "error": str(e)})
                     await _clear_waiting_message(bot, chat_id)
                     try:
                         await bot.send_message(chat_id, "⚠️ Ошибка генерации. Напишите @guard_gpt")
@@ -238,9 +457,9 @@ async def process_generation(
                         seed=seed,
                         cid=cid,
                     )
-                    log.info(_j("queue.create_task_t2i.ok", cid=cid, task_id=task_id))
+                    log.info("queue.create_task_t2i.ok", extra={"cid": cid, "task_id": task_id})
                 except Exception as e:
-                    log.error(_j("queue.seedream_error", cid=cid, error=str(e)))
+                    log.error("queue.seedream_error", extra={"cid": cid, "error": str(e)})
                     await _clear_waiting_message(bot, chat_id)
                     try:
                         await bot.send_message(chat_id, "⚠️ Ошибка генерации. Напишите @guard_gpt")
@@ -248,20 +467,32 @@ async def process_generation(
                         pass
                     return {"ok": False, "error": "seedream_error"}
 
-            log.info(_j("queue.create_task.ok", cid=cid, task_id=task_id))
+            log.info("queue.create_task.ok", extra={"cid": cid, "task_id": task_id})
+            # дальше маркер дублей снимет доставка (services.delivery)
+            task_created = True
+            await trace_start(
+                task_id,
+                cid=cid,
+                chat_id=chat_id,
+                fp=fp,
+                enqueue=enqueued_at,
+                job_start=job_started,
+                kie_create=time.time(),
+            )
 
             try:
                 task = Task(user_id=user.id, prompt=prompt, task_uuid=task_id, status="queued", delivered=False)
                 s.add(task)
                 await s.commit()
-                log.info(_j("queue.db_task_saved", cid=cid, task_id=task_id))
+                log.info("queue.db_task_saved", extra={"cid": cid, "task_id": task_id})
+                await segments.mark_generated(chat_id)
             except Exception:
-                log.warning(_j("queue.db_write_failed", cid=cid, task_id=task_id))
+                log.warning("queue.db_write_failed", extra={"cid": cid, "task_id": task_id})
 
         return {"ok": True, "task_id": task_id}
 
     except Exception:
-        log.exception(_j("queue.fatal", cid=cid))
+        log.exception("queue.fatal", extra={"cid": cid})
         await _clear_waiting_message(bot, chat_id)
         if 'task_id' in locals():
             await _maybe_refund_if_deducted(chat_id, task_id, max_images, cid, reason="internal")
@@ -272,21 +503,76 @@ async def process_generation(
         return {"ok": False, "error": "internal"}
     
     finally:
+        if not task_created:
+            await release_generation(chat_id, fp)
         # 🆕 ВСЕГДА закрываем HTTP клиент SeedreamClient
         try:
             await api.aclose()
-            log.info(_j("queue.api_client_closed", cid=cid))
+            log.info("queue.api_client_closed", extra={"cid": cid})
         except Exception as e:
-            log.warning(_j("queue.api_client_close_failed", cid=cid, error=str(e)))
+            log.warning("queue.api_client_close_failed", extra={"cid": cid, "error": str(e)})
 
-class WorkerSettings:
-    functions = [process_generation, broadcast_send]
-    on_startup = startup
+# ARQ читает настройки из __dict__ класса (без наследования), поэтому общие
+# поля повторяются. {queue}:health-check обновляется каждые 30с — его проверяет /readyz
+class GenerationWorker:
+    queue_name = QUEUE_GENERATION
+    max_jobs = QUEUE_MAX_JOBS[QUEUE_GENERATION]
+    on_startup = functools.partial(startup, queue_name=QUEUE_GENERATION)
+    functions = [
+        job_function(process_generation),
+        job_function(transcribe_voice, timeout=settings.VOICE_JOB_TIMEOUT_S),
+    ]
     on_shutdown = shutdown
-    redis_settings = RedisSettings(
-        host=settings.REDIS_HOST, port=settings.REDIS_PORT, database=settings.REDIS_DB_CACHE
-    )
-    job_timeout = 259200
+    on_job_start = on_job_start
+    redis_settings = _REDIS_SETTINGS
+    job_timeout = settings.ARQ_JOB_TIMEOUT_S
+    keep_result = 0
+    health_check_interval = 30
+
+
+class DeliveryWorker:
+    queue_name = QUEUE_DELIVERY
+    max_jobs = QUEUE_MAX_JOBS[QUEUE_DELIVERY]
+    on_startup = functools.partial(startup, queue_name=QUEUE_DELIVERY)
+    functions = [job_function(deliver_generation), job_function(notify_payment)]
+    on_shutdown = shutdown
+    on_job_start = on_job_start
+    redis_settings = _REDIS_SETTINGS
+    job_timeout = settings.ARQ_JOB_TIMEOUT_S
     keep_result = 0
+    health_check_interval = 30
+
+
+class BroadcastWorker:
+    queue_name = QUEUE_BROADCAST
+    max_jobs = QUEUE_MAX_JOBS[QUEUE_BROADCAST]
+    on_startup = functools.partial(startup, queue_name=QUEUE_BROADCAST)
+    functions = [job_function(broadcast_send, timeout=settings.BROADCAST_JOB_TIMEOUT_S)]
+    on_shutdown = shutdown
+    on_job_start = on_job_start
+    redis_settings = _REDIS_SETTINGS
+    job_timeout = settings.ARQ_JOB_TIMEOUT_S
+    keep_result = 0
+    health_check_interval = 30
+
+
+class MaintenanceWorker:
+    queue_name = QUEUE_MAINTENANCE
+    max_jobs = QUEUE_MAX_JOBS[QUEUE_MAINTENANCE]
+    on_startup = functools.partial(startup, queue_name=QUEUE_MAINTENANCE)
+    functions = [job_function(rebuild_segments)]  # внеочередная пересборка из /broadcast
+    cron_jobs = [
+        cron(tracked(cleanup_redis), minute=set(range(0, 60, 5)), run_at_startup=True),
+        cron(tracked(reconcile_payments), minute=set(range(2, 60, 5))),
+        cron(tracked(rebuild_segments), hour={3}, minute={40}, run_at_startup=True),
+        cron(tracked(prune_deliveries), hour={3}, minute={50}),
+    ]
+    on_shutdown = shutdown
+    on_job_start = on_job_start
+    redis_settings = _REDIS_SETTINGS
+    job_timeout = settings.ARQ_JOB_TIMEOUT_S
+    keep_result = 0
+    health_check_interval = 30
+
 
 log.info("worker_settings_initialized")
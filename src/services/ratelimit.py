@@ -0,0 +1,85 @@
+"""
+Ограничение частоты апдейтов от пользователя (GCRA).
+
+Одно атомарное EVALSHA на апдейт: в Redis хранится только «теоретическое
+время прихода» (TAT) ``rl:{user_id}`` с TTL, стоимость апдейта — в единицах
+лимита (генерация дороже кнопки меню). Кто уже упёрся в лимит, отсекается
+локально до ``retry_after`` без похода в Redis — но только апдейты не дешевле
+отклонённого: после отказа генерации кнопки меню по-прежнему идут в Redis.
+"""
+from __future__ import annotations
+
+import logging
+import time
+from typing import Dict, Tuple
+
+from core.config import settings
+from core.redis import get_redis
+
+log = logging.getLogger("ratelimit")
+
+# ARGV: интервал на единицу (мс), допуск всплеска (мс), стоимость.
+# Возвращает {1, 0} — пропустить, {0, retry_after_ms} — отказ.
+_GCRA = """
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then
+  tat = now
+end
+local new_tat = tat + interval * cost
+local allow_at = new_tat - burst
+if allow_at > now then
+  return {0, allow_at - now}
+end
+redis.call('SET', KEYS[1], new_tat, 'PX', new_tat - now)
+return {1, 0}
+"""
+
+_BLOCKED_MAX = 10000
+
+
+class RateLimiter:
+    """limit единиц за period секунд на пользователя, всплеск до limit единиц."""
+
+    def __init__(self, limit: int, period: float = 60.0, prefix: str = "rl"):
+        self.limit = max(1, limit)
+        self.interval_ms = int(period * 1000 / self.limit)
+        self.burst_ms = int(period * 1000)
+        self.prefix = prefix
+        self._script = get_redis(settings.REDIS_DB_CACHE).register_script(_GCRA)
+        # user_id -> (до какого момента, стоимость отклонённого апдейта)
+        self._blocked: Dict[int, Tuple[float, int]] = {}
+
+    def blocked_locally(self, user_id: int, cost: int = 1) -> bool:
+        entry = self._blocked.get(user_id)
+        if entry is None:
+            return False
+        until, rejected_cost = entry
+        if until <= time.monotonic():
+            self._blocked.pop(user_id, None)
+            return False
+        # retry_after считан для rejected_cost; более дешёвый апдейт Redis может пропустить
+        return cost >= rejected_cost
+
+    async def hit(self, user_id: int, cost: int = 1) -> Tuple[bool, float]:
+        """(разрешено, через сколько секунд можно снова). Redis недоступен — пропускаем."""
+        try:
+            allowed, retry_ms = await self._script(
+                keys=[f"{self.prefix}:{user_id}"],
+                args=[self.interval_ms, self.burst_ms, min(cost, self.limit)],
+            )
+        except Exception:
+            log.warning("ratelimit.redis_failed", extra={"user_id": user_id})
+            return True, 0.0
+        if allowed:
+            return True, 0.0
+        retry_after = int(retry_ms) / 1000
+        if len(self._blocked) >= _BLOCKED_MAX:
+            now = time.monotonic()
+            self._blocked = {k: v for k, v in self._blocked.items() if v[0] > now}
+        self._blocked[user_id] = (time.monotonic() + retry_after, cost)
+        return False, retry_after
@@ -0,0 +1,294 @@
+"""
+Материализованные сегменты аудитории в Redis (БД REDIS_DB_BROADCAST).
+
+Sorted set'ы, член — chat_id:
+
+- ``seg:users`` — все пользователи, score = chat_id (по нему идёт постраничная
+  выдача при рассылке);
+- ``seg:paid``  — score = время последней успешной оплаты;
+- ``seg:gen``   — score = время последней генерации;
+- ``seg:zero``  — пользователи с нулевым балансом.
+
+Наборы поддерживаются на путях записи (оплата, создание задачи, списание,
+возврат, новый пользователь, блокировка бота) и раз в сутки пересобираются
+из MySQL (``rebuild_segments``), что чинит пропущенные обновления.
+
+Выражение сегмента рассылки — имена через ``&``: ``paid30`` (оплата за 30
+дней), ``gen7`` (генерация за 7 дней), ``zero``. На старте рассылки
+пересечение сохраняется в ``seg:job:{job_id}`` (score = chat_id), и
+broadcast_send читает его страницами без JOIN'ов в MySQL.
+
+Член набора — ``chat_id``, а не ``users.id``: рассылка шлёт по chat_id и
+идёт по нему keyset'ом, а все пути записи (оплата, списание, блокировка бота)
+уже знают chat_id — так не нужен лишний поиск users.id.
+
+Redis без персистентности и с allkeys-lru, поэтому наборы могут пропасть
+(рестарт, FLUSHDB, вытеснение). ``seg:built`` хранит размеры наборов при
+последней пересборке; набор, который был непустым, а теперь отсутствует
+(или ужался больше чем вдвое), значит «сегменты не готовы» — рассылка по
+ним не уходит молча в пустую аудиторию (см. use_materialized).
+"""
+from __future__ import annotations
+
+import logging
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+
+from core.config import settings
+from core.redis import get_redis
+from db.engine import SessionLocal
+from db.models import Payment, Task, User
+from services.audience import SEGMENTS as SQL_SEGMENTS
+
+log = logging.getLogger("segments")
+
+USERS_KEY = "seg:users"
+PAID_KEY = "seg:paid"
+GEN_KEY = "seg:gen"
+ZERO_KEY = "seg:zero"
+BUILT_KEY = "seg:built"
+
+_ALL_KEYS = (USERS_KEY, PAID_KEY, GEN_KEY, ZERO_KEY)
+_WINDOW_RE = re.compile(r"^(paid|gen)(\d{1,3})d?$")
+_CHUNK = 1000
+_MIN_FILL = 0.5  # доля размера с последней пересборки, ниже которой набор считается потерянным
+
+
+class SegmentsNotReady(RuntimeError):
+    """Наборы в Redis не собраны или потеряны — аудитория была бы неполной."""
+
+    def __init__(self, missing: List[str]):
+        self.missing = missing
+        super().__init__(f"segments not ready: {', '.join(missing)}")
+
+
+def _r():
+    return get_redis(settings.REDIS_DB_BROADCAST)
+
+
+def job_key(job_id: str) -> str:
+    return f"seg:job:{job_id}"
+
+
+# --- выражения сегментов ---
+
+def parse_spec(spec: Optional[str]) -> Optional[List[Tuple[str, Optional[int]]]]:
+    """
+    ``paid30&zero`` → [(seg:paid, 30), (seg:zero, None)]; None — это не
+    материализованный сегмент (тогда работает SQL из services.audience).
+    """
+    if not spec:
+        return None
+    parts = []
+    for name in spec.split("&"):
+        name = name.strip()
+        if name == "zero":
+            parts.append((ZERO_KEY, None))
+            continue
+        m = _WINDOW_RE.match(name)
+        if not m or not 0 < int(m.group(2)) <= settings.SEGMENT_MAX_WINDOW_DAYS:
+            return None
+        parts.append((PAID_KEY if m.group(1) == "paid" else GEN_KEY, int(m.group(2))))
+    return parts
+
+
+async def materialize(spec: str, dest: str, ttl: int) -> int:
+    """Сохраняет пересечение сегментов в dest (score = chat_id); возвращает размер."""
+    parts = parse_spec(spec)
+    if parts is None:
+        raise ValueError(f"unknown segment: {spec}")
+    r = _r()
+    now = time.time()
+    tmp = [f"{dest}:part:{i}" for i in range(len(parts))]
+    async with r.pipeline(transaction=True) as p:
+        for key, (src, days) in zip(tmp, parts):
+            if days is None:
+                p.zunionstore(key, [src])
+            else:
+                p.zrangestore(key, src, now - days * 86400, "+inf", byscore=True)
+        # веса 0 у частей — score результата берётся из seg:users (= chat_id)
+        p.zinterstore(dest, {USERS_KEY: 1, **{k: 0 for k in tmp}})
+        p.expire(dest, ttl)
+        p.delete(*tmp)
+        p.zcard(dest)
+        res = await p.execute()
+    return int(res[-1])
+
+
+async def page(dest: str, after_chat_id: int, limit: int) -> List[int]:
+    raw = await _r().zrangebyscore(dest, f"({after_chat_id}", "+inf", start=0, num=limit)
+    return [int(x) for x in raw]
+
+
+async def missing_sources(spec: str) -> List[str]:
+    """
+    Наборы-источники spec, которых нет в Redis (или осталось меньше половины),
+    хотя при пересборке они были непустыми; без пересборки — все. Пустой
+    список — можно считать.
+    """
+    sources = [USERS_KEY] + [src for src, _ in parse_spec(spec) or []]
+    try:
+        async with _r().pipeline(transaction=False) as p:
+            p.hgetall(BUILT_KEY)
+            for key in sources:
+                p.zcard(key)
+            res = await p.execute()
+    except Exception:
+        return sources
+    built: Dict[str, int] = {k.decode(): int(v) for k, v in (res[0] or {}).items()}
+    if not built:
+        return sources
+    # после вытеснения хуки снова создают ключ, но в нём лишь свежие записи —
+    # поэтому сравниваем размер, а не только наличие
+    return [
+        key for key, card in zip(sources, res[1:])
+        if built.get(key, 1) > 0 and int(card) < built.get(key, 1) * _MIN_FILL
+    ]
+
+
+async def use_materialized(spec: Optional[str], *, rebuild: bool = False) -> bool:
+    """
+    Брать ли аудиторию из Redis. Имена, которые есть и в SQL-сегментах
+    (``zero``), при потерянных наборах уходят в SQL. Для остальных (``paid30``,
+    ``gen7&zero``) SQL-замены нет: с rebuild=True наборы пересобираются на месте,
+    иначе — SegmentsNotReady.
+    """
+    if parse_spec(spec) is None:
+        return False
+    missing = await missing_sources(spec)
+    if not missing:
+        return True
+    if spec in SQL_SEGMENTS:
+        return False
+    if rebuild:
+        log.warning("segments.rebuild_inline", extra={"spec": spec, "missing": missing})
+        await rebuild_segments()
+        missing = await missing_sources(spec)
+        if not missing:
+            return True
+    raise SegmentsNotReady(missing)
+
+
+# --- пути записи (best effort: ошибка Redis не ломает основной сценарий) ---
+
+async def _apply(op: str, chat_id: int, fn) -> None:
+    try:
+        async with _r().pipeline(transaction=False) as p:
+            fn(p)
+            await p.execute()
+    except Exception:
+        log.warning("segments.update_failed", extra={"op": op, "chat_id": chat_id})
+
+
+async def add_user(chat_id: int) -> None:
+    await _apply("add_user", chat_id, lambda p: p.zadd(USERS_KEY, {chat_id: chat_id}))
+
+
+async def mark_paid(chat_id: int) -> None:
+    """Успешная оплата: в seg:paid и (баланс точно > 0) из seg:zero."""
+    def fn(p):
+        p.zadd(PAID_KEY, {chat_id: time.time()})
+        p.zrem(ZERO_KEY, chat_id)
+    await _apply("paid", chat_id, fn)
+
+
+async def mark_generated(chat_id: int) -> None:
+    await _apply("generated", chat_id, lambda p: p.zadd(GEN_KEY, {chat_id: time.time()}))
+
+
+async def set_balance(chat_id: int, balance: int) -> None:
+    def fn(p):
+        if balance <= 0:
+            p.zadd(ZERO_KEY, {chat_id: time.time()})
+        else:
+            p.zrem(ZERO_KEY, chat_id)
+    await _apply("balance", chat_id, fn)
+
+
+async def forget_user(chat_id: int) -> None:
+    def fn(p):
+        for key in _ALL_KEYS:
+            p.zrem(key, chat_id)
+    await _apply("forget", chat_id, fn)
+
+
+# --- полная пересборка из MySQL ---
+
+async def _fill(key: str, stmt, score) -> int:
+    """Стримит (chat_id, value) из MySQL во временный ключ и атомарно подменяет key."""
+    r = _r()
+    tmp = f"{key}:rebuild"
+    await r.delete(tmp)
+    n = 0
+    async with SessionLocal() as s:
+        result = await s.stream(stmt)
+        async for rows in result.partitions(_CHUNK):
+            await r.zadd(tmp, {int(chat_id): score(chat_id, value) for chat_id, value in rows})
+            n += len(rows)
+    if n:
+        await r.rename(tmp, key)
+    else:
+        await r.delete(key)
+    return n
+
+
+def _ts(value: Optional[datetime]) -> float:
+    # в БД наивное UTC-время (datetime.utcnow), а TZ контейнера — не UTC
+    return value.replace(tzinfo=timezone.utc).timestamp() if value is not None else 0.0
+
+
+async def rebuild_segments(ctx: Optional[dict[str, Any]] = None) -> None:
+    """Cron очереди maintenance (раз в сутки) и первичное заполнение."""
+    horizon = datetime.utcnow() - timedelta(days=settings.SEGMENT_MAX_WINDOW_DAYS)
+    t0 = time.perf_counter()
+    try:
+        users = await _fill(
+            USERS_KEY,
+            select(User.chat_id, User.id),
+            lambda chat_id, _: chat_id,
+        )
+        paid = await _fill(
+            PAID_KEY,
+            select(User.chat_id, func.max(Payment.created_at))
+            .join(Payment, Payment.user_id == User.id)
+            .where(Payment.status == "succeeded")
+            .group_by(User.chat_id),
+            lambda _, value: _ts(value),
+        )
+        gen = await _fill(
+            GEN_KEY,
+            select(User.chat_id, func.max(Task.created_at))
+            .join(Task, Task.user_id == User.id)
+            .where(Task.created_at >= horizon)
+            .group_by(User.chat_id),
+            lambda _, value: _ts(value),
+        )
+        zero = await _fill(
+            ZERO_KEY,
+            select(User.chat_id, User.created_at).where(User.balance_credits <= 0),
+            lambda _, value: _ts(value),
+        )
+        # размеры наборов — по ним missing_sources отличает пустой набор от потерянного
+        async with _r().pipeline(transaction=True) as p:
+            p.delete(BUILT_KEY)
+            p.hset(BUILT_KEY, mapping={
+                "at": int(time.time()),
+                USERS_KEY: users,
+                PAID_KEY: paid,
+                GEN_KEY: gen,
+                ZERO_KEY: zero,
+            })
+            await p.execute()
+        log.info("segments.rebuilt", extra={
+            "users": users,
+            "paid": paid,
+            "gen": gen,
+            "zero": zero,
+            "ms": round((time.perf_counter() - t0) * 1000),
+        })
+    except Exception:
+        log.exception("segments.rebuild_failed")
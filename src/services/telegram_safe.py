@@ -293,6 +293,7 @@ from aiogram.exceptions import (
 from db.engine import SessionLocal
 from db.models import User
 from sqlalchemy import delete
+from services import segments
 
 log = logging.getLogger("tg_safe")
 
@@ -303,6 +304,7 @@ async def _maybe_delete_user(chat_id: int):
         async with SessionLocal() as s:
             await s.execute(delete(User).where(User.chat_id == chat_id))
             await s.commit()
+        await segments.forget_user(chat_id)
         log.info(f"user_deleted_due_block chat_id={chat_id}")
     except Exception:
         log.exception(f"failed to delete user on forbidden chat_id={chat_id}")
@@ -0,0 +1,84 @@
+"""
+Кэш результатов getFile: ``tgfile:{file_id}`` → ``{"path", "size"}``.
+
+Сценарии «изменить ещё раз» и перегенерация снова и снова отправляют
+те же file_id; ссылка на файл у Telegram живёт не меньше часа, поэтому
+кэшируем чуть меньше и пропускаем повторные getFile.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Dict, List, Tuple, Union
+
+import orjson
+from aiogram import Bot
+
+from core.config import settings
+from core.redis import get_redis
+
+log = logging.getLogger("tg_files")
+
+TG_FILE_CACHE_TTL_S = 50 * 60
+
+FileInfo = Tuple[str, int]  # (file_path, file_size)
+
+
+def _key(file_id: str) -> str:
+    return f"tgfile:{file_id}"
+
+
+async def resolve_tg_files(
+    bot: Bot, file_ids: List[str], *, concurrency: int = 4
+) -> Dict[str, Union[FileInfo, Exception]]:
+    """
+    file_id → (file_path, size) или исключение getFile. Кэш читается одним MGET,
+    промахи запрашиваются у Telegram параллельно (не больше concurrency разом)
+    и пишутся одним pipeline.
+    """
+    unique = list(dict.fromkeys(file_ids))
+    if not unique:
+        return {}
+
+    r = get_redis(settings.REDIS_DB_CACHE)
+    out: Dict[str, Union[FileInfo, Exception]] = {}
+    try:
+        cached = await r.mget([_key(fid) for fid in unique])
+    except Exception:
+        cached = [None] * len(unique)
+    for fid, raw in zip(unique, cached):
+        if raw:
+            d = orjson.loads(raw)
+            out[fid] = (d["path"], d["size"])
+
+    misses = [fid for fid in unique if fid not in out]
+    if not misses:
+        return out
+
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def _get(fid: str):
+        async with sem:
+            return await bot.get_file(fid)
+
+    results = await asyncio.gather(*(_get(fid) for fid in misses), return_exceptions=True)
+    fresh = {}
+    for fid, res in zip(misses, results):
+        if isinstance(res, Exception):
+            out[fid] = res
+            continue
+        info = (res.file_path, getattr(res, "file_size", None) or 0)
+        out[fid] = info
+        fresh[fid] = info
+
+    if fresh:
+        try:
+            async with r.pipeline(transaction=False) as p:
+                for fid, (path, size) in fresh.items():
+                    p.set(_key(fid), orjson.dumps({"path": path, "size": size}), ex=TG_FILE_CACHE_TTL_S)
+                await p.execute()
+        except Exception:
+            log.warning("tg_files.cache_write_failed", extra={"count": len(fresh)})
+
+    log.info("tg_files.resolved", extra={"hits": len(unique) - len(misses), "misses": len(misses)})
+    return out
@@ -0,0 +1,167 @@
+"""
+Сквозная трассировка генерации по task_uuid.
+
+Этапы: enqueue → job_start → kie_create → callback → download →
+first_photo → last_document. Запись ``trace:{task_uuid}`` (hash с TTL)
+хранит cid, chat_id и unix-время каждого этапа. Завершённый трейс
+раскладывается по сегментам в sorted set-ы ``trace:seg:{segment}``
+(score — время завершения, member — ``"{task_uuid}:{ms}"``), по ним
+считаются перцентили за произвольное окно.
+"""
+from __future__ import annotations
+
+import logging
+import math
+import time
+from typing import Dict, List, Optional
+
+from core.config import settings
+from core.redis import get_redis
+
+log = logging.getLogger("tracing")
+
+STAGES = (
+    "enqueue",
+    "job_start",
+    "kie_create",
+    "callback",
+    "download",
+    "first_photo",
+    "last_document",
+)
+
+# (сегмент, от этапа, до этапа)
+SEGMENTS = (
+    ("queue_wait", "enqueue", "job_start"),
+    ("prepare", "job_start", "kie_create"),
+    ("kie", "kie_create", "callback"),
+    ("download", "callback", "download"),
+    ("first_photo", "download", "first_photo"),
+    ("documents", "first_photo", "last_document"),
+    ("to_first_photo", "enqueue", "first_photo"),
+    ("total", "enqueue", "last_document"),
+)
+
+TRACE_TTL_S = 2 * 86400
+RETENTION_S = 7 * 86400
+
+
+def _key(task_uuid: str) -> str:
+    return f"trace:{task_uuid}"
+
+
+def _seg_key(segment: str) -> str:
+    return f"trace:seg:{segment}"
+
+
+async def trace_start(
+    task_uuid: str,
+    *,
+    cid: str,
+    chat_id: int,
+    fp: Optional[str] = None,
+    **stamps: Optional[float],
+) -> None:
+    """Создаёт запись трейса после того, как KIE вернул taskId."""
+    mapping = {"cid": cid, "chat_id": chat_id}
+    if fp:
+        # отпечаток для снятия in-flight маркера при доставке (services.dedup)
+        mapping["fp"] = fp
+    mapping.update({k: v for k, v in stamps.items() if k in STAGES and v is not None})
+    r = get_redis(settings.REDIS_DB_CACHE)
+    try:
+        async with r.pipeline(transaction=False) as p:
+            p.hset(_key(task_uuid), mapping=mapping)
+            p.expire(_key(task_uuid), TRACE_TTL_S)
+            await p.execute()
+    except Exception:
+        log.warning("trace.start_failed", extra={"cid": cid, "task_uuid": task_uuid})
+
+
+class GenerationTrace:
+    """
+    Трейс одной генерации на стороне доставки. Отметки копятся в памяти
+    и пишутся одним pipeline в finish().
+    """
+
+    def __init__(self, task_uuid: str, fields: Optional[Dict[str, str]] = None):
+        fields = fields or {}
+        self.task_uuid = task_uuid
+        self.cid: Optional[str] = fields.get("cid")
+        self.fp: Optional[str] = fields.get("fp")
+        self.chat_id: Optional[int] = int(fields["chat_id"]) if fields.get("chat_id") else None
+        self.stamps: Dict[str, float] = {}
+        for stage in STAGES:
+            if stage in fields:
+                try:
+                    self.stamps[stage] = float(fields[stage])
+                except (TypeError, ValueError):
+                    pass
+        self._new: Dict[str, float] = {}
+
+    @classmethod
+    async def load(cls, task_uuid: str) -> "GenerationTrace":
+        try:
+            raw = await get_redis(settings.REDIS_DB_CACHE).hgetall(_key(task_uuid))
+        except Exception:
+            raw = {}
+        fields = {k.decode(): v.decode() for k, v in (raw or {}).items()}
+        return cls(task_uuid, fields)
+
+    def mark(self, stage: str, at: Optional[float] = None) -> None:
+        ts = at or time.time()
+        self.stamps[stage] = ts
+        self._new[stage] = ts
+
+    def segments(self) -> Dict[str, float]:
+        """Длительности сегментов в миллисекундах (только полностью известные)."""
+        out: Dict[str, float] = {}
+        for name, start, end in SEGMENTS:
+            if start in self.stamps and end in self.stamps:
+                out[name] = max(0.0, (self.stamps[end] - self.stamps[start]) * 1000)
+        return out
+
+    async def finish(self) -> None:
+        """Сохраняет новые отметки и добавляет сегменты в статистику."""
+        now = time.time()
+        r = get_redis(settings.REDIS_DB_CACHE)
+        try:
+            async with r.pipeline(transaction=False) as p:
+                if self._new:
+                    p.hset(_key(self.task_uuid), mapping=self._new)
+                for name, ms in self.segments().items():
+                    p.zadd(_seg_key(name), {f"{self.task_uuid}:{ms:.0f}": now})
+                    p.zremrangebyscore(_seg_key(name), 0, now - RETENTION_S)
+                await p.execute()
+            self._new = {}
+        except Exception:
+            log.warning("trace.finish_failed", extra={"cid": self.cid, "task_uuid": self.task_uuid})
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """Перцентиль по методу nearest-rank; values отсортированы."""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+async def stage_percentiles(window_s: int) -> Dict[str, Dict[str, float]]:
+    """p50/p90/p99/max (мс) по каждому сегменту за последние window_s секунд."""
+    now = time.time()
+    r = get_redis(settings.REDIS_DB_CACHE)
+    async with r.pipeline(transaction=False) as p:
+        for name, _, _ in SEGMENTS:
+            p.zrangebyscore(_seg_key(name), now - window_s, "+inf")
+        rows = await p.execute()
+
+    stats: Dict[str, Dict[str, float]] = {}
+    for (name, _, _), members in zip(SEGMENTS, rows):
+        values = sorted(float(m.rsplit(b":", 1)[1]) for m in members)
+        stats[name] = {
+            "count": len(values),
+            "p50": _percentile(values, 0.50),
+            "p90": _percentile(values, 0.90),
+            "p99": _percentile(values, 0.99),
+            "max": values[-1] if values else 0.0,
+        }
+    return stats
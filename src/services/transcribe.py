@@ -0,0 +1,95 @@
+"""
+Распознавание голосовых через OpenAI Whisper.
+
+Голос скачивается в память (BytesIO от ``Bot.download_file``) и этот же буфер
+уходит в multipart-запрос OpenAI — без временного файла и лишней копии.
+Размер проверяется по ``voice.file_size`` до скачивания и по ответу getFile.
+"""
+from __future__ import annotations
+
+import io
+import logging
+import time
+from typing import Optional
+
+from aiogram import Bot
+from openai import AsyncOpenAI
+
+from core.config import settings
+from services.metrics import VOICE_STAGE_SECONDS
+
+log = logging.getLogger("voice")
+
+
+class VoiceTooLarge(ValueError):
+    def __init__(self, size: int):
+        self.size = size
+        super().__init__(f"voice too large: {size} bytes")
+
+
+# ✅ Инициализация OpenAI клиента с проверкой
+try:
+    if not settings.OPENAI_API_KEY or settings.OPENAI_API_KEY == "your_openai_api_key":
+        openai_client: Optional[AsyncOpenAI] = None
+        log.warning("OpenAI API key not configured - voice messages disabled")
+    else:
+        openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+        log.info("OpenAI client initialized successfully")
+except Exception as e:
+    openai_client = None
+    log.error(f"Failed to initialize OpenAI client: {e}")
+
+
+def _check_size(size: Optional[int]) -> None:
+    if size and size > settings.VOICE_MAX_BYTES:
+        raise VoiceTooLarge(size)
+
+
+async def download_voice(bot: Bot, file_id: str, file_size: Optional[int] = None) -> io.BytesIO:
+    """Скачивает голос в память; VoiceTooLarge — если больше VOICE_MAX_BYTES."""
+    _check_size(file_size)
+    t0 = time.perf_counter()
+    file = await bot.get_file(file_id)
+    _check_size(file.file_size)
+    buf = await bot.download_file(file.file_path)
+    VOICE_STAGE_SECONDS.labels("download").observe(time.perf_counter() - t0)
+    return buf
+
+
+async def transcribe_voice_whisper(audio: io.BytesIO, filename: str = "audio.ogg") -> str:
+    """
+    ✅ Транскрибация голосового сообщения через OpenAI Whisper API
+    """
+    if openai_client is None:
+        raise ValueError("OpenAI API not configured")
+
+    audio.seek(0)
+    t0 = time.perf_counter()
+    try:
+        transcript = await openai_client.audio.transcriptions.create(
+            model=settings.WHISPER_MODEL,
+            file=(filename, audio, "audio/ogg"),
+            language="ru",
+            response_format="text"
+        )
+
+        text = transcript.strip()
+
+        log.info(
+            "whisper_transcription_success",
+            extra={
+                "text_length": len(text),
+                "model": settings.WHISPER_MODEL
+            }
+        )
+
+        return text
+
+    except Exception as e:
+        log.exception(
+            "whisper_transcription_error",
+            extra={"error": str(e)}
+        )
+        raise
+    finally:
+        VOICE_STAGE_SECONDS.labels("transcribe").observe(time.perf_counter() - t0)
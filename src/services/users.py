@@ -1,6 +1,7 @@
 from sqlalchemy import select
 from db.engine import SessionLocal
 from db.models import User
+from services import segments
 
 async def ensure_user(telegram_user) -> User:
     async with SessionLocal() as s:
@@ -17,4 +18,5 @@ async def ensure_user(telegram_user) -> User:
         s.add(u)
         await s.commit()
         await s.refresh(u)
+        await segments.add_user(u.chat_id)
         return u
@@ -0,0 +1,356 @@
+"""
+Голосовой промт в воркере (очередь generation).
+
+Вебхук только ставит задачу ``transcribe_voice`` со снимком FSM (состояние и
+данные на момент голосового) и отвечает «🎙️ Распознаю голос…». Воркер
+скачивает голос, распознаёт его Whisper'ом, правит это сообщение и продолжает
+в ту же ветку enqueue_generation, что раньше выполнялась прямо в хендлере.
+"""
+from __future__ import annotations
+
+import html
+import logging
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from sqlalchemy import select
+
+from bot.states import CreateStates, GenStates
+from core.fsm import get_fsm_storage
+from db.engine import SessionLocal
+from db.models import User
+from services.transcribe import VoiceTooLarge, download_voice, transcribe_voice_whisper
+
+log = logging.getLogger("voice")
+
+_UNAVAILABLE = (
+    "❌ Распознавание голоса временно недоступно.\n\n"
+    "Пожалуйста, напишите текстом или обратитесь в поддержку: @guard_gpt"
+)
+
+
+def voice_job_id(chat_id: int, message_id: int) -> str:
+    # повтор вебхука с тем же апдейтом не ставит вторую задачу
+    return f"voice:{chat_id}:{message_id}"
+
+
+def _error_text(e: Exception) -> str:
+    error_str = str(e).lower()
+    if "insufficient_quota" in error_str or "quota" in error_str:
+        return (
+            "❌ Превышена квота OpenAI API.\n"
+            "Пожалуйста, напишите текстом или обратитесь в поддержку: @guard_gpt"
+        )
+    if "invalid_api_key" in error_str or "authentication" in error_str or "401" in error_str:
+        return (
+            "❌ Ошибка конфигурации сервиса распознавания.\n"
+            "Пожалуйста, напишите текстом или обратитесь в поддержку: @guard_gpt"
+        )
+    if "timeout" in error_str:
+        return (
+            "❌ Превышено время ожидания ответа от сервиса.\n"
+            "Попробуйте ещё раз или напишите текстом."
+        )
+    return "❌ Произошла ошибка при обработке голосового сообщения."
+
+
+async def _edit_or_send(bot: Bot, chat_id: int, message_id: Optional[int], text: str, **kwargs) -> None:
+    if message_id:
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+            return
+        except Exception:
+            try:
+                await bot.delete_message(chat_id, message_id)
+            except Exception:
+                pass
+    try:
+        await bot.send_message(chat_id, text, **kwargs)
+    except Exception as e:
+        # показ статуса не должен обрывать задачу (и запуск генерации)
+        log.warning("voice_status_send_failed", extra={"user_id": chat_id, "error": str(e)})
+
+
+async def transcribe_voice(
+    ctx: dict[str, Any],
+    chat_id: int,
+    file_id: str,
+    file_size: Optional[int],
+    processing_msg_id: Optional[int],
+    cur: Optional[str],
+    data: Dict[str, Any],
+) -> None:
+    """Задача очереди generation: голос → текст → генерация по снимку FSM."""
+    bot: Bot = ctx["bot"]
+    try:
+        voice_data = await download_voice(bot, file_id, file_size)
+        text = await transcribe_voice_whisper(voice_data, filename="voice.ogg")
+    except VoiceTooLarge:
+        await _edit_or_send(
+            bot, chat_id, processing_msg_id,
+            "❌ Голосовое слишком длинное.\n\n"
+            "💡 Запишите покороче или напишите промт текстом."
+        )
+        return
+    except ValueError as e:
+        if "not configured" in str(e):
+            await _edit_or_send(bot, chat_id, processing_msg_id, _UNAVAILABLE)
+            return
+        log.exception("voice_processing_error", extra={"user_id": chat_id, "error": str(e)})
+        await _edit_or_send(bot, chat_id, processing_msg_id, _error_text(e))
+        return
+    except Exception as e:
+        log.exception("voice_processing_error", extra={"user_id": chat_id, "error": str(e)})
+        await _edit_or_send(bot, chat_id, processing_msg_id, _error_text(e))
+        return
+
+    if not text or len(text) < 2:
+        await _edit_or_send(
+            bot, chat_id, processing_msg_id,
+            "❌ Не удалось распознать голос.\n\n"
+            "💡 Советы:\n"
+            "• Говорите чётче и громче\n"
+            "• Записывайте минимум 2 секунды\n"
+            "• Избегайте сильного фонового шума"
+        )
+        return
+
+    await _edit_or_send(
+        bot, chat_id, processing_msg_id,
+        f"🎙️ <b>Распознано:</b>\n\n<i>{html.escape(text)}</i>",
+        parse_mode="HTML",
+    )
+
+    async with SessionLocal() as s:
+        user = (await s.execute(select(User).where(User.chat_id == chat_id))).scalar_one_or_none()
+        if not user:
+            await bot.send_message(chat_id, "Нажмите /start для инициализации")
+            return
+        image_resolution = user.image_resolution
+        max_images = user.max_images
+
+    state = FSMContext(storage=get_fsm_storage(), key=StorageKey(bot.id, chat_id, chat_id))
+    await _continue_generation(bot, state, chat_id, cur, data, text, image_resolution, max_images)
+
+
+async def _claim(state: FSMContext, chat_id: int, cur: Optional[str], target: Optional[str]) -> bool:
+    """
+    Атомарно cur → target. Пока распознавали, пользователь мог уйти в другой
+    сценарий (или второе голосовое уже запустило генерацию) — тогда текст
+    показан, а генерацию не трогаем.
+    """
+    if await state.storage.compare_and_set_state(state.key, cur, target):
+        return True
+    log.info("voice_state_changed", extra={"user_id": chat_id, "state": cur})
+    return False
+
+
+async def _continue_generation(
+    bot: Bot,
+    state: FSMContext,
+    chat_id: int,
+    cur: Optional[str],
+    data: Dict[str, Any],
+    text: str,
+    image_resolution: str,
+    max_images: int,
+) -> None:
+    # services.queue импортирует этот модуль для регистрации задачи
+    from services.queue import enqueue_generation, undo_duplicate_start
+
+    # ========== ОБРАБОТКА ПО СОСТОЯНИЯМ ==========
+
+    if cur == GenStates.waiting_prompt.state:
+        photos = data.get("photos") or []
+        if not photos:
+            await bot.send_message(chat_id, "❌ Нет загруженных фото. Используйте /gen и отправьте фото сначала.")
+            return
+
+        file_ids = [p["file_id"] for p in photos]
+        if not await _claim(state, chat_id, cur, GenStates.generating.state):
+            return
+
+        wait_msg = await bot.send_message(chat_id, f"⏳ Генерирую {max_images} изображений...")
+
+        started = dict(
+            prompt=text,
+            base_prompt=text,
+            edits=[],
+            mode="edit",
+            wait_msg_id=wait_msg.message_id,
+            image_resolution=image_resolution,
+            max_images=max_images,
+        )
+        await state.update_data(**started)
+
+        if not await enqueue_generation(
+            chat_id,
+            text,
+            file_ids,
+            image_resolution=image_resolution,
+            max_images=max_images
+        ):
+            await undo_duplicate_start(
+                bot, chat_id, wait_msg.message_id, state, cur, data,
+                started_state=GenStates.generating.state, started=started,
+            )
+        return
+
+    if cur == GenStates.final_menu.state:
+        photos = data.get("photos") or []
+        if not photos:
+            await bot.send_message(chat_id, "❌ Не удалось найти исходные изображения. Нажмите «Начать заново».")
+            return
+
+        base_prompt = (data.get("base_prompt") or data.get("prompt") or "").strip()
+        edits = list(data.get("edits") or [])
+        edits.append(text)
+
+        cumulative_prompt = " ".join([base_prompt] + edits).strip()
+        if len(cumulative_prompt) > 4000:
+            cumulative_prompt = cumulative_prompt[:4000]
+
+        file_ids = [p["file_id"] for p in photos]
+        seed = data.get("last_seed")
+
+        if not await _claim(state, chat_id, cur, GenStates.generating.state):
+            return
+
+        wait_msg = await bot.send_message(chat_id, f"⏳ Генерирую {max_images} изображений...")
+
+        started = dict(
+            prompt=cumulative_prompt,
+            base_prompt=base_prompt,
+            edits=edits,
+            mode="edit",
+            wait_msg_id=wait_msg.message_id,
+            image_resolution=image_resolution,
+            max_images=max_images,
+        )
+        await state.update_data(**started)
+
+        if not await enqueue_generation(
+            chat_id,
+            cumulative_prompt,
+            file_ids,
+            image_resolution=image_resolution,
+            max_images=max_images,
+            seed=seed
+        ):
+            await undo_duplicate_start(
+                bot, chat_id, wait_msg.message_id, state, cur, data,
+                started_state=GenStates.generating.state, started=started,
+            )
+        return
+
+    if cur == CreateStates.waiting_prompt.state:
+        aspect_ratio = data.get("aspect_ratio")
+
+        if not await _claim(state, chat_id, cur, CreateStates.generating.state):
+            return
+
+        wait_msg = await bot.send_message(chat_id, f"⏳ Генерирую {max_images} изображений...")
+
+        started = dict(
+            mode="create",
+            prompt=text,
+            wait_msg_id=wait_msg.message_id,
+            image_resolution=image_resolution,
+            max_images=max_images,
+        )
+        await state.update_data(**started)
+
+        if not await enqueue_generation(
+            chat_id,
+            text,
+            [],
+            aspect_ratio=aspect_ratio,
+            image_resolution=image_resolution,
+            max_images=max_images
+        ):
+            await undo_duplicate_start(
+                bot, chat_id, wait_msg.message_id, state, cur, data,
+                started_state=CreateStates.generating.state, started=started,
+            )
+        return
+
+    if cur == CreateStates.final_menu.state:
+        last_result_urls = data.get("last_result_urls", [])
+        aspect_ratio = data.get("aspect_ratio")
+        seed = data.get("last_seed")
+
+        if not await _claim(state, chat_id, cur, CreateStates.generating.state):
+            return
+
+        wait_msg = await bot.send_message(chat_id, f"⏳ Генерирую {max_images} изображений...")
+
+        started = dict(
+            mode="create_edit",
+            prompt=text,
+            wait_msg_id=wait_msg.message_id,
+            image_resolution=image_resolution,
+            max_images=max_images,
+        )
+        await state.update_data(**started)
+
+        if not await enqueue_generation(
+            chat_id,
+            text,
+            last_result_urls,
+            aspect_ratio=aspect_ratio,
+            image_resolution=image_resolution,
+            max_images=max_images,
+            seed=seed
+        ):
+            await undo_duplicate_start(
+                bot, chat_id, wait_msg.message_id, state, cur, data,
+                started_state=CreateStates.generating.state, started=started,
+            )
+        return
+
+    if cur == CreateStates.selecting_aspect_ratio.state:
+        aspect_ratio = data.get("aspect_ratio")
+
+        if not await _claim(state, chat_id, cur, CreateStates.generating.state):
+            return
+
+        wait_msg = await bot.send_message(chat_id, f"⏳ Генерирую {max_images} изображений...")
+
+        started = dict(
+            mode="create",
+            prompt=text,
+            wait_msg_id=wait_msg.message_id,
+            aspect_ratio=aspect_ratio,
+            image_resolution=image_resolution,
+            max_images=max_images,
+        )
+        await state.update_data(**started)
+
+        if not await enqueue_generation(
+            chat_id,
+            text,
+            [],
+            aspect_ratio=aspect_ratio,
+            image_resolution=image_resolution,
+            max_images=max_images
+        ):
+            await undo_duplicate_start(
+                bot, chat_id, wait_msg.message_id, state, cur, data,
+                started_state=CreateStates.generating.state, started=started,
+            )
+        return
+
+    if await state.get_state() != cur:
+        return
+    await bot.send_message(
+        chat_id,
+        "ℹ️ Для генерации используйте:\n\n"
+        "• <b>/gen</b> или <b>/edit</b> — редактировать фото\n"
+        "  (загрузите фото, затем скажите промт)\n\n"
+        "• <b>/create</b> — создать новое изображение\n"
+        "  (скажите промт сразу)\n\n"
+        "• <b>/set</b> — настройки качества и количества",
+        parse_mode="HTML"
+    )
@@ -0,0 +1,218 @@
+"""
+Heartbeat и реестр выполняющихся задач ARQ-воркеров.
+
+Каждый воркер раз в ``WORKER_HEARTBEAT_S`` пишет в Redis (БД кэша):
+
+- ``workers:alive`` — sorted set ``{worker_id: last_seen}``;
+- ``worker:{id}`` — hash со сводкой (max_jobs, running, busy_s, done, ...);
+- ``worker:{id}:jobs`` — hash ``{job_id: json}`` с задачами в работе.
+
+Тот же цикл — watchdog: задача дольше своего бюджета помечается
+(лог + метрика), а после ``WORKER_WATCHDOG_GRACE_S`` сверху — отменяется,
+если включён ``WORKER_WATCHDOG_ABORT``.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import os
+import socket
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import orjson
+from arq.worker import Function, func as arq_func
+
+from core.config import settings
+from services.metrics import ARQ_JOBS_IN_FLIGHT, WATCHDOG_ACTIONS_TOTAL, track_job
+
+log = logging.getLogger("workers")
+
+WORKERS_KEY = "workers:alive"
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# job_id -> {function, started, budget, task, flagged}
+_inflight: Dict[str, Dict[str, Any]] = {}
+_stats = {"started": time.time(), "busy_s": 0.0, "done": 0, "flagged": 0, "aborted": 0}
+
+
+def _key(worker_id: str) -> str:
+    return f"worker:{worker_id}"
+
+
+def _jobs_key(worker_id: str) -> str:
+    return f"worker:{worker_id}:jobs"
+
+
+def tracked(
+    coroutine: Callable[..., Awaitable[Any]], *, timeout: Optional[int] = None
+) -> Callable[..., Awaitable[Any]]:
+    """Метрики (track_job) + учёт в реестре in-flight; годится и для cron()."""
+    budget = timeout or settings.ARQ_JOB_TIMEOUT_S
+    name = coroutine.__name__
+
+    @functools.wraps(coroutine)
+    async def wrapper(ctx: dict, *args, **kwargs):
+        job_id = ctx.get("job_id") or f"anon-{id(ctx)}"
+        t0 = time.time()
+        _inflight[job_id] = {
+            "function": name,
+            "started": t0,
+            "budget": budget,
+            "try": ctx.get("job_try", 1),
+            "task": asyncio.current_task(),
+            "flagged": False,
+        }
+        ARQ_JOBS_IN_FLIGHT.inc()
+        try:
+            return await coroutine(ctx, *args, **kwargs)
+        finally:
+            _inflight.pop(job_id, None)
+            ARQ_JOBS_IN_FLIGHT.dec()
+            _stats["busy_s"] += time.time() - t0
+            _stats["done"] += 1
+
+    return track_job(wrapper)
+
+
+def job_function(
+    coroutine: Callable[..., Awaitable[Any]], *, timeout: Optional[int] = None
+) -> Function:
+    """Функция для WorkerSettings.functions; timeout ARQ — он же бюджет для watchdog."""
+    return arq_func(
+        tracked(coroutine, timeout=timeout),
+        name=coroutine.__name__,
+        timeout=timeout or settings.ARQ_JOB_TIMEOUT_S,
+    )
+
+
+def _watchdog(now: float) -> None:
+    for job_id, job in list(_inflight.items()):
+        elapsed = now - job["started"]
+        if elapsed <= job["budget"]:
+            continue
+        if not job["flagged"]:
+            job["flagged"] = True
+            _stats["flagged"] += 1
+            WATCHDOG_ACTIONS_TOTAL.labels(job["function"], "flagged").inc()
+            log.error("worker.job_over_budget", extra={
+                "job_id": job_id,
+                "function": job["function"],
+                "elapsed_s": round(elapsed),
+                "budget_s": job["budget"],
+            })
+        if (
+            settings.WORKER_WATCHDOG_ABORT
+            and elapsed > job["budget"] + settings.WORKER_WATCHDOG_GRACE_S
+            and job["task"] is not None
+            and not job["task"].done()
+        ):
+            # ARQ уже должен был отменить задачу по таймауту — значит, она
+            # глотает CancelledError или висит в неотменяемом коде
+            job["task"].cancel()
+            _stats["aborted"] += 1
+            WATCHDOG_ACTIONS_TOTAL.labels(job["function"], "aborted").inc()
+            log.error("worker.job_aborted", extra={
+                "job_id": job_id,
+                "function": job["function"],
+                "elapsed_s": round(elapsed),
+            })
+
+
+async def _publish(redis, now: float, queue_name: str, max_jobs: int) -> None:
+    ttl = settings.WORKER_HEARTBEAT_S * 3
+    summary = {
+        "queue": queue_name,
+        "pid": os.getpid(),
+        "started": _stats["started"],
+        "last_seen": now,
+        "max_jobs": max_jobs,
+        "running": len(_inflight),
+        "busy_s": round(_stats["busy_s"] + sum(now - j["started"] for j in _inflight.values()), 1),
+        "done": _stats["done"],
+        "flagged": _stats["flagged"],
+        "aborted": _stats["aborted"],
+    }
+    jobs = {
+        job_id: orjson.dumps({k: v for k, v in job.items() if k != "task"})
+        for job_id, job in _inflight.items()
+    }
+    async with redis.pipeline(transaction=True) as p:
+        p.zadd(WORKERS_KEY, {WORKER_ID: now})
+        p.hset(_key(WORKER_ID), mapping=summary)
+        p.expire(_key(WORKER_ID), ttl)
+        p.delete(_jobs_key(WORKER_ID))
+        if jobs:
+            p.hset(_jobs_key(WORKER_ID), mapping=jobs)
+            p.expire(_jobs_key(WORKER_ID), ttl)
+        await p.execute()
+
+
+async def heartbeat_loop(ctx: dict) -> None:
+    """Запускается из on_startup воркера; живёт до shutdown."""
+    redis = ctx["redis"]
+    while True:
+        now = time.time()
+        _watchdog(now)
+        try:
+            await _publish(redis, now, ctx["queue_name"], ctx["max_jobs"])
+        except Exception:
+            log.warning("worker.heartbeat_failed", extra={"worker_id": WORKER_ID})
+        await asyncio.sleep(settings.WORKER_HEARTBEAT_S)
+
+
+async def heartbeat_stop(ctx: dict) -> None:
+    redis = ctx["redis"]
+    try:
+        async with redis.pipeline(transaction=True) as p:
+            p.zrem(WORKERS_KEY, WORKER_ID)
+            p.delete(_key(WORKER_ID), _jobs_key(WORKER_ID))
+            await p.execute()
+    except Exception:
+        pass
+
+
+async def workers_overview(redis) -> List[Dict[str, Any]]:
+    """Живые воркеры со сводкой и задачами в работе (для админки)."""
+    now = time.time()
+    await redis.zremrangebyscore(WORKERS_KEY, 0, now - settings.WORKER_HEARTBEAT_S * 3)
+    ids = [w.decode() for w in await redis.zrange(WORKERS_KEY, 0, -1)]
+    if not ids:
+        return []
+
+    async with redis.pipeline(transaction=False) as p:
+        for wid in ids:
+            p.hgetall(_key(wid))
+            p.hgetall(_jobs_key(wid))
+        rows = await p.execute()
+
+    out = []
+    for i, wid in enumerate(ids):
+        summary = {k.decode(): v.decode() for k, v in rows[2 * i].items()}
+        if not summary:
+            continue
+        jobs = []
+        for job_id, raw in rows[2 * i + 1].items():
+            job = orjson.loads(raw)
+            job["job_id"] = job_id.decode()
+            job["elapsed_s"] = now - job["started"]
+            jobs.append(job)
+        jobs.sort(key=lambda j: j["started"])
+
+        uptime = max(1.0, now - float(summary["started"]))
+        max_jobs = int(summary["max_jobs"])
+        out.append({
+            "worker_id": wid,
+            "queue": summary.get("queue"),
+            "running": int(summary["running"]),
+            "max_jobs": max_jobs,
+            "done": int(summary["done"]),
+            "flagged": int(summary["flagged"]),
+            "aborted": int(summary["aborted"]),
+            "uptime_s": uptime,
+            # средняя загрузка слотов с момента старта
+            "utilization": float(summary["busy_s"]) / (uptime * max_jobs),
+            "jobs": jobs,
+        })
+    return out
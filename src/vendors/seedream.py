@@ -1,6 +1,5 @@
 from __future__ import annotations
 import asyncio
-import json
 import logging
 import time
 from typing import Any, Dict, List, Optional
@@ -8,15 +7,13 @@ from typing import Any, Dict, List, Optional
 import httpx
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from core.config import settings
+from services.metrics import RATE_LIMITED_TOTAL, RETRIES_TOTAL, SEEDREAM_REQUEST_SECONDS
 
 log = logging.getLogger("seedream")
 
 class SeedreamError(Exception):
     ...
 
-def _j(event: str, **fields) -> str:
-    return json.dumps({"event": event, **fields}, ensure_ascii=False)
-
 class SeedreamClient:
     """
     Client для Seedream V4 API (KIE.ai)
@@ -36,6 +33,17 @@ class SeedreamClient:
             timeout=httpx.Timeout(connect=15.0, read=120.0, write=30.0, pool=10.0)
         )
 
+    async def _request(self, method: str, url: str, *, op: str, **kwargs) -> httpx.Response:
+        """HTTP-запрос к KIE.ai с учётом задержки по операции и статусу"""
+        t0 = time.perf_counter()
+        status = "error"
+        try:
+            r = await self._client.request(method, url, **kwargs)
+            status = str(r.status_code)
+            return r
+        finally:
+            SEEDREAM_REQUEST_SECONDS.labels(op, status).observe(time.perf_counter() - t0)
+
     async def aclose(self):
         try:
             await self._client.aclose()
@@ -99,45 +107,52 @@ class SeedreamClient:
         if callback_url:
             payload["callBackUrl"] = callback_url
 
-        log.info(_j("seedream.create_edit.request", cid=cid, prompt_len=len(prompt), 
-                   images=len(image_urls), size=image_size, resolution=image_resolution,
-                   max_images=max_images, seed=seed))
+        log.info("seedream.create_edit.request", extra={
+            "cid": cid,
+            "prompt_len": len(prompt),
+            "images": len(image_urls),
+            "size": image_size,
+            "resolution": image_resolution,
+            "max_images": max_images,
+            "seed": seed,
+        })
 
         try:
-            r = await self._client.post(self.create_url, headers=self.common_hdr, json=payload)
+            r = await self._request("POST", self.create_url, op="create_edit", headers=self.common_hdr, json=payload)
             
-            log.info(_j("seedream.response", cid=cid, status=r.status_code, 
-                       body=r.text[:1000]))
+            log.info("seedream.response", extra={"cid": cid, "status": r.status_code, "body": r.text[:1000]})
             
             if r.status_code == 401:
-                log.error(_j("seedream.create.unauthorized", cid=cid))
+                log.error("seedream.create.unauthorized", extra={"cid": cid})
                 raise SeedreamError("❌ Неправильный API ключ. Проверьте KIE_API_KEY")
             
             if r.status_code == 402:
-                log.error(_j("seedream.create.insufficient_funds", cid=cid))
+                log.error("seedream.create.insufficient_funds", extra={"cid": cid})
                 raise SeedreamError("❌ Недостаточно средств на аккаунте KIE.ai")
             
             if r.status_code == 404:
-                log.error(_j("seedream.create.not_found", cid=cid))
+                log.error("seedream.create.not_found", extra={"cid": cid})
                 raise SeedreamError("❌ Модель не найдена на https://kie.ai")
             
             if r.status_code == 422:
-                log.error(_j("seedream.create.validation_error", cid=cid, body=r.text))
+                log.error("seedream.create.validation_error", extra={"cid": cid, "body": r.text})
                 raise SeedreamError(f"❌ Ошибка валидации: {r.text}")
             
             if r.status_code == 429:
                 ra = r.headers.get("Retry-After")
                 delay = int(ra) if (ra and ra.isdigit()) else 3
-                log.warning(_j("seedream.create.rate_limited", cid=cid, retry_after=delay))
+                log.warning("seedream.create.rate_limited", extra={"cid": cid, "retry_after": delay})
+                RATE_LIMITED_TOTAL.labels("kie").inc()
+                RETRIES_TOTAL.labels("kie").inc()
                 await asyncio.sleep(delay)
-                r = await self._client.post(self.create_url, headers=self.common_hdr, json=payload)
+                r = await self._request("POST", self.create_url, op="create_edit", headers=self.common_hdr, json=payload)
             
             if 500 <= r.status_code < 600:
-                log.error(_j("seedream.create.5xx", cid=cid, status=r.status_code))
+                log.error("seedream.create.5xx", extra={"cid": cid, "status": r.status_code})
                 raise SeedreamError(f"❌ Ошибка сервера KIE.ai: {r.status_code}")
             
             if r.status_code == 400:
-                log.error(_j("seedream.create.bad_request", cid=cid, resp=r.text[:500]))
+                log.error("seedream.create.bad_request", extra={"cid": cid, "resp": r.text[:500]})
                 raise SeedreamError(f"❌ Неправильный запрос: {r.text[:200]}")
 
             r.raise_for_status()
@@ -145,19 +160,19 @@ class SeedreamClient:
             
             if data.get("code") != 200:
                 error_msg = data.get('msg', 'unknown')
-                log.error(_j("seedream.create.api_error", cid=cid, msg=error_msg))
+                log.error("seedream.create.api_error", extra={"cid": cid, "api_msg": error_msg})
                 raise SeedreamError(f"❌ Ошибка API: {error_msg}")
             
             task_id = data.get("data", {}).get("taskId")
             if not task_id:
-                log.error(_j("seedream.create.no_task_id", cid=cid))
+                log.error("seedream.create.no_task_id", extra={"cid": cid})
                 raise SeedreamError("❌ Нет taskId в ответе")
 
-            log.info(_j("seedream.create_edit.ok", cid=cid, task_id=task_id))
+            log.info("seedream.create_edit.ok", extra={"cid": cid, "task_id": task_id})
             return task_id
             
         except httpx.HTTPError as e:
-            log.error(_j("seedream.http_error", cid=cid, error=str(e)))
+            log.error("seedream.http_error", extra={"cid": cid, "error": str(e)})
             raise SeedreamError(f"❌ Ошибка HTTP: {e}")
 
     @retry(
@@ -201,13 +216,19 @@ class SeedreamClient:
         if callback_url:
             payload["callBackUrl"] = callback_url
 
-        log.info(_j("seedream.create_t2i.request", cid=cid, prompt_len=len(prompt), 
-                   size=image_size, resolution=image_resolution, max_images=max_images, seed=seed))
+        log.info("seedream.create_t2i.request", extra={
+            "cid": cid,
+            "prompt_len": len(prompt),
+            "size": image_size,
+            "resolution": image_resolution,
+            "max_images": max_images,
+            "seed": seed,
+        })
 
         try:
-            r = await self._client.post(self.create_url, headers=self.common_hdr, json=payload)
+            r = await self._request("POST", self.create_url, op="create_t2i", headers=self.common_hdr, json=payload)
             
-            log.info(_j("seedream.response", cid=cid, status=r.status_code, body=r.text[:1000]))
+            log.info("seedream.response", extra={"cid": cid, "status": r.status_code, "body": r.text[:1000]})
             
             if r.status_code == 401:
                 raise SeedreamError("❌ Неправильный API ключ")
@@ -218,8 +239,10 @@ class SeedreamClient:
             if r.status_code == 422:
                 raise SeedreamError(f"❌ Ошибка валидации: {r.text[:200]}")
             if r.status_code == 429:
+                RATE_LIMITED_TOTAL.labels("kie").inc()
+                RETRIES_TOTAL.labels("kie").inc()
                 await asyncio.sleep(3)
-                r = await self._client.post(self.create_url, headers=self.common_hdr, json=payload)
+                r = await self._request("POST", self.create_url, op="create_t2i", headers=self.common_hdr, json=payload)
             if 500 <= r.status_code < 600:
                 raise SeedreamError(f"❌ Ошибка сервера: {r.status_code}")
 
@@ -233,19 +256,21 @@ class SeedreamClient:
             if not task_id:
                 raise SeedreamError("❌ Нет taskId")
 
-            log.info(_j("seedream.create_t2i.ok", cid=cid, task_id=task_id))
+            log.info("seedream.create_t2i.ok", extra={"cid": cid, "task_id": task_id})
             return task_id
             
         except httpx.HTTPError as e:
-            log.error(_j("seedream.http_error", cid=cid, error=str(e)))
+            log.error("seedream.http_error", extra={"cid": cid, "error": str(e)})
             raise SeedreamError(f"❌ HTTP: {e}")
 
     async def get_status(self, task_id: str, *, cid: Optional[str] = None) -> Dict[str, Any]:
         """Получение статуса задачи"""
-        r = await self._client.get(self.status_url, headers=self.auth_hdr, params={"taskId": task_id})
+        r = await self._request("GET", self.status_url, op="status", headers=self.auth_hdr, params={"taskId": task_id})
         if r.status_code == 429:
+            RATE_LIMITED_TOTAL.labels("kie").inc()
+            RETRIES_TOTAL.labels("kie").inc()
             await asyncio.sleep(2)
-            r = await self._client.get(self.status_url, headers=self.auth_hdr, params={"taskId": task_id})
+            r = await self._request("GET", self.status_url, op="status", headers=self.auth_hdr, params={"taskId": task_id})
         r.raise_for_status()
         data = r.json()
         if data.get("code") != 200:
@@ -0,0 +1,114 @@
+from __future__ import annotations
+import logging
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+from core.config import settings
+from services.metrics import RATE_LIMITED_TOTAL, RETRIES_TOTAL, YOOKASSA_REQUEST_SECONDS
+
+log = logging.getLogger("yookassa")
+
+
+class YooKassaError(Exception):
+    """Ответ API YooKassa с ошибкой (тело ошибки по документации API v3)."""
+
+    def __init__(self, status: int, body: Optional[Dict[str, Any]] = None):
+        body = body or {}
+        self.status = status
+        self.type = body.get("type")
+        self.code = body.get("code")
+        self.description = body.get("description")
+        self.parameter = body.get("parameter")
+        super().__init__(f"YooKassa {status}: {self.code} {self.description or ''}".strip())
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == 429 or self.status >= 500
+
+
+def _retryable(e: BaseException) -> bool:
+    if isinstance(e, YooKassaError):
+        return e.retryable
+    return isinstance(e, httpx.TransportError)
+
+
+def _before_retry(state) -> None:
+    RETRIES_TOTAL.labels("yookassa").inc()
+
+
+class YooKassaClient:
+    """
+    Асинхронный клиент API YooKassa v3 поверх httpx (вместо синхронного SDK на requests).
+
+    Повторы — с тем же Idempotence-Key: YooKassa вернёт уже созданный платёж,
+    а не создаст второй.
+    """
+
+    def __init__(self):
+        self._client = httpx.AsyncClient(
+            base_url=settings.YOOKASSA_API_BASE.rstrip("/"),
+            auth=(settings.YOOKASSA_SHOP_ID, settings.YOOKASSA_SECRET_KEY),
+            timeout=httpx.Timeout(connect=5.0, read=settings.YOOKASSA_TIMEOUT_S, write=10.0, pool=5.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+
+    async def aclose(self):
+        try:
+            await self._client.aclose()
+        except Exception:
+            pass
+
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=0.5, max=4),
+        retry=retry_if_exception(_retryable),
+        before_sleep=_before_retry,
+        reraise=True,
+    )
+    async def _request(self, method: str, path: str, *, op: str, **kwargs) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        status = "error"
+        try:
+            r = await self._client.request(method, path, **kwargs)
+            status = str(r.status_code)
+        finally:
+            YOOKASSA_REQUEST_SECONDS.labels(op, status).observe(time.perf_counter() - t0)
+
+        if r.status_code == 429:
+            RATE_LIMITED_TOTAL.labels("yookassa").inc()
+        if r.status_code >= 400:
+            try:
+                body = r.json()
+            except ValueError:
+                body = {"description": r.text[:500]}
+            raise YooKassaError(r.status_code, body)
+        return r.json()
+
+    async def create_payment(self, body: Dict[str, Any], idem_key: str) -> Dict[str, Any]:
+        return await self._request(
+            "POST", "/payments", op="create_payment", json=body, headers={"Idempotence-Key": idem_key}
+        )
+
+    async def get_payment(self, payment_id: str) -> Dict[str, Any]:
+        return await self._request("GET", f"/payments/{payment_id}", op="get_payment")
+
+
+_client: Optional[YooKassaClient] = None
+
+
+def get_yookassa() -> YooKassaClient:
+    """Общий на процесс клиент (пул соединений к API)."""
+    global _client
+    if _client is None:
+        _client = YooKassaClient()
+    return _client
+
+
+async def close_yookassa() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -1,8 +1,106 @@
+import asyncio
+import time
+
+from arq.constants import health_check_key_suffix
 from fastapi import APIRouter
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from sqlalchemy import text
+
+from core.config import settings
+from core.redis import get_redis
+from db.engine import engine
+from services.queue import QUEUES
 
 router = APIRouter()
 
+PROBE_TIMEOUT_S = 1.5
+READY_CACHE_TTL_S = 3.0
+# Без MySQL/Redis бот не работает → 503; воркер и очередь — только "degraded"
+CRITICAL = ("mysql", "redis_fsm", "redis_cache")
+
+_ready_cache: dict = {"at": 0.0, "body": None, "code": 200}
+_ready_lock = asyncio.Lock()
+
+
 @router.get("/healthz")
 async def healthz():
     return PlainTextResponse("ok")
+
+
+async def _probe_mysql():
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+
+async def _probe_redis_fsm():
+    await get_redis(settings.REDIS_DB_FSM).ping()
+
+
+async def _probe_redis_cache():
+    await get_redis(settings.REDIS_DB_CACHE).ping()
+
+
+async def _probe_queue():
+    async with get_redis(settings.REDIS_DB_CACHE).pipeline(transaction=False) as p:
+        for q in QUEUES:
+            p.zcard(q)
+        depths = await p.execute()
+    return {"depth": dict(zip(QUEUES, depths))}
+
+
+async def _probe_worker():
+    # ARQ сам пишет {queue}:health-check с TTL health_check_interval+1 секунд
+    infos = await get_redis(settings.REDIS_DB_CACHE).mget([q + health_check_key_suffix for q in QUEUES])
+    alive = {q: info is not None for q, info in zip(QUEUES, infos)}
+    missing = [q for q, ok in alive.items() if not ok]
+    if missing:
+        raise RuntimeError("no heartbeat: " + ", ".join(missing))
+    return {"queues": alive}
+
+
+async def _run_probe(fn):
+    t0 = time.perf_counter()
+    res = {"ok": True}
+    try:
+        extra = await asyncio.wait_for(fn(), timeout=PROBE_TIMEOUT_S)
+        if extra:
+            res.update(extra)
+    except asyncio.TimeoutError:
+        res = {"ok": False, "error": "timeout"}
+    except Exception as e:
+        res = {"ok": False, "error": str(e)[:200]}
+    res["latency_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return res
+
+
+async def _check_all():
+    probes = {
+        "mysql": _probe_mysql,
+        "redis_fsm": _probe_redis_fsm,
+        "redis_cache": _probe_redis_cache,
+        "queue": _probe_queue,
+        "worker": _probe_worker,
+    }
+    results = await asyncio.gather(*(_run_probe(fn) for fn in probes.values()))
+    checks = dict(zip(probes, results))
+
+    if not all(checks[name]["ok"] for name in CRITICAL):
+        status, code = "fail", 503
+    elif not all(c["ok"] for c in checks.values()):
+        status, code = "degraded", 200
+    else:
+        status, code = "ok", 200
+    return {"status": status, "checks": checks}, code
+
+
+@router.get("/readyz")
+async def readyz():
+    """Глубокая проверка зависимостей; результат кэшируется на несколько секунд"""
+    if time.monotonic() - _ready_cache["at"] > READY_CACHE_TTL_S:
+        async with _ready_lock:
+            # пока ждали lock, кэш мог обновить другой запрос
+            if time.monotonic() - _ready_cache["at"] > READY_CACHE_TTL_S:
+                body, code = await _check_all()
+                _ready_cache.update(at=time.monotonic(), body=body, code=code)
+    body = dict(_ready_cache["body"], age_s=round(time.monotonic() - _ready_cache["at"], 1))
+    return JSONResponse(body, status_code=_ready_cache["code"])
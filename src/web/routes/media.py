@@ -0,0 +1,107 @@
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+from services.blobstore import blob_path, touch
+from services.media import verify_signature
+
+router = APIRouter()
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+_CHUNK = 64 * 1024
+
+
+def _iter_file(path: str, start: int, length: int):
+    # sync-генератор: Starlette крутит его в threadpool
+    with open(path, "rb") as f:
+        f.seek(start)
+        left = length
+        while left > 0:
+            chunk = f.read(min(_CHUNK, left))
+            if not chunk:
+                break
+            left -= len(chunk)
+            yield chunk
+
+
+def _parse_range(header: str, size: int):
+    """(start, end) включительно; None — заголовок не понят (отдаём целиком); ValueError — 416."""
+    m = _RANGE_RE.match(header.strip())
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if not m.group(1):
+        # bytes=-N — последние N байт
+        n = int(m.group(2))
+        if n == 0:
+            raise ValueError
+        return max(0, size - n), size - 1
+    start = int(m.group(1))
+    end = int(m.group(2)) if m.group(2) else size - 1
+    if start >= size or end < start:
+        raise ValueError
+    return start, min(end, size - 1)
+
+
+@router.api_route("/media/{key}", methods=["GET", "HEAD"])
+async def media(key: str, req: Request):
+    """Входные фото для KIE по подписанной ссылке (services.media). Range + ETag"""
+    if not verify_signature(key, req.query_params.get("e"), req.query_params.get("s")):
+        raise HTTPException(403, "forbidden")
+    path = blob_path(key)
+    if not path:
+        raise HTTPException(404, "not found")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(404, "not found")
+
+    # ключ — SHA-256 содержимого, поэтому ETag сильный и вечный
+    etag = f'"{key.split(".", 1)[0]}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=3600, immutable",
+    }
+
+    inm = req.headers.get("if-none-match")
+    if inm:
+        if etag in [t.strip() for t in inm.split(",")] or inm.strip() == "*":
+            return Response(status_code=304, headers=headers)
+    else:
+        ims = req.headers.get("if-modified-since")
+        if ims:
+            try:
+                if int(st.st_mtime) <= parsedate_to_datetime(ims).timestamp():
+                    return Response(status_code=304, headers=headers)
+            except (TypeError, ValueError):
+                pass
+
+    size = st.st_size
+    start, end, status = 0, size - 1, 200
+    range_header = req.headers.get("range")
+    if_range = req.headers.get("if-range")
+    if range_header and size > 0 and (not if_range or if_range.strip() == etag):
+        try:
+            rng = _parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if rng:
+            start, end = rng
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    await touch(key)
+    length = end - start + 1 if size else 0
+    headers["Content-Length"] = str(length)
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    if req.method == "HEAD":
+        return Response(status_code=status, headers=headers, media_type=media_type)
+    return StreamingResponse(
+        _iter_file(path, start, length), status_code=status, headers=headers, media_type=media_type
+    )
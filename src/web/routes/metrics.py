@@ -0,0 +1,28 @@
+import logging
+
+from fastapi import APIRouter
+from fastapi.responses import Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from core.config import settings
+from core.redis import get_redis
+from services.metrics import ARQ_QUEUE_DEPTH
+from services.queue import QUEUES
+
+router = APIRouter()
+log = logging.getLogger("metrics")
+
+
+@router.get("/metrics")
+async def metrics():
+    """Prometheus-метрики веб-процесса (+ глубина очередей ARQ на момент скрейпа)"""
+    try:
+        async with get_redis(settings.REDIS_DB_CACHE).pipeline(transaction=False) as p:
+            for q in QUEUES:
+                p.zcard(q)
+            depths = await p.execute()
+        for q, depth in zip(QUEUES, depths):
+            ARQ_QUEUE_DEPTH.labels(q).set(depth)
+    except Exception:
+        log.warning("metrics.queue_depth_failed")
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,16 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+from core.config import settings
+from services.tracing import stage_percentiles
+
+router = APIRouter()
+
+
+@router.get("/trace/stats")
+async def trace_stats(req: Request, window: int = 3600):
+    """Перцентили этапов генерации (мс) за окно window секунд. Защищено ?t=WEBHOOK_SECRET_TOKEN"""
+    if req.query_params.get("t") != settings.WEBHOOK_SECRET_TOKEN:
+        raise HTTPException(403, "forbidden")
+    window = max(60, min(window, 7 * 86400))
+    return JSONResponse({"window_s": window, "segments": await stage_percentiles(window)})
@@ -1,29 +1,37 @@
 import asyncio
-import redis.asyncio as redis
 
 from fastapi import FastAPI
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
 from aiogram.exceptions import TelegramRetryAfter
 
 from core.config import settings
 from core.logging import configure_json_logging
+from core.fsm import get_fsm_storage
+from core.redis import close_redis
+from services.queue import close_arq_pool
+from services.ratelimit import RateLimiter
+from vendors.yookassa import close_yookassa
+from services.metrics import TelegramMetricsMiddleware
 
-from bot.middlewares import ErrorLoggingMiddleware, RateLimitMiddleware
+from bot.middlewares import ErrorLoggingMiddleware, FSMBufferMiddleware, RateLimitMiddleware
 from bot.routers import voice as r_voice
 from bot.routers import broadcast as r_broadcast
 # from bot.routers import settings as r_settings
 from bot.routers import generation as r_generation
 from bot.routers import payments as r_payments
 from bot.routers import commands as r_cmd
+from bot.routers import admin as r_admin
 
 from web.routes import tg as rt_tg
 from web.routes import yookassa as rt_yk
 from web.routes import health as rt_health
 from web.routes import misc as rt_misc
 from web.routes import seedream as rt_seedream
+from web.routes import metrics as rt_metrics
+from web.routes import trace as rt_trace
+from web.routes import media as rt_media
 
 configure_json_logging()
 app = FastAPI(title="Seedream Bot", version="1.0.0")
@@ -32,13 +40,12 @@ bot = Bot(
     token=settings.TELEGRAM_BOT_TOKEN,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
+bot.session.middleware(TelegramMetricsMiddleware())
 
-redis_fsm = redis.from_url(
-    f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB_FSM}"
-)
-storage = RedisStorage(redis=redis_fsm, key_builder=DefaultKeyBuilder(with_bot_id=True))
+storage = get_fsm_storage()
 dp = Dispatcher(storage=storage)
 
+dp.include_router(r_admin.router)
 dp.include_router(r_generation.router)  
 dp.include_router(r_voice.router)
 dp.include_router(r_broadcast.router)
@@ -48,21 +55,17 @@ dp.include_router(r_cmd.router)
 
 
 # Middlewares
+rate_limiter = RateLimiter(settings.RATE_LIMIT_PER_MIN)
+# буфер FSM должен быть снаружи FSMContextMiddleware (Dispatcher регистрирует его
+# первым), иначе её get_state — отдельное небуферизованное чтение Redis
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(FSMBufferMiddleware(storage))
+dp.update.outer_middleware(dp.fsm)
 dp.message.middleware(ErrorLoggingMiddleware())
-dp.message.middleware(
-    RateLimitMiddleware(
-        redis.from_url(f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB_CACHE}"),
-        settings.RATE_LIMIT_PER_MIN,
-    )
-)
+dp.message.middleware(RateLimitMiddleware(rate_limiter, "message"))
 
 dp.callback_query.middleware(ErrorLoggingMiddleware())
-dp.callback_query.middleware(
-    RateLimitMiddleware(
-        redis.from_url(f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB_CACHE}"),
-        settings.RATE_LIMIT_PER_MIN,
-    )
-)
+dp.callback_query.middleware(RateLimitMiddleware(rate_limiter, "callback"))
 
 app.state.bot = bot
 app.state.dp = dp
@@ -73,6 +76,9 @@ app.include_router(rt_yk.router)
 app.include_router(rt_health.router)
 app.include_router(rt_misc.router)
 app.include_router(rt_seedream.router)
+app.include_router(rt_metrics.router)
+app.include_router(rt_trace.router)
+app.include_router(rt_media.router)
 
 @app.on_event("startup")
 async def on_startup():
@@ -94,3 +100,6 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     await bot.session.close()
+    await close_arq_pool()
+    await close_yookassa()
+    await close_redis()